@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+SpotPDF バッチ比較 CLI
+
+多数のPDFペアを PixelDiffDetector でヘッドレスに比較し、結果を JSON Lines で出力します。
+
+使用例:
+    # 2つのフォルダ内の同名ファイルを比較
+    python batch_diff.py --old-dir drawings/rev1 --new-dir drawings/rev2 -o batch_output
+
+    # マニフェスト (CSV: old,new 列 / JSON Lines: {"old": ..., "new": ...}) で指定
+    python batch_diff.py --manifest pairs.csv -o batch_output --workers 4
+
+    # リビジョンチェーン (v1→v2→v3) を各リビジョン1回のラスタライズで比較
+    python batch_diff.py --chain v1.pdf v2.pdf v3.pdf -o chain_output --compare-to-first
+
+    # 画像を出力せず、変更のあるページだけを素早く調べる (CI の事前チェック向け)
+    python batch_diff.py --old-dir rev1 --new-dir rev2 -o quick_output --quick --fail-on-changes
+
+中断後に同じコマンドを再実行すると、サマリーに "ok" として記録済みのペアはスキップされ、
+途中で中断したペアは完了済みのページ (チェックポイント) から再開します。
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+SUMMARY_FILENAME = "summary.jsonl"
+# --quick の結果は通常の比較と混ざらないよう (再開時に完了済みと誤認しないよう) 別のファイルに書く
+QUICK_SUMMARY_FILENAME = "quick_summary.jsonl"
+
+
+def pair_key(old_pdf: str, new_pdf: str) -> str:
+    return f"{os.path.abspath(old_pdf)}::{os.path.abspath(new_pdf)}"
+
+
+def load_manifest(manifest_path: str) -> List[Tuple[str, str]]:
+    """CSV (old,new 列) または JSON Lines のマニフェストからペアを読み込む"""
+    path = Path(manifest_path)
+    base_dir = path.parent
+    pairs = []
+    with open(path, "r", encoding="utf-8") as f:
+        if path.suffix.lower() in (".jsonl", ".json"):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = list(csv.DictReader(f))
+    for record in records:
+        old_pdf, new_pdf = record.get("old"), record.get("new")
+        if not old_pdf or not new_pdf:
+            raise ValueError(f"マニフェストの行に old/new がありません: {record}")
+        pairs.append((str(base_dir / old_pdf), str(base_dir / new_pdf)))
+    return pairs
+
+
+def pairs_from_directories(old_dir: str, new_dir: str) -> List[Tuple[str, str]]:
+    """2つのフォルダからフォルダ内の相対パスが同じ (大文字小文字を区別しない) PDFをペアにする
+
+    サブフォルダも含めて探すため、別のサブフォルダにある同名のファイルは別のファイルとして扱う。
+    """
+    def relative_key(root: Path, path: Path) -> str:
+        return path.relative_to(root).as_posix().lower()
+
+    new_root = Path(new_dir)
+    new_files = {relative_key(new_root, p): p for p in new_root.rglob("*.pdf")}
+    old_root = Path(old_dir)
+    pairs = []
+    for old_file in sorted(old_root.rglob("*.pdf")):
+        new_file = new_files.get(relative_key(old_root, old_file))
+        if new_file is None:
+            logging.warning(f"対応する新版ファイルがありません: {old_file}")
+            continue
+        pairs.append((str(old_file), str(new_file)))
+    return pairs
+
+
+def load_completed(summary_path: Path) -> Dict[str, Dict]:
+    """既存サマリーから正常終了したペアを読み込む (再開用)"""
+    completed = {}
+    if not summary_path.exists():
+        return completed
+    with open(summary_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 中断時に書きかけになった行
+            if record.get("status") == "ok":
+                completed[record["key"]] = record
+    return completed
+
+
+def run_pair(old_pdf: str, new_pdf: str, output_dir: str, settings: Dict) -> Dict:
+    """ワーカープロセスで1ペアを比較し、サマリーレコードを返す"""
+    from pixel_diff_detector import PixelDiffDetector
+
+    started = time.perf_counter()
+    record = {"key": pair_key(old_pdf, new_pdf), "old": old_pdf, "new": new_pdf,
+              "started_at": datetime.now().isoformat(timespec="seconds")}
+    try:
+        if settings.get("quick"):
+            results = PixelDiffDetector().quick_check(old_pdf, new_pdf, settings=settings)
+            record.update({
+                "status": "ok",
+                "quick": True,
+                "changed": results["changed"],
+                "pages": results["page_count"],
+                "changed_pages": results["changed_pages"],
+                "total_changes": sum(p.get("changed_pixels", 0) for p in results["pages"]),
+                "page_changes": results["pages"],
+                "added_pages": results["added_pages"],
+                "removed_pages": results["removed_pages"],
+                "dpi": results["dpi"],
+            })
+        else:
+            results = PixelDiffDetector().create_pixel_diff_output(old_pdf, new_pdf, output_dir, settings=settings)
+            record.update({
+                "status": "ok",
+                "pages": results["page_count"],
+                "changed_pages": [p["page"] for p in results["pages"] if p["change_count"]],
+                "total_changes": results["total_changes"],
+                "page_changes": [{"page": p["page"], "old_page": p["old_page"], "new_page": p["new_page"],
+                                  "status": p["status"], "change_count": p["change_count"], "clip": p.get("clip"), "dpi": p.get("dpi")}
+                                 for p in results["pages"]],
+                "added_pages": results["added_pages"],
+                "removed_pages": results["removed_pages"],
+                "output_path": results["output_path"],
+                "diff_images": results["diff_images"],
+                "summary_pdf": results["summary_pdf"],
+                "profile_trace": results.get("profile_trace"),
+            })
+    except Exception as e:
+        record.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+    record["elapsed_sec"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_batch(pairs: List[Tuple[str, str]], output_dir: str, settings: Dict, workers: int = None,
+              summary_path: Path = None, resume: bool = True) -> List[Dict]:
+    output_root = Path(output_dir)
+    output_root.mkdir(parents=True, exist_ok=True)
+    summary_path = Path(summary_path) if summary_path else output_root / (QUICK_SUMMARY_FILENAME if settings.get("quick") else SUMMARY_FILENAME)
+
+    completed = load_completed(summary_path) if resume else {}
+    # 同名ファイルが別フォルダにあっても出力先が衝突しないよう、ペアごとにフォルダを分ける
+    pending = [(i, o, n) for i, (o, n) in enumerate(pairs, 1) if pair_key(o, n) not in completed]
+    logging.info(f"{len(pairs)} ペア中 {len(pairs) - len(pending)} ペアは完了済み、{len(pending)} ペアを処理します")
+
+    records = list(completed.values())
+    with open(summary_path, "a", encoding="utf-8") as summary, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_pair, o, n, str(output_root / f"{i:04d}_{Path(o).stem}"), settings) for i, o, n in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            summary.write(json.dumps(record, ensure_ascii=False) + "\n")
+            summary.flush()
+            os.fsync(summary.fileno())
+            records.append(record)
+            if record["status"] == "ok":
+                logging.info(f"[{len(records)}/{len(pairs)}] {Path(record['old']).name}: "
+                             f"{record['total_changes']} ピクセル変更 ({record['elapsed_sec']} 秒)")
+            else:
+                logging.error(f"[{len(records)}/{len(pairs)}] {Path(record['old']).name}: {record['error']}")
+    return records
+
+
+def run_chain(pdf_paths: List[str], output_dir: str, settings: Dict, fail_on_changes: bool = False) -> int:
+    """リビジョンチェーンを1ジョブで比較し、ステップごとの変更数を表示する"""
+    from pixel_diff_detector import PixelDiffDetector
+
+    if len(pdf_paths) < 2:
+        logging.error("--chain には2つ以上のPDFが必要です")
+        return 2
+    try:
+        results = PixelDiffDetector().create_revision_chain_output(pdf_paths, output_dir, settings=settings)
+    except Exception as e:
+        logging.error(f"リビジョン比較に失敗しました: {e}")
+        return 2
+    for step in results["steps"]:
+        print(json.dumps({key: step[key] for key in ("step", "old", "new", "total_changes")}, ensure_ascii=False))
+    logging.info(f"レポート: {results['report']}")
+    return 1 if fail_on_changes and results["total_changes"] else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="SpotPDF バッチ比較 (ヘッドレス)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", help="ペア一覧 (CSV: old,new 列 / JSON Lines)")
+    source.add_argument("--old-dir", help="旧版PDFのフォルダ (--new-dir と併用)")
+    source.add_argument("--chain", nargs="+", metavar="PDF", help="古い順に並べたリビジョンのPDF (連続ペアを比較)")
+    parser.add_argument("--new-dir", help="新版PDFのフォルダ")
+    parser.add_argument("-o", "--output", default="batch_output", help="出力フォルダ")
+    parser.add_argument("--summary", help=f"サマリー JSON Lines のパス (既定: <output>/{SUMMARY_FILENAME})")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="並列プロセス数 (既定: CPU数)")
+    parser.add_argument("--compare-to-first", action="store_true", help="--chain で各リビジョンと初版の比較も行う")
+    parser.add_argument("--sensitivity", type=int, default=10, help="差分検出感度 (1-50)")
+    parser.add_argument("--match-pages", action="store_true", help="ページを内容で対応付ける (挿入・削除・並び替えに対応)")
+    parser.add_argument("--vector-prediff", action="store_true", help="ベクター構造の事前比較で変更領域のみをラスタ比較する")
+    parser.add_argument("--memory-budget-mb", type=int, default=None, help="1ページあたりのメモリ上限 (MB)")
+    parser.add_argument("--memory-policy", choices=["reduce_dpi", "tile", "fail"], default="reduce_dpi",
+                        help="メモリ上限を超えるページの扱い (DPIを下げる / 帯状に分割 / エラー)")
+    parser.add_argument("--summary-mode", choices=["layered", "vector", "raster"], default="layered",
+                        help="統合PDFの形式: layered は元のページに変更領域だけを追加/削除のレイヤーで重ねる (軽量・既定)、"
+                             "vector はレイヤーなし、raster は差分画像を埋め込む")
+    parser.add_argument("--export-all", action="store_true", help="both/added/removed の全パターンを出力")
+    parser.add_argument("--profile", action="store_true", help="ペアごとに Chrome trace を出力")
+    parser.add_argument("--deadline-sec", type=float, default=None,
+                        help="1ペアあたりの制限時間 (秒)。超えたペアは途中の出力を削除してエラーとして記録")
+    parser.add_argument("--no-resume", action="store_true", help="既存サマリーを無視して全ペアを再実行")
+    parser.add_argument("--fail-on-changes", action="store_true", help="差分があれば終了コード 1 を返す (CI 用)")
+    parser.add_argument("--quick", action="store_true",
+                        help="画像を出力せず、ページ内容のハッシュと低解像度の比較で変更のあるページだけを調べる")
+    parser.add_argument("--first-change-only", action="store_true", help="--quick で最初の変更が見つかったら残りのページを調べない")
+    return parser
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.old_dir and not args.new_dir:
+        parser.error("--old-dir には --new-dir が必要です")
+    if args.quick and args.chain:
+        parser.error("--quick は --chain と併用できません")
+
+    settings = {
+        "sensitivity": args.sensitivity,
+        "display_filter": {"added": True, "removed": True},
+        "export_all_patterns": args.export_all,
+        "page_matching": args.match_pages,
+        "vector_prediff": args.vector_prediff,
+        "memory_budget_mb": args.memory_budget_mb,
+        "memory_policy": args.memory_policy,
+        "profile": args.profile,
+        "deadline_sec": args.deadline_sec,
+        "summary_mode": args.summary_mode,
+        # ペアの途中で中断しても、再実行時に完了済みのページから再開する
+        "checkpoint": not args.no_resume,
+        "quick": args.quick,
+        "first_change_only": args.first_change_only,
+    }
+    if args.chain:
+        return run_chain(args.chain, args.output, dict(settings, compare_to_first=args.compare_to_first),
+                         fail_on_changes=args.fail_on_changes)
+
+    pairs = load_manifest(args.manifest) if args.manifest else pairs_from_directories(args.old_dir, args.new_dir)
+    if not pairs:
+        logging.error("比較するペアがありません")
+        return 2
+
+    records = run_batch(pairs, args.output, settings, workers=args.workers,
+                        summary_path=args.summary, resume=not args.no_resume)
+
+    failed = [r for r in records if r["status"] != "ok"]
+    changed = [r for r in records if r["status"] == "ok" and (r["total_changes"] or r.get("changed"))]
+    logging.info(f"完了: {len(records)} ペア (差分あり {len(changed)}, エラー {len(failed)})")
+    if failed:
+        return 2
+    if args.fail_on_changes and changed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+共有メモリによるラスタ受け渡しのベンチマーク
+
+ページのレンダリングと差分を別々のワーカープロセスで行う構成について、
+NumPy 配列を pickle で受け渡す場合と SharedRasterPool を使う場合の処理時間を比較します。
+
+使用例:
+    python bench_shared_raster.py                       # 生成したテスト PDF (A3, 8ページ) で計測
+    python bench_shared_raster.py --old a.pdf --new b.pdf --dpi 300 --workers 4
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from shared_raster_pool import SharedRasterPool, diff_shared, raster_shape, render_page_into
+
+
+def make_test_pdf(path: str, pages: int, variant: int):
+    doc = fitz.open()
+    for index in range(pages):
+        page = doc.new_page(width=1191, height=842)  # A3 横
+        for k in range(0, 1100, 20):
+            page.draw_line((40 + k, 40), (40 + k, 800), width=0.3)
+        page.insert_text((60, 80), f"Sheet {index + 1} rev {variant}", fontsize=20)
+        if variant:
+            page.draw_rect(fitz.Rect(600, 300, 700 + index * 5, 400), color=(1, 0, 0))
+    doc.save(path)
+
+
+# --- pickle による受け渡し ---
+
+def render_to_array(pdf_path: str, page_index: int, dpi: int) -> np.ndarray:
+    with fitz.open(pdf_path) as doc:
+        zoom = dpi / 72
+        pix = doc[page_index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+
+def diff_arrays(old_image: np.ndarray, new_image: np.ndarray, pixel_threshold: int) -> int:
+    import cv2
+    old_gray = cv2.cvtColor(old_image, cv2.COLOR_RGB2GRAY)
+    new_gray = cv2.cvtColor(new_image, cv2.COLOR_RGB2GRAY)
+    _, mask = cv2.threshold(cv2.absdiff(old_gray, new_gray), pixel_threshold, 255, cv2.THRESH_BINARY)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+    return int(np.count_nonzero(mask))
+
+
+def run_pickled(executor, old_pdf, new_pdf, pages, dpi):
+    renders = [(executor.submit(render_to_array, old_pdf, i, dpi), executor.submit(render_to_array, new_pdf, i, dpi)) for i in range(pages)]
+    diffs = [executor.submit(diff_arrays, o.result(), n.result(), 10) for o, n in renders]
+    return [d.result() for d in diffs]
+
+
+def run_shared(executor, pool, old_pdf, new_pdf, pages, dpi):
+    with fitz.open(old_pdf) as old_doc, fitz.open(new_pdf) as new_doc:
+        shapes = [(raster_shape(old_doc[i].rect, dpi), raster_shape(new_doc[i].rect, dpi)) for i in range(pages)]
+    counts = []
+    # 同時に保持するページ数をワーカー数に抑え、バッファを使い回す
+    batch = executor._max_workers
+    for start in range(0, pages, batch):
+        handles = []
+        for i in range(start, min(start + batch, pages)):
+            old_h, new_h = pool.acquire(shapes[i][0]), pool.acquire(shapes[i][1])
+            handles.append((old_h, new_h, executor.submit(render_page_into, old_h, old_pdf, i, dpi),
+                            executor.submit(render_page_into, new_h, new_pdf, i, dpi)))
+        diffs = []
+        for old_h, new_h, old_f, new_f in handles:
+            old_f.result(); new_f.result()
+            diffs.append((old_h, new_h, executor.submit(diff_shared, old_h, new_h, 10)))
+        for old_h, new_h, diff_f in diffs:
+            counts.append(diff_f.result())
+            pool.release(old_h); pool.release(new_h)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pickle と共有メモリによるラスタ受け渡しの比較")
+    parser.add_argument("--old", help="旧版PDF (省略時はテスト用PDFを生成)")
+    parser.add_argument("--new", help="新版PDF")
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        old_pdf, new_pdf = args.old, args.new
+        if not (old_pdf and new_pdf):
+            old_pdf, new_pdf = os.path.join(tmp, "old.pdf"), os.path.join(tmp, "new.pdf")
+            make_test_pdf(old_pdf, args.pages, 0)
+            make_test_pdf(new_pdf, args.pages, 1)
+        with fitz.open(old_pdf) as doc:
+            pages = min(args.pages, len(doc))
+            raster_mb = np.prod(raster_shape(doc[0].rect, args.dpi)) / 1024 / 1024
+
+        print(f"{pages} ページ x 2, {args.dpi} DPI (1ページ約 {raster_mb:.0f}MB), ワーカー {args.workers}")
+        with ProcessPoolExecutor(max_workers=args.workers) as executor, SharedRasterPool() as pool:
+            # ワーカーの起動と import を計測対象から外す
+            list(executor.map(diff_arrays, [np.zeros((8, 8, 3), np.uint8)] * args.workers, [np.zeros((8, 8, 3), np.uint8)] * args.workers, [10] * args.workers))
+            for name, run in (("pickle", lambda: run_pickled(executor, old_pdf, new_pdf, pages, args.dpi)),
+                              ("shared", lambda: run_shared(executor, pool, old_pdf, new_pdf, pages, args.dpi))):
+                timings = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    counts = run()
+                    timings.append(time.perf_counter() - started)
+                print(f"  {name:6s}: 最速 {min(timings):.2f} 秒 / 平均 {sum(timings) / len(timings):.2f} 秒 (変更ピクセル合計 {sum(counts)})")
+            print(f"  共有バッファ: 新規確保 {pool.stats['allocated']} / 再利用 {pool.stats['reused']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Web アプリの起動時間のベンチマーク
+
+毎回新しい Python プロセスで次を計測します (OS のファイルキャッシュが温まった状態の値)。
+
+    import     web_app の import にかかる時間と、その時点で読み込まれた重いモジュール
+    /status    import からテストクライアントで /status が 200 を返すまでの時間
+    最初の比較  小さなPDFの比較1回 (遅延読み込みされる cv2 の読み込みを含む)
+
+--gunicorn を付けると gunicorn.conf.py で実際にサーバーを起動し、/status に応答するまでの時間も
+計測します (Dockerfile の HEALTHCHECK --start-period の目安)。
+
+使用例:
+    python bench_startup.py
+    python bench_startup.py --repeat 10 --gunicorn
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HEAVY_MODULES = ("cv2", "fitz", "numpy", "gspread", "google.oauth2.id_token", "googleapiclient")
+
+# 子プロセスで実行する計測コード (結果を JSON で1行出力する)
+CHILD_CODE = """
+import json, sys, tempfile, time
+started = time.perf_counter()
+import web_app
+imported = time.perf_counter()
+client = web_app.app.test_client()
+assert client.get('/status').status_code == 200
+ready = time.perf_counter()
+result = {"import": imported - started, "status": ready - started,
+          "loaded": [m for m in %r if m in sys.modules]}
+if %r:
+    import fitz
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for variant in (0, 1):
+            doc = fitz.open()
+            page = doc.new_page(width=200, height=200)
+            page.insert_text((20, 40 + variant * 20), "rev", fontsize=12)
+            paths.append(f"{tmp}/{variant}.pdf")
+            doc.save(paths[-1])
+        diff_started = time.perf_counter()
+        web_app.PixelDiffDetector().create_pixel_diff_output(paths[0], paths[1], f"{tmp}/out")
+        result["first_diff"] = time.perf_counter() - diff_started
+print(json.dumps(result))
+"""
+
+
+def run_child(with_diff: bool) -> dict:
+    code = CHILD_CODE % (HEAVY_MODULES, with_diff)
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_gunicorn(timeout: float = 60.0) -> float:
+    """gunicorn を起動し、/status が 200 を返すまでの秒数を返す"""
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), WEB_WORKERS="1")
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "web_app:app"],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/status", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError(f"{timeout} 秒以内に /status が応答しませんでした")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def summarize(values) -> str:
+    return f"最速 {min(values) * 1000:.0f} ms / 平均 {sum(values) / len(values) * 1000:.0f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Web アプリの起動時間の計測")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--no-diff", action="store_true", help="最初の比較の計測を省略")
+    parser.add_argument("--gunicorn", action="store_true", help="gunicorn で起動して /status までの時間も計測")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    run_child(False)  # 1回目はバイトコードのコンパイルとファイルキャッシュを温めるため除外
+    results = [run_child(not args.no_diff) for _ in range(args.repeat)]
+
+    print(f"新しいプロセスで {args.repeat} 回計測")
+    print(f"  import web_app : {summarize([r['import'] for r in results])}")
+    print(f"  /status 応答   : {summarize([r['status'] for r in results])}")
+    if not args.no_diff:
+        print(f"  最初の比較     : {summarize([r['first_diff'] for r in results])}")
+    print(f"  import 時点で読み込み済みの重いモジュール: {', '.join(results[0]['loaded']) or 'なし'}")
+    if args.gunicorn:
+        timings = [time_gunicorn() for _ in range(args.repeat)]
+        print(f"  gunicorn 起動 → /status: {summarize(timings)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import numpy as np
+from typing import Dict, Tuple
+
+
+class BufferArena:
+    """用途ごとに確保したバッファをページ間で使い回すための置き場
+
+    各用途 (名前) につき1つの平坦なバッファを保持し、要求された形状がその容量に
+    収まる限り、先頭部分を reshape したビューを返す。容量が足りない場合だけ
+    大きく確保し直すため、同じ用紙サイズが続くジョブでは2ページ目以降の
+    大きな配列確保がなくなり、アロケータの断片化による RSS の増加を防げる。
+
+    返すビューは次に同じ名前で get() するまで有効。OpenCV には dst= 引数で渡す。
+    """
+
+    def __init__(self):
+        self._buffers: Dict[Tuple[str, str], np.ndarray] = {}
+        self.stats = {"allocated": 0, "reused": 0}
+
+    def get(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        key = (name, dtype.str)
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            self._buffers[key] = buffer
+            self.stats["allocated"] += 1
+        else:
+            self.stats["reused"] += 1
+        return buffer[:size].reshape(shape)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def clear(self):
+        """保持しているバッファをすべて解放する"""
+        self._buffers.clear()
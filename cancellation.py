@@ -0,0 +1,82 @@
+"""
+比較ジョブの協調的な中止 (キャンセル要求・制限時間)
+
+PixelDiffDetector はページの処理の合間や段階の区切りで token.check() を呼び、中止が要求されて
+いれば JobCancelledError を送出して途中の出力を削除します。
+
+    token = CancellationToken(timeout=600)        # 600 秒で打ち切り
+    threading.Thread(target=lambda: detector.create_pixel_diff_output(..., cancel_token=token)).start()
+    token.cancel()                                # 別スレッドから中止
+
+別プロセス (gunicorn の他のワーカーやキューのワーカー) から中止するには、ジョブフォルダの
+中止ファイルを使います (request_cancel(job_dir) で作成し、cancel_file に指定したトークンが検知)。
+キューのワーカーがリースを失ったときは reason="abandoned" で中止します。ジョブは別のワーカーが
+同じフォルダで続けているため、中止した側は出力に触れずに抜けます。
+"""
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+CANCEL_FILENAME = "cancel_requested"
+
+
+class JobCancelledError(Exception):
+    """ジョブが中止された (reason は "cancelled"・"deadline"・"abandoned" のいずれか)"""
+
+    def __init__(self, message: str, reason: str = "cancelled"):
+        super().__init__(message)
+        self.reason = reason
+
+
+class CancellationToken:
+    """中止要求と制限時間をまとめて確認するためのトークン (スレッドセーフ)"""
+
+    def __init__(self, timeout: float = None, cancel_file: str = None):
+        self._event = threading.Event()
+        self._message = None
+        self._reason = "cancelled"
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.cancel_file = Path(cancel_file) if cancel_file else None
+        self._watches: List[Tuple[Callable[[], bool], str, str]] = []
+
+    def cancel(self, message: str = "中止が要求されました", reason: str = "cancelled"):
+        self._message = message
+        self._reason = reason
+        self._event.set()
+
+    def watch(self, predicate: Callable[[], bool], message: str, reason: str = "cancelled"):
+        """predicate() が真を返したら中止とみなす (クライアントの切断検知など)"""
+        self._watches.append((predicate, message, reason))
+
+    @property
+    def remaining(self) -> Optional[float]:
+        """制限時間までの残り秒数 (制限なしなら None)"""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self.cancel_file is not None and self.cancel_file.exists():
+            self.cancel("中止が要求されました")
+            return True
+        for predicate, message, reason in self._watches:
+            if predicate():
+                self.cancel(message, reason)
+                return True
+        return False
+
+    def check(self):
+        """中止が要求されているか制限時間を過ぎていれば JobCancelledError を送出する"""
+        if self.cancelled:
+            raise JobCancelledError(self._message, self._reason)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise JobCancelledError("制限時間を超えたため中止しました", "deadline")
+
+
+def request_cancel(job_dir: str) -> Path:
+    """ジョブフォルダに中止ファイルを作る (cancel_file を監視しているトークンが次の確認で中止する)"""
+    path = Path(job_dir) / CANCEL_FILENAME
+    path.touch()
+    return path
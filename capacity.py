@@ -0,0 +1,191 @@
+"""
+Web コンテナの受け入れ余力 (/readyz とジョブの受け付け制御)
+
+JobSlots はコンテナ内で同時に実行する比較ジョブの枠です。枠ごとのファイルに flock をかけるため、
+gunicorn の複数のワーカープロセスで同じ枠を共有でき、ワーカーが強制終了されても枠は自動で解放されます。
+枠を確保したプロセスはファイルに自分の PID を書き、使用中の枠の数 (in_use) はロックを取らずにこの記録から数えます。
+
+    slots = JobSlots(2)
+    slot = slots.try_acquire()       # 空きがなければ None (HTTP 503 で断る)
+    try:
+        ...                          # 比較ジョブ
+    finally:
+        slot.release()
+
+memory_headroom() はコンテナのメモリ上限 (cgroup v2/v1) と使用量から、上限がなければ
+/proc/meminfo の MemAvailable から空きメモリを求めます。disk_headroom() は出力先の空き容量です。
+"""
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows (開発用の run_web.py): プロセス内だけで数える
+    fcntl = None
+
+DEFAULT_SLOT_DIR = os.path.join(tempfile.gettempdir(), "spotpdf_job_slots")
+# cgroup v1 で上限なしのときの値 (これ以上は上限なしとみなす)
+UNLIMITED_BYTES = 1 << 60
+
+
+class JobSlot:
+    """確保したジョブの枠 (release() で解放)"""
+
+    def __init__(self, slots: "JobSlots", index: int, fd: Optional[int]):
+        self.slots = slots
+        self.index = index
+        self._fd = fd
+
+    def release(self):
+        if self._fd is not None:
+            os.ftruncate(self._fd, 0)  # 使用者の記録を消してから閉じる
+            os.close(self._fd)  # flock はファイルを閉じると解放される
+            self._fd = None
+        elif self.index is not None:
+            with self.slots._lock:
+                self.slots._local.discard(self.index)
+        self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class JobSlots:
+    """プロセス間で共有する同時実行ジョブの枠"""
+
+    def __init__(self, capacity: int, directory: str = None):
+        self.capacity = max(1, int(capacity))
+        self.directory = Path(directory or DEFAULT_SLOT_DIR)
+        self._lock = threading.Lock()
+        self._local = set()
+        if fcntl is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, index: int) -> Path:
+        return self.directory / f"slot{index:02d}.lock"
+
+    def _open(self, index: int) -> int:
+        return os.open(self._path(index), os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _try_lock(self, index: int) -> Optional[int]:
+        fd = self._open(index)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def try_acquire(self) -> Optional[JobSlot]:
+        """空いている枠を確保する (空きがなければ None)"""
+        for index in range(self.capacity):
+            if fcntl is None:
+                with self._lock:
+                    if index not in self._local:
+                        self._local.add(index)
+                        return JobSlot(self, index, None)
+                continue
+            fd = self._try_lock(index)
+            if fd is not None:
+                os.ftruncate(fd, 0)
+                os.write(fd, str(os.getpid()).encode())
+                return JobSlot(self, index, fd)
+        return None
+
+    def in_use(self) -> int:
+        """使用中の枠の数
+
+        ロックを試して数えると、その間に別のリクエストの try_acquire が枠を取れずに断られるため、
+        確保したプロセスの記録 (PID) から数える。強制終了されたプロセスの記録は数えない。
+        """
+        if fcntl is None:
+            with self._lock:
+                return len(self._local)
+        busy = 0
+        for index in range(self.capacity):
+            try:
+                holder = self._path(index).read_text().strip()
+            except OSError:
+                continue
+            if holder.isdigit() and _process_alive(int(holder)):
+                busy += 1
+        return busy
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # 別のユーザーのプロセス
+    return True
+
+
+def _read_int(path: Path) -> Optional[int]:
+    try:
+        value = path.read_text().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def _read_stat(path: Path, key: str) -> int:
+    try:
+        for line in path.read_text().splitlines():
+            name, _, value = line.partition(" ")
+            if name == key:
+                return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _meminfo_available() -> Optional[int]:
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def memory_headroom(cgroup_root: str = "/sys/fs/cgroup") -> Dict:
+    """空きメモリ (バイト)。available はコンテナの上限までの残りとホストの MemAvailable の小さい方
+
+    回収できるページキャッシュ (inactive_file) は使用量に含めない。求められなければ available は None。
+    """
+    root = Path(cgroup_root)
+    limit = usage = None
+    if (root / "memory.max").exists():
+        limit = _read_int(root / "memory.max")  # "max" は上限なし
+        usage = _read_int(root / "memory.current")
+        if usage is not None:
+            usage -= _read_stat(root / "memory.stat", "inactive_file")
+    elif (root / "memory" / "memory.limit_in_bytes").exists():
+        limit = _read_int(root / "memory" / "memory.limit_in_bytes")
+        usage = _read_int(root / "memory" / "memory.usage_in_bytes")
+        if usage is not None:
+            usage -= _read_stat(root / "memory" / "memory.stat", "total_inactive_file")
+    if limit is not None and limit >= UNLIMITED_BYTES:
+        limit = None
+
+    candidates = [value for value in (_meminfo_available(),
+                                      limit - usage if limit is not None and usage is not None else None) if value is not None]
+    return {"available": max(0, min(candidates)) if candidates else None, "limit": limit}
+
+
+def disk_headroom(path: str) -> Dict:
+    """path のあるファイルシステムの空き容量 (バイト)"""
+    usage = shutil.disk_usage(path)
+    return {"free": usage.free, "total": usage.total}
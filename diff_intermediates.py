@@ -0,0 +1,104 @@
+"""
+再しきい値処理のための中間データ (ページごとの符号付き差分) の保存と読み込み
+
+差分検出の結果を感度や表示フィルタを変えて作り直すときに、PDFのレンダリングと
+位置合わせをやり直さずに済むよう、ページごとに次のファイルを残します。
+
+    intermediates/<prefix>_idx.npy   差分のあるピクセルの位置 (uint32, 平坦化したインデックス)
+    intermediates/<prefix>_val.npy   その位置の符号付き差分 new - old (int16)
+    intermediates/<prefix>_diff.npy  差分のあるピクセルが多いページでは密な int16 配列
+    intermediates/<prefix>_base.png  オーバーレイの下地 (新版の画像、可逆圧縮)
+    job.json                         ジョブの設定とページ構成のマニフェスト
+
+.npy は np.load(mmap_mode="r") でメモリマップして読み込めます。
+"""
+import json
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+
+from lazy_import import lazy_import
+from png_encoder import write_png
+
+cv2 = lazy_import("cv2")
+
+INTERMEDIATES_DIR = "intermediates"
+MANIFEST_FILENAME = "job.json"
+MANIFEST_VERSION = 1
+# 差分のあるピクセルがこの割合を超えたら、疎な形式 (6バイト/画素) より密な形式 (2バイト/画素) が小さい
+SPARSE_MAX_FRACTION = 1 / 3
+
+
+def save_signed_diff(job_dir: Path, prefix: str, old_gray: np.ndarray, new_gray: np.ndarray,
+                     base_image: np.ndarray, signed: np.ndarray, dpi: int) -> Dict:
+    """符号付き差分と下地画像を保存し、マニフェストに載せるレコードを返す
+
+    signed は old_gray と同じ形状の int16 作業用バッファ (内容は上書きされる)。
+    """
+    directory = Path(job_dir) / INTERMEDIATES_DIR
+    directory.mkdir(exist_ok=True)
+    np.subtract(new_gray, old_gray, out=signed, dtype=np.int16)
+    indices = np.flatnonzero(signed)
+    record = {"prefix": prefix, "shape": list(signed.shape), "dpi": dpi, "nonzero": int(indices.size)}
+    if indices.size == 0:
+        record["format"] = "empty"
+        return record
+    if indices.size > SPARSE_MAX_FRACTION * signed.size:
+        record["format"] = "dense"
+        np.save(directory / f"{prefix}_diff.npy", signed)
+    else:
+        record["format"] = "sparse"
+        np.save(directory / f"{prefix}_idx.npy", indices.astype(np.uint32))
+        np.save(directory / f"{prefix}_val.npy", signed.reshape(-1)[indices])
+    # 配列をそのまま書き出し、cv2.imread で同じ配列として読み戻す
+    write_png(directory / f"{prefix}_base.png", base_image)
+    return record
+
+
+def load_signed_diff(job_dir: Path, record: Dict, magnitude: np.ndarray, added: np.ndarray, removed: np.ndarray):
+    """保存済みの差分を |new - old| (uint8) と増減の符号 (bool) のバッファへ展開する"""
+    directory = Path(job_dir) / INTERMEDIATES_DIR
+    prefix = record["prefix"]
+    magnitude.fill(0); added.fill(False); removed.fill(False)
+    if record["format"] == "empty":
+        return
+    if record["format"] == "dense":
+        signed = np.load(directory / f"{prefix}_diff.npy", mmap_mode="r")
+        np.copyto(magnitude, np.abs(signed), casting="unsafe")
+        np.greater(signed, 0, out=added)
+        np.less(signed, 0, out=removed)
+        return
+    indices = np.load(directory / f"{prefix}_idx.npy", mmap_mode="r")
+    values = np.load(directory / f"{prefix}_val.npy", mmap_mode="r")
+    magnitude.reshape(-1)[indices] = np.abs(values)
+    added.reshape(-1)[indices] = values > 0
+    removed.reshape(-1)[indices] = values < 0
+
+
+def load_base_image(job_dir: Path, record: Dict) -> np.ndarray:
+    path = Path(job_dir) / INTERMEDIATES_DIR / f"{record['prefix']}_base.png"
+    image = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(f"中間データの下地画像がありません: {path}")
+    return image
+
+
+def write_manifest(job_dir: Path, manifest: Dict) -> Path:
+    path = Path(job_dir) / MANIFEST_FILENAME
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(dict(manifest, version=MANIFEST_VERSION), f, ensure_ascii=False, indent=2)
+    temp_path.replace(path)
+    return path
+
+
+def read_manifest(job_dir: Path) -> Dict:
+    path = Path(job_dir) / MANIFEST_FILENAME
+    if not path.exists():
+        raise FileNotFoundError(f"再計算用の中間データがありません: {path}")
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"対応していない中間データのバージョンです: {manifest.get('version')}")
+    return manifest
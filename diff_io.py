@@ -0,0 +1,93 @@
+"""
+差分検出の入力と出力先 (一時ファイルを経由しない比較用)
+
+PixelDiffDetector の比較メソッドは入力PDFをパスのほか、バイト列やファイルのようなオブジェクト
+(read() を持つもの。Flask の FileStorage など) でも受け取ります。出力 (差分画像・レイヤー画像・
+統合PDF) は sink に書き出します。
+
+    DirectorySink  フォルダに書き出す (既定。結果にはファイルのパスが入る)
+    MemorySink     メモリ上に保持する (結果にはファイル名が入り、内容は sink.files[ファイル名])
+
+    sink = MemorySink()
+    results = PixelDiffDetector().create_pixel_diff_output(old_bytes, new_bytes, sink=sink)
+    png = sink.files[results["diff_images"][0]]
+
+独自の出力先 (オブジェクトストレージなど) は write(name, data) で受け取ったデータを保存し、
+結果に入れる参照 (文字列) を返すクラスとして作れます。directory 属性が None の出力先では、
+チェックポイント・中間データ・プロファイルを使わない限り出力フォルダを作りません。
+"""
+import io
+import os
+from pathlib import Path
+from typing import BinaryIO, Dict, Union
+
+from lazy_import import lazy_import
+
+fitz = lazy_import("fitz")  # PyMuPDF
+
+# パス、PDFのバイト列、またはファイルのようなオブジェクト
+PdfSource = Union[str, Path, bytes, bytearray, memoryview, BinaryIO]
+
+
+def is_path(source: PdfSource) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+
+def input_name(source: PdfSource, default: str) -> str:
+    """入力のファイル名 (出力ファイル名の元になる)。名前のないバイト列は default"""
+    if is_path(source):
+        return Path(source).name
+    name = getattr(source, "filename", None) or getattr(source, "name", None)
+    return os.path.basename(name) if isinstance(name, str) and name else default
+
+
+def read_input(source: PdfSource) -> Union[str, Path, bytes]:
+    """ファイルのようなオブジェクトはバイト列に読み込む (パスとバイト列はそのまま)"""
+    if is_path(source):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source.read()
+
+
+def buffered_input(source: PdfSource, default: str) -> io.BytesIO:
+    """入力をメモリ上の名前付きバッファにする (リクエストの終了後や入力ファイルの削除後も何度でも読めるように)"""
+    buffer = io.BytesIO(Path(source).read_bytes() if is_path(source) else read_input(source))
+    buffer.name = input_name(source, default)
+    return buffer
+
+
+def open_pdf(source: PdfSource):
+    """PDF を開く (バイト列はディスクに書かずにメモリ上で開く)"""
+    source = read_input(source)
+    if isinstance(source, bytes):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+class DirectorySink:
+    """出力をフォルダに書き出す"""
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = self.directory / name
+        with open(path, "wb") as f:
+            f.write(data)
+        return str(path)
+
+
+class MemorySink:
+    """出力をメモリ上に保持する (ファイル名 → 内容)"""
+
+    directory = None
+
+    def __init__(self):
+        self.files: Dict[str, bytes] = {}
+
+    def write(self, name: str, data: bytes) -> str:
+        self.files[name] = bytes(data)
+        return name
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+
+def current_rss_bytes() -> int:
+    """現在の常駐メモリ量 (RSS) をバイトで返す。取得できない環境では 0"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, AttributeError):
+        return 0
+
+
+class _Span:
+    def __init__(self, profiler: "DiffProfiler", name: str, category: str, args: Dict):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> Dict:
+        self._rss = current_rss_bytes()
+        self._start = time.perf_counter()
+        return self.args
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        self.args["rss_delta_bytes"] = current_rss_bytes() - self._rss
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.profiler._add_complete_event(self.name, self.category, self._start, end, self.args)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self) -> Dict:
+        return {}
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullProfiler:
+    """プロファイル無効時に使う何もしないプロファイラ"""
+
+    enabled = False
+
+    def span(self, name: str, category: str = "diff", **args):
+        return _NULL_SPAN
+
+    def counter(self, name: str, **values):
+        pass
+
+
+class DiffProfiler:
+    """ページ・処理段階ごとのネストしたスパンを記録し、Chrome trace 形式で書き出す
+
+    出力した JSON は chrome://tracing や https://ui.perfetto.dev で開ける。
+    スパン内で `with profiler.span(...) as args:` の args に値を追加すると、
+    トレースのイベント引数 (画像サイズなど) として記録される。
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self.events: List[Dict] = [{
+            "name": "process_name", "ph": "M", "pid": self._pid, "tid": 0,
+            "args": {"name": "SpotPDF diff"},
+        }]
+
+    def span(self, name: str, category: str = "diff", **args) -> _Span:
+        return _Span(self, name, category, args)
+
+    def counter(self, name: str, **values):
+        event = {"name": name, "ph": "C", "ts": self._us(time.perf_counter()), "pid": self._pid, "tid": threading.get_ident(), "args": values}
+        with self._lock:
+            self.events.append(event)
+
+    def _us(self, t: float) -> float:
+        return round((t - self._origin) * 1e6, 1)
+
+    def _add_complete_event(self, name: str, category: str, start: float, end: float, args: Dict):
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": self._us(start), "dur": round((end - start) * 1e6, 1),
+            "pid": self._pid, "tid": threading.get_ident(), "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def write(self, path: Path) -> Path:
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+        return Path(path)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+SpotPDF 差分ワーカー
+
+共有ボリューム上のジョブキュー (job_queue.JobQueue) から比較ジョブを取り出して実行します。
+Web コンテナ (JOB_QUEUE_DB を設定した web_app) はジョブを登録するだけになり、
+ワーカーの数を増やすことで処理能力を拡張できます。
+
+使用例:
+    # 1台のマシンで Web とワーカー2つを動かす
+    export JOB_QUEUE_DB=data/jobs.sqlite3
+    gunicorn -c gunicorn.conf.py web_app:app &
+    python diff_worker.py &
+    python diff_worker.py &
+
+    # Docker Compose でワーカーを増やす
+    docker-compose up -d --scale spotpdf-worker=3
+
+処理中はリースを定期的に延長します。ワーカーが落ちるとリースが切れ、ジョブは別のワーカーが
+引き継ぎます (チェックポイントのある比較ジョブは完了済みのページを飛ばして続きから、それ以外は
+最初から)。SIGTERM / SIGINT を受けると実行中のジョブを終えてから終了します。
+Web から中止されたジョブ (出力フォルダの中止ファイル) はページの合間で止めて出力を削除し、
+ジョブごとの制限時間 (settings["deadline_sec"]) を超えたジョブは失敗として登録します。
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict
+
+from cancellation import CANCEL_FILENAME, CancellationToken, JobCancelledError
+from job_queue import DEFAULT_LEASE_SECONDS, Job, JobQueue, cleanup_inputs
+
+DEFAULT_QUEUE_DB = "data/jobs.sqlite3"
+
+logger = logging.getLogger("diff_worker")
+
+
+def run_job(job: Job, heartbeat: "Heartbeat" = None) -> Dict:
+    """ジョブを実行し、PixelDiffDetector の結果を返す
+
+    heartbeat を渡すと、リースを失った時点で (次のページの区切りで) 出力に触れずに中止する。
+    """
+    from pixel_diff_detector import PixelDiffDetector
+
+    payload = job.payload
+    output_dir = Path(payload["output_dir"])
+    if job.attempts > 1 and not (job.kind == "diff" and payload.get("settings", {}).get("checkpoint")):
+        # チェックポイントのないジョブは、前回の実行 (落ちたワーカー) の書きかけの出力を消してからやり直す
+        for child in output_dir.iterdir():
+            if child.is_dir():
+                shutil.rmtree(child)
+    detector = PixelDiffDetector()
+    # Web からの中止要求はジョブフォルダの中止ファイルで受け取る (別のコンテナからでも届く)
+    token = CancellationToken(timeout=payload.get("settings", {}).get("deadline_sec"),
+                              cancel_file=str(output_dir / CANCEL_FILENAME))
+    if heartbeat is not None:
+        # 別のワーカーが同じ出力フォルダでジョブをやり直すため、ここで止める
+        token.watch(lambda: heartbeat.lost, "リースが別のワーカーに移りました", "abandoned")
+    if job.kind == "diff" and payload.get("settings", {}).get("progressive"):
+        from progressive_diff import ProgressiveDiff
+        return ProgressiveDiff(str(output_dir), payload["settings"]).run(payload["old_path"], payload["new_path"], token)
+    if job.kind == "diff":
+        return detector.create_pixel_diff_output(payload["old_path"], payload["new_path"], str(output_dir),
+                                                 settings=payload.get("settings"), cancel_token=token)
+    if job.kind == "chain":
+        return detector.create_revision_chain_output(payload["paths"], str(output_dir), settings=payload.get("settings"),
+                                                     cancel_token=token)
+    raise ValueError(f"未対応のジョブの種類です: {job.kind}")
+
+
+class Heartbeat:
+    """ジョブの実行中、別スレッドでリースを延長し続ける"""
+
+    def __init__(self, queue: JobQueue, job: Job, worker_id: str, lease_seconds: float):
+        self.queue, self.job, self.worker_id, self.lease_seconds = queue, job, worker_id, lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job.id}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if not self.queue.heartbeat(self.job.id, self.worker_id, self.lease_seconds):
+                    self.lost = True
+                    logger.warning(f"ジョブ {self.job.id} のリースが別のワーカーに移りました")
+                    return
+            except Exception as e:  # データベースの一時的なロックなど。次の周期で再試行する
+                logger.warning(f"ジョブ {self.job.id} のリース延長に失敗: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def process(queue: JobQueue, job: Job, worker_id: str, lease_seconds: float):
+    logger.info(f"ジョブ {job.id} ({job.kind}, {job.attempts} 回目) を開始")
+    started = time.perf_counter()
+    with Heartbeat(queue, job, worker_id, lease_seconds) as heartbeat:
+        try:
+            results = run_job(job, heartbeat)
+        except JobCancelledError as e:
+            logger.info(f"ジョブ {job.id} を中止しました: {e}")
+            if e.reason == "abandoned":
+                return  # 状態の登録と入力の削除は引き継いだワーカーが行う
+            if e.reason == "deadline":
+                finished = queue.fail(job.id, worker_id, str(e))
+            else:
+                finished = queue.cancelled(job.id, worker_id, str(e))
+            if finished:
+                cleanup_inputs(job)
+            return
+        except Exception as e:
+            logger.error(f"ジョブ {job.id} が失敗しました: {e}")
+            if queue.fail(job.id, worker_id, str(e)):
+                cleanup_inputs(job)
+            return
+    if heartbeat.lost or not queue.complete(job.id, worker_id, results):
+        logger.warning(f"ジョブ {job.id} はリースを失ったため結果を登録しませんでした")
+        return
+    cleanup_inputs(job)
+    logger.info(f"ジョブ {job.id} が完了 ({time.perf_counter() - started:.1f} 秒, 変更 {results.get('total_changes', 0)})")
+
+
+def work(queue: JobQueue, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+         poll_interval: float = 1.0, max_jobs: int = 0, stop: threading.Event = None) -> int:
+    """stop が設定されるか max_jobs 件 (0 は無制限) を処理するまでジョブを処理し、処理件数を返す"""
+    stop = stop or threading.Event()
+    processed = 0
+    while not stop.is_set() and (not max_jobs or processed < max_jobs):
+        job = queue.claim(worker_id, lease_seconds)
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+        process(queue, job, worker_id, lease_seconds)
+        processed += 1
+    return processed
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="SpotPDF 差分ワーカー (ジョブキューから比較ジョブを処理)")
+    parser.add_argument("--db", default=os.getenv("JOB_QUEUE_DB") or DEFAULT_QUEUE_DB,
+                        help=f"ジョブキューの SQLite ファイル (既定: $JOB_QUEUE_DB または {DEFAULT_QUEUE_DB})")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}:{os.getpid()}", help="ワーカーの識別名")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS,
+                        help="リースの秒数 (この間ハートビートがなければ他のワーカーに再割り当て)")
+    parser.add_argument("--poll", type=float, default=1.0, help="キューが空のときの確認間隔 (秒)")
+    parser.add_argument("--max-jobs", type=int, default=int(os.getenv("WORKER_MAX_JOBS", "0")),
+                        help="この件数を処理したら終了する (0 は無制限。再起動でメモリを解放する場合に)")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    queue = JobQueue(args.db)
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("終了要求を受け付けました (実行中のジョブを終えてから終了します)")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logger.info(f"ワーカー {args.worker_id} を開始 (キュー: {args.db})")
+    processed = work(queue, args.worker_id, args.lease, args.poll, args.max_jobs, stop)
+    logger.info(f"ワーカー {args.worker_id} を終了 ({processed} 件処理)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
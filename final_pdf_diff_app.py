@@ -8,6 +8,7 @@ import json
 from pathlib import Path
 from PIL import Image, ImageTk
 from pixel_diff_detector import PixelDiffDetector
+from cancellation import CancellationToken, JobCancelledError
 
 # --- 追加されたインポート --- #
 from datetime import datetime, date
@@ -50,7 +51,7 @@ def load_config():
         # ServiceAccountKeyPath はこのスクリプトからの相対パスで解決
         config["ServiceAccountKeyPath"] = Path(getattr(sys, '_MEIPASS', Path(__file__).parent)) / config["ServiceAccountKeyPath"]
         if not config["ServiceAccountKeyPath"].exists():
-            messagebox.showerror("設定エラー", f"サービスアカウントキーファイルが見つかりません: {config["ServiceAccountKeyPath"]}")
+            messagebox.showerror("設定エラー", f"サービスアカウントキーファイルが見つかりません: {config['ServiceAccountKeyPath']}")
             return None
 
         return config
@@ -247,10 +248,24 @@ class PDFDiffApp(tk.Tk):
         self.export_all_patterns = tk.BooleanVar(value=False)
         ttk.Label(settings_frame, text="出力オプション:").grid(row=3, column=0, sticky=tk.W, padx=(0,10), pady=5)
         ttk.Checkbutton(settings_frame, text="全パターンを個別に出力する (both, added, removed)", variable=self.export_all_patterns).grid(row=3, column=1, sticky=tk.W, padx=5)
+        self.page_matching = tk.BooleanVar(value=False)
+        ttk.Checkbutton(settings_frame, text="ページを内容で対応付ける (挿入・削除・並び替えに対応)", variable=self.page_matching).grid(row=4, column=1, sticky=tk.W, padx=5)
+        self.vector_prediff = tk.BooleanVar(value=False)
+        ttk.Checkbutton(settings_frame, text="ベクター事前比較 (CAD図面向け・変更領域のみ高解像度比較)", variable=self.vector_prediff).grid(row=5, column=1, sticky=tk.W, padx=5)
+        self.vector_summary = tk.BooleanVar(value=True)
+        ttk.Checkbutton(settings_frame, text="統合PDFを軽量化 (元のページに変更箇所をレイヤーで重ねる)", variable=self.vector_summary).grid(row=6, column=1, sticky=tk.W, padx=5)
 
         self.run_button = ttk.Button(main_frame, text="差分検出実行", command=self.run_diff_check, style='Accent.TButton')
-        self.run_button.pack(pady=15, ipady=5)
+        self.run_button.pack(pady=(15, 5), ipady=5)
         style.configure('Accent.TButton', font=('Yu Gothic UI', 12, 'bold'))
+        # 実行中の比較を次のページの区切りで止める (途中の出力は削除される)
+        self.cancel_token = None
+        self.cancel_button = ttk.Button(main_frame, text="中止", command=self.cancel_diff_check, state="disabled")
+        self.cancel_button.pack(pady=(0, 5))
+        # 直前の結果を、レンダリングし直さずに感度・表示する差分だけ変えて出力し直す
+        self.last_job_dir = None
+        self.rethreshold_button = ttk.Button(main_frame, text="感度・表示のみ変更して再出力", command=self.run_rethreshold, state="disabled")
+        self.rethreshold_button.pack(pady=(0, 10))
 
         output_frame = ttk.Frame(main_frame)
         output_frame.pack(fill=tk.X, pady=5)
@@ -281,6 +296,9 @@ class PDFDiffApp(tk.Tk):
                     self.show_removed.set(config.get("show_removed", True))
                     self.sensitivity.set(config.get("sensitivity", 10))
                     self.export_all_patterns.set(config.get("export_all_patterns", False))
+                    self.page_matching.set(config.get("page_matching", False))
+                    self.vector_prediff.set(config.get("vector_prediff", False))
+                    self.vector_summary.set(config.get("vector_summary", True))
                     self.sensitivity_val_label.config(text=str(self.sensitivity.get()))
         except Exception as e: print(f"設定ファイルの読み込みに失敗: {e}")
 
@@ -291,7 +309,10 @@ class PDFDiffApp(tk.Tk):
                 "old_pdf_path": self.old_pdf_path.get(), "new_pdf_path": self.new_pdf_path.get(),
                 "output_dir": self.output_dir.get(), "show_added": self.show_added.get(),
                 "show_removed": self.show_removed.get(), "sensitivity": self.sensitivity.get(),
-                "export_all_patterns": self.export_all_patterns.get()
+                "export_all_patterns": self.export_all_patterns.get(),
+                "page_matching": self.page_matching.get(),
+                "vector_prediff": self.vector_prediff.get(),
+                "vector_summary": self.vector_summary.get()
             }
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, indent=4)
@@ -329,27 +350,68 @@ class PDFDiffApp(tk.Tk):
         settings = {
             "sensitivity": self.sensitivity.get(),
             "display_filter": {"added": self.show_added.get(), "removed": self.show_removed.get()},
-            "export_all_patterns": self.export_all_patterns.get()
+            "export_all_patterns": self.export_all_patterns.get(),
+            "page_matching": self.page_matching.get(),
+            "vector_prediff": self.vector_prediff.get(),
+            "summary_mode": "layered" if self.vector_summary.get() else "raster",
+            "save_intermediates": True
         }
 
-        self.run_button.config(state="disabled"); self.log_text.config(state="normal"); self.log_text.delete('1.0', tk.END); self.log_text.config(state="disabled")
+        self.run_button.config(state="disabled"); self.rethreshold_button.config(state="disabled"); self.log_text.config(state="normal"); self.log_text.delete('1.0', tk.END); self.log_text.config(state="disabled")
+        self.cancel_token = CancellationToken(); self.cancel_button.config(state="normal")
         threading.Thread(target=self.run_backend_process, args=(old_pdf, new_pdf, output_dir, settings), daemon=True).start()
 
+    def cancel_diff_check(self):
+        if self.cancel_token:
+            self.cancel_token.cancel("ユーザーが中止しました")
+            self.cancel_button.config(state="disabled")
+            self.log("中止しています... (現在のページの処理が終わると止まります)")
+
     def run_backend_process(self, old_pdf, new_pdf, output_dir, settings):
         try:
             detector = PixelDiffDetector()
-            results = detector.create_pixel_diff_output(old_pdf_path=old_pdf, new_pdf_path=new_pdf, output_dir=output_dir, progress_callback=self.log, settings=settings)
+            results = detector.create_pixel_diff_output(old_pdf_path=old_pdf, new_pdf_path=new_pdf, output_dir=output_dir, progress_callback=self.log, settings=settings, cancel_token=self.cancel_token)
             final_output_path = results.get("output_path", output_dir)
+            self.last_job_dir = final_output_path
             self.log("✓✓✓ 処理が正常に完了しました。✓✓✓")
             message = f"処理が完了しました。\n出力先: {final_output_path}"
             self.after(0, lambda: messagebox.showinfo("完了", message))
             self.after(0, self.open_output_folder, final_output_path)
+        except JobCancelledError:
+            self.log("処理を中止しました。途中の出力は削除しました。")
         except Exception as e:
             self.log(f"エラーが発生しました: {e}")
             message = f"処理中にエラーが発生しました。\n詳細はログを確認してください。\n\n{e}"
             self.after(0, lambda: messagebox.showerror("エラー", message))
         finally:
-            self.after(0, lambda: self.run_button.config(state="normal"))
+            self.cancel_token = None
+            self.after(0, self.enable_buttons)
+
+    def enable_buttons(self):
+        self.run_button.config(state="normal"); self.cancel_button.config(state="disabled")
+        self.rethreshold_button.config(state="normal" if self.last_job_dir else "disabled")
+
+    def run_rethreshold(self):
+        if not self.last_job_dir: return
+        settings = {
+            "sensitivity": self.sensitivity.get(),
+            "display_filter": {"added": self.show_added.get(), "removed": self.show_removed.get()},
+            "export_all_patterns": self.export_all_patterns.get()
+        }
+        self.run_button.config(state="disabled"); self.rethreshold_button.config(state="disabled")
+        threading.Thread(target=self.run_rethreshold_process, args=(self.last_job_dir, settings), daemon=True).start()
+
+    def run_rethreshold_process(self, job_dir, settings):
+        try:
+            results = PixelDiffDetector().rethreshold_output(job_dir, progress_callback=self.log, settings=settings)
+            self.log(f"✓ 再出力が完了しました ({results['total_changes']} ピクセルの変更)")
+            self.after(0, self.open_output_folder, job_dir)
+        except Exception as e:
+            self.log(f"エラーが発生しました: {e}")
+            message = f"再出力中にエラーが発生しました。\n\n{e}"
+            self.after(0, lambda: messagebox.showerror("エラー", message))
+        finally:
+            self.after(0, self.enable_buttons)
 
 if __name__ == "__main__":
     # --- 認証ロジックの追加 --- #
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Google ID トークンの検証 (署名用証明書をキャッシュし、接続を使い回す)
+
+google.oauth2.id_token.verify_oauth2_token はログインのたびに新しい接続で Google の証明書を
+取得します。GoogleTokenVerifier は証明書を HTTP の Cache-Control (max-age と Age、なければ
+Expires) に従ってプロセス内にキャッシュし、取得には接続プールを持つ requests.Session を
+スレッド間で共有します。
+
+    verifier = GoogleTokenVerifier()
+    idinfo = verifier.verify(token, client_id)   # 不正なトークンは ValueError
+
+- 同時に期限切れを検知したスレッドのうち1つだけが取得し、他はその結果を使う
+- トークンの kid がキャッシュにないとき (鍵の入れ替え直後) は期限内でも取り直す (間隔は最短 KID_REFRESH_INTERVAL 秒)
+- 取得に失敗 (プロキシの停止・タイムアウトなど) しても、期限切れから MAX_STALE_SECONDS 秒以内なら
+  古い証明書で検証を続ける。次の取得は FETCH_RETRY_INTERVAL 秒後で、それまでと、他のスレッドが
+  取得している間は待たずに古い証明書を返す (証明書サーバーが応答しなくてもログインが詰まらない)
+
+証明書の URL は環境変数 GOOGLE_CERTS_URL で差し替えられます。
+FakeGoogleIdentity はローカルの証明書サーバーと署名鍵を持つ偽の ID プロバイダーです
+(負荷試験 loadtest.py と `python google_token_verifier.py` の動作確認で使い、ネットワーク不要)。
+"""
+import email.utils
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Mapping, Optional
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+FETCH_TIMEOUT = (3.05, 10)         # (接続, 読み取り) 秒
+DEFAULT_MAX_AGE = 300              # キャッシュ指定がない応答を使い続ける秒数
+KID_REFRESH_INTERVAL = 60
+FETCH_RETRY_INTERVAL = 30          # 取得に失敗してから次に試すまでの秒数 (その間は古い証明書を使う)
+MAX_STALE_SECONDS = 24 * 3600
+CLOCK_SKEW_SECONDS = 10
+
+logger = logging.getLogger(__name__)
+
+
+def cache_lifetime(headers: Mapping[str, str], now: float = None) -> float:
+    """応答ヘッダーからキャッシュしてよい秒数を求める"""
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0.0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if match:
+        age = headers.get("Age", "0")
+        return max(0.0, int(match.group(1)) - (int(age) if age.isdigit() else 0))
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            expires_at = email.utils.parsedate_to_datetime(expires).timestamp()
+            date = headers.get("Date")
+            base = email.utils.parsedate_to_datetime(date).timestamp() if date else (now or time.time())
+            return max(0.0, expires_at - base)
+        except (TypeError, ValueError):
+            return 0.0
+    return float(DEFAULT_MAX_AGE)
+
+
+class GoogleTokenVerifier:
+    """Google の署名用証明書をキャッシュして ID トークンを検証する (スレッドセーフ)"""
+
+    def __init__(self, certs_url: str = None, session=None, pool_size: int = 10, timeout=FETCH_TIMEOUT):
+        self.certs_url = certs_url or os.getenv("GOOGLE_CERTS_URL") or GOOGLE_CERTS_URL
+        self.timeout = timeout
+        self._session = session
+        self._pool_size = pool_size
+        self._lock = threading.Lock()
+        self._certs: Optional[Dict[str, str]] = None
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._retry_at = 0.0
+        self.fetch_count = 0
+
+    @property
+    def session(self):
+        if self._session is None:
+            # Google 認証ライブラリと同じく requests は最初に使うときに読み込む
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    def _fetch(self) -> Dict[str, str]:
+        response = self.session.get(self.certs_url, timeout=self.timeout)
+        response.raise_for_status()
+        certs = response.json()
+        now = time.monotonic()
+        self._certs = certs
+        self._fetched_at = now
+        self._expires_at = now + cache_lifetime(response.headers)
+        self._retry_at = 0.0
+        self.fetch_count += 1
+        logger.info(f"Google の証明書を取得しました ({len(certs)} 件, {self._expires_at - now:.0f} 秒有効)")
+        return certs
+
+    def _cached(self, kid: Optional[str], now: float) -> Optional[Dict[str, str]]:
+        """取り直さずに使える証明書 (なければ None)"""
+        certs = self._certs
+        if certs is None:
+            return None
+        if now < self._retry_at:
+            return certs  # 取得に失敗した直後: 再試行の時刻までは古い証明書を使う
+        if now < self._expires_at and (kid is None or kid in certs or now - self._fetched_at < KID_REFRESH_INTERVAL):
+            return certs
+        return None
+
+    def certificates(self, kid: str = None) -> Dict[str, str]:
+        """有効な証明書 (kid → PEM) を返す。期限切れか kid が見つからなければ取り直す"""
+        certs = self._cached(kid, time.monotonic())
+        if certs is not None:
+            return certs
+        certs = self._certs
+        usable = certs is not None and time.monotonic() - self._expires_at < MAX_STALE_SECONDS and (kid is None or kid in certs)
+        # 他のスレッドが取得中なら、使える古い証明書があれば待たずに返す
+        if not self._lock.acquire(blocking=not usable):
+            return certs
+        try:
+            # ロック待ちの間に他のスレッドが取り直していればそれを使う
+            now = time.monotonic()
+            cached = self._cached(kid, now)
+            if cached is not None:
+                return cached
+            certs = self._certs
+            try:
+                return self._fetch()
+            except Exception as e:
+                if certs is not None and now - self._expires_at < MAX_STALE_SECONDS:
+                    self._retry_at = time.monotonic() + FETCH_RETRY_INTERVAL
+                    logger.warning(f"Google の証明書の取得に失敗したため、キャッシュ済みの証明書を使います"
+                                   f" ({FETCH_RETRY_INTERVAL} 秒後に再試行): {e}")
+                    return certs
+                raise
+        finally:
+            self._lock.release()
+
+    def verify(self, token, audience: str = None, clock_skew_in_seconds: int = CLOCK_SKEW_SECONDS) -> Dict:
+        """ID トークンの署名・有効期限・audience・発行者を検証し、内容を返す (不正なら ValueError)"""
+        from google.auth import jwt
+
+        try:
+            header = jwt.decode_header(token)
+        except Exception as e:
+            raise ValueError(f"Could not parse token header: {e}")
+        certs = self.certificates(header.get("kid"))
+        idinfo = jwt.decode(token, certs=certs, audience=audience, clock_skew_in_seconds=clock_skew_in_seconds)
+        if idinfo.get("iss") not in GOOGLE_ISSUERS:
+            raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+        return idinfo
+
+
+_default_verifier = None
+_default_lock = threading.Lock()
+
+
+def default_verifier() -> GoogleTokenVerifier:
+    """プロセス内で共有する検証器 (gunicorn のワーカーごとに1つ)"""
+    global _default_verifier
+    if _default_verifier is None:
+        with _default_lock:
+            if _default_verifier is None:
+                _default_verifier = GoogleTokenVerifier()
+    return _default_verifier
+
+
+class FakeGoogleIdentity:
+    """検証・負荷試験用のローカルの ID プロバイダー (ネットワーク不要)
+
+    自己署名の証明書を 127.0.0.1 の HTTP サーバーで配布し、同じ鍵で Google 形式の ID トークンに
+    署名します。検証する側の GOOGLE_CERTS_URL に certs_url を設定して使います。
+
+        with FakeGoogleIdentity() as identity:
+            os.environ["GOOGLE_CERTS_URL"] = identity.certs_url
+            token = identity.token("user@example.com", audience=client_id)
+    """
+
+    def __init__(self, max_age: int = 3600, kid: str = "fake-kid"):
+        import datetime
+
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+        from google.auth import crypt
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "spotpdf-fake-google")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1))
+                .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256()))
+        pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        self.signer = crypt.RSASigner.from_string(pem.decode(), key_id=kid)
+        self.certs_body = json.dumps({kid: cert.public_bytes(serialization.Encoding.PEM).decode()}).encode()
+        self.max_age = max_age
+        self.requests_served = 0
+        self._server = None
+
+    def start(self) -> "FakeGoogleIdentity":
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        identity = self
+
+        class CertHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                identity.requests_served += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", f"public, max-age={identity.max_age}")
+                self.send_header("Content-Length", str(len(identity.certs_body)))
+                self.end_headers()
+                self.wfile.write(identity.certs_body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), CertHandler)
+        threading.Thread(target=self._server.serve_forever, name="fake-google-certs", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    @property
+    def certs_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/certs"
+
+    def token(self, email: str, audience: str, lifetime: int = 3600, **claims) -> str:
+        from google.auth import jwt
+
+        issued = int(time.time())
+        payload = {"iss": "https://accounts.google.com", "aud": audience, "sub": email, "email": email,
+                   "email_verified": True, "name": email.split("@")[0], "iat": issued, "exp": issued + lifetime}
+        payload.update(claims)
+        return jwt.encode(self.signer, payload).decode()
+
+
+def _self_test():
+    """ローカルの証明書サーバーと自分で署名したトークンで動作を確認する (ネットワーク不要)"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    identity = FakeGoogleIdentity(max_age=2).start()
+    verifier = GoogleTokenVerifier(certs_url=identity.certs_url)
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(8) as pool:
+            emails = list(pool.map(lambda _: verifier.verify(identity.token("user@example.com", "client-id"),
+                                                             "client-id")["email"], range(200)))
+        elapsed = time.perf_counter() - started
+        assert emails == ["user@example.com"] * 200
+        print(f"200 件を 8 スレッドで検証: {elapsed * 1000:.0f} ms, 証明書の取得 {identity.requests_served} 回")
+        assert identity.requests_served == 1
+
+        for label, token, audience in (("audience 違い", identity.token("user@example.com", "client-id"), "other-client"),
+                                       ("発行者違い", identity.token("user@example.com", "client-id",
+                                                                iss="https://evil.example.com"), "client-id"),
+                                       ("期限切れ", identity.token("user@example.com", "client-id", iat=1, exp=2), "client-id")):
+            try:
+                verifier.verify(token, audience)
+            except ValueError:
+                print(f"{label}: 拒否")
+            else:
+                raise AssertionError(f"{label} のトークンが通りました")
+
+        time.sleep(2.1)
+        verifier.verify(identity.token("user@example.com", "client-id"), "client-id")
+        print(f"max-age 経過後: 証明書の取得 {identity.requests_served} 回")
+        assert identity.requests_served == 2
+
+        identity.stop()
+        verifier._expires_at = 0.0
+        verifier.verify(identity.token("user@example.com", "client-id"), "client-id")
+        print("証明書サーバー停止後: キャッシュ済みの証明書で検証")
+    finally:
+        identity.stop()
+    print("OK")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    _self_test()
@@ -0,0 +1,104 @@
+"""
+Gunicorn configuration for running SpotPDF in production.
+
+    gunicorn -c gunicorn.conf.py web_app:app
+
+Diff requests are CPU-bound and hold the GIL for long stretches, so concurrency comes
+from preforked worker processes; threads only keep cheap requests (status, static files,
+downloads) responsive while a worker is busy with a comparison. All values can be
+overridden with environment variables (WEB_WORKERS, WEB_THREADS, WEB_TIMEOUT, ...).
+"""
+import logging
+import os
+import random
+
+from lazy_import import preload_modules
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_WORKERS", "2"))
+threads = int(os.getenv("WEB_THREADS", "2"))
+worker_class = "gthread"
+
+# A large drawing set can take several minutes; keep this in line with nginx proxy_read_timeout
+timeout = int(os.getenv("WEB_TIMEOUT", "600"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", str(timeout)))
+keepalive = 5
+
+# Import web_app once in the master. This gives every worker the same app.secret_key
+# when SECRET_KEY is not set, so sessions survive across workers. cv2 and fitz are
+# imported lazily by the app, so on_starting loads them explicitly before forking.
+preload_app = True
+
+# Recycle a worker after this many diff jobs to return memory fragmented by large NumPy
+# arrays to the OS. The jitter keeps all workers from restarting at the same time.
+# 0 disables recycling.
+max_jobs_per_worker = int(os.getenv("WEB_MAX_JOBS_PER_WORKER", "20"))
+max_jobs_jitter = int(os.getenv("WEB_MAX_JOBS_JITTER", "5"))
+
+# Requests that run a comparison and count towards max_jobs_per_worker
+JOB_PATHS = ("/upload", "/upload/chain")
+JOB_PATH_SUFFIXES = ("/rethreshold",)
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("WEB_LOG_LEVEL", "info")
+
+
+def on_starting(server):
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    )
+    for directory in ('uploads', 'static/outputs', 'logs'):
+        os.makedirs(directory, exist_ok=True)
+    # Workers fork with OpenCV and PyMuPDF already imported (shared copy-on-write pages)
+    preload_modules()
+
+
+def post_fork(server, worker):
+    worker.job_count = 0
+    worker.max_jobs = max_jobs_per_worker + random.randint(0, max_jobs_jitter) if max_jobs_per_worker > 0 else 0
+
+
+def post_worker_init(worker):
+    """Run a tiny comparison so the first real request doesn't pay for lazy initialisation.
+
+    This runs in each worker after the fork (not in the master) so that OpenCV's and
+    MuPDF's thread pools and caches are created in the process that uses them.
+    """
+    try:
+        warm_up()
+        worker.log.info("Worker %s warmed up", worker.pid)
+    except Exception as e:
+        worker.log.warning("Worker %s warm-up failed: %s", worker.pid, e)
+
+
+def warm_up():
+    import fitz  # PyMuPDF
+    from pixel_diff_detector import PixelDiffDetector
+
+    doc = fitz.open()
+    page = doc.new_page(width=72, height=72)
+    page.draw_rect(fitz.Rect(10, 10, 40, 40), color=(0, 0, 0))
+    detector = PixelDiffDetector()
+    image = detector._get_high_res_page(doc, 0, dpi=72)
+    changed = image.copy()
+    changed[20:30, 20:30] = 0
+    diff_data = detector._detect_pixel_differences(image, changed, 10)
+    detector._create_precise_diff_display(diff_data, {"added": True, "removed": True})
+    doc.close()
+
+
+def is_job_request(req) -> bool:
+    path = req.path.split("?", 1)[0]
+    return req.method == "POST" and (path in JOB_PATHS or path.endswith(JOB_PATH_SUFFIXES))
+
+
+def post_request(worker, req, environ, resp):
+    if not getattr(worker, "max_jobs", 0) or not is_job_request(req):
+        return
+    worker.job_count += 1
+    if worker.job_count >= worker.max_jobs and worker.alive:
+        worker.log.info("Worker %s handled %s jobs; restarting to release memory", worker.pid, worker.job_count)
+        # Finish in-flight requests, then exit; the arbiter starts a fresh worker
+        worker.alive = False
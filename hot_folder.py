@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+SpotPDF ホットフォルダ監視
+
+文書管理の共有フォルダを監視し、既存のファイルの新しいリビジョンが置かれたら、
+1つ前のリビジョンとの比較 (PixelDiffDetector) を自動で実行します。
+
+使用例:
+    # \\\\server\\drawings (マウント先 /mnt/drawings) を監視し、結果を /mnt/drawings_diff に出力
+    python hot_folder.py /mnt/drawings
+
+    # 命名規則を指定 (base と rev のグループを持つ正規表現、拡張子を除いたファイル名に一致させる)
+    python hot_folder.py /mnt/drawings --pattern "^(?P<base>.+)_(?P<rev>\\d+)$"
+
+    # 1回だけ走査し、書き込み中のファイルが落ち着いてから比較を終えたら終了 (cron 向け)
+    python hot_folder.py /mnt/drawings --once
+
+リビジョンの判定 (既定の命名規則 DEFAULT_PATTERN):
+    A-101_rev3.pdf / A-101 Rev.B.pdf / A-101-r2.pdf / A-101_v4.pdf / A-101 第2版.pdf
+    同じフォルダで base (大文字小文字を区別しない) が同じファイルを同じ図面の版とみなします。
+    版は英字 (A, B, ... Z, AA) が数字より前、番号のないファイル (A-101.pdf) が最初の版です。
+
+- 共有フォルダでは inotify などの変更通知が届かないことが多いため、一定間隔で走査します
+- コピー中のファイルは、サイズと更新時刻が --settle 秒以上変わらず、末尾に %%EOF があるまで待ちます
+  (コピーツールは元の更新時刻を引き継ぐことがあるため、更新時刻の古さでは判定しません)
+- 処理済みのファイル (パス・サイズ・更新時刻) は出力フォルダの hot_folder_index.json に記録し、
+  再起動しても比較し直しません。比較の途中で止まったファイルは再起動後に続きから処理します
+  (ページごとのチェックポイント)。同じ名前のファイルが上書きされた場合は新しい版として比較し直します
+- 初回起動時に既にあるファイルは記録だけして比較しません (--initial-scan diff で比較)。書き込み中の
+  ファイルは落ち着いたものから順に記録し、落ち着かないファイルがあっても他のファイルの処理は止めません
+- 落ち着いても末尾に %%EOF のないファイル (壊れたファイルなど) は警告して待ち続けます。--once は
+  そのファイルを残して終了し、次の実行で確認し直します
+- 結果は監視フォルダと同じ階層の <監視フォルダ名>_diff/ (--output で変更可) に、監視フォルダと
+  同じサブフォルダ構成で <新版のファイル名>/ として出力し、各比較の結果を summary.jsonl に追記します
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from batch_diff import SUMMARY_FILENAME, run_pair
+
+INDEX_FILENAME = "hot_folder_index.json"
+INDEX_VERSION = 1
+# 区切り + rev/ver/r/v + 番号、区切り + rev/ver + 英字 (River.pdf などを版と誤認しないよう英字は rev/ver のみ)、第N版
+DEFAULT_PATTERN = (r"^(?P<base>.+?)(?:[\s_\-.]+(?:rev|ver|r|v)\.?\s*(?P<rev>\d+)"
+                   r"|[\s_\-.]+(?:rev|ver)\.?\s*(?P<rev_letter>[A-Za-z]{1,2})"
+                   r"|\s*第\s*(?P<rev_ja>\d+)\s*版)$")
+EOF_SEARCH_BYTES = 2048
+
+logger = logging.getLogger("hot_folder")
+
+
+class RevisionRule:
+    """ファイル名から (図面のキー, 版の並び順, 版の表記) を求める命名規則"""
+
+    def __init__(self, pattern: str = DEFAULT_PATTERN):
+        self.regex = re.compile(pattern, re.IGNORECASE)
+        if "base" not in self.regex.groupindex:
+            raise ValueError("命名規則の正規表現には base のグループが必要です")
+
+    def parse(self, relative_path: str) -> Tuple[str, Tuple, str]:
+        path = Path(relative_path)
+        match = self.regex.match(path.stem)
+        if match is None:
+            # 版の番号がないファイルはその図面の最初の版とみなす
+            return self._family(path.parent, path.stem), (0,), ""
+        groups = match.groupdict()
+        label = next((groups[name] for name in ("rev", "rev_letter", "rev_ja") if groups.get(name)), "") or ""
+        return self._family(path.parent, groups["base"]), self.revision_key(label), label
+
+    @staticmethod
+    def _family(parent: Path, base: str) -> str:
+        return f"{parent.as_posix()}/{base.strip(' _-.').lower()}"
+
+    @staticmethod
+    def revision_key(label: str) -> Tuple:
+        """版の並び順: 番号なし < 英字 (A < B < ... < Z < AA) < 数字"""
+        if not label:
+            return (0,)
+        if label.isdigit():
+            return (2, int(label))
+        return (1, len(label), label.upper())
+
+
+def pdf_is_complete(path: Path) -> bool:
+    """末尾に %%EOF があるか (書き込み途中のファイルを除外する)"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - EOF_SEARCH_BYTES))
+            return b"%%EOF" in f.read()
+    except OSError:
+        return False
+
+
+class FileIndex:
+    """処理済みファイルの記録 (相対パス → サイズ・更新時刻・状態)"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.exists = path.exists()
+        self.files: Dict[str, Dict] = {}
+        if self.exists:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    self.files = data.get("files", {})
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"記録ファイルを読み込めないため、作り直します: {e}")
+
+    def save(self):
+        # 書きかけのファイルを残さないよう、一時ファイルに書いてから置き換える
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "files": self.files}, f, ensure_ascii=False, indent=1)
+        temp_path.replace(self.path)
+        self.exists = True
+
+    def is_current(self, relative_path: str, stat: os.stat_result) -> bool:
+        entry = self.files.get(relative_path)
+        return entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+
+def _ignore_interrupt():
+    # Ctrl+C は監視プロセスだけが受け取り、実行中の比較は最後まで続ける
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class HotFolderWatcher:
+    """監視フォルダを走査し、新しいリビジョンと1つ前の版との比較を実行する"""
+
+    def __init__(self, watch_dir: str, output_dir: str, settings: Dict, rule: RevisionRule = None,
+                 settle: float = 10.0, workers: int = 1, initial_scan: str = "index"):
+        self.watch_dir = Path(watch_dir).resolve()
+        self.output_dir = Path(output_dir).resolve()
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.settings = settings
+        self.rule = rule or RevisionRule()
+        self.settle = settle
+        self.index = FileIndex(self.output_dir / INDEX_FILENAME)
+        self.initial_scan = initial_scan if not self.index.exists else None
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_ignore_interrupt)
+        self.running: Dict[str, Future] = {}
+        # 落ち着くのを待っているファイル: 相対パス → (サイズ, 更新時刻, 最初にその状態を見た時刻)
+        self.observed: Dict[str, Tuple[int, int, float]] = {}
+        # そのうち、変化が止まっても末尾に %%EOF がないファイル
+        self.incomplete: Set[str] = set()
+        # 初回の走査で既にあったファイルのうち、まだ記録していないもの (落ち着いたら比較せずに記録する)
+        self.preexisting: Set[str] = set()
+
+    def _relative(self, path: Path) -> Optional[str]:
+        if path == self.output_dir or self.output_dir in path.parents:
+            return None  # 出力フォルダが監視フォルダの中にある場合、出力した統合PDFは対象外
+        return path.relative_to(self.watch_dir).as_posix()
+
+    def scan(self) -> Dict[str, os.stat_result]:
+        files = {}
+        for path in self.watch_dir.rglob("*"):
+            if path.suffix.lower() != ".pdf" or path.name.startswith((".", "~$")):
+                continue
+            relative = self._relative(path)
+            if relative is None:
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue  # 走査中に移動・削除された
+            if stat.st_size:
+                files[relative] = stat
+        return files
+
+    def _stable(self, relative: str, stat: os.stat_result, now: float) -> bool:
+        state = (stat.st_size, stat.st_mtime_ns)
+        observed = self.observed.get(relative)
+        if observed is None or observed[:2] != state:
+            self.observed[relative] = state + (now,)
+            self.incomplete.discard(relative)
+            return False
+        if now - observed[2] < self.settle:
+            return False
+        if pdf_is_complete(self.watch_dir / relative):
+            return True
+        if relative not in self.incomplete:
+            self.incomplete.add(relative)
+            logger.warning(f"末尾に %%EOF がないため待機します (壊れたファイルか、まだ書き込み中): {relative}")
+        return False
+
+    def _predecessor(self, relative: str) -> Optional[str]:
+        """同じ図面の記録済みの版のうち、relative より前で最も新しいもの"""
+        family, key, _ = self.rule.parse(relative)
+        candidates = []
+        for other, entry in self.index.files.items():
+            if other == relative or not (self.watch_dir / other).exists():
+                continue
+            other_family, other_key, _ = self.rule.parse(other)
+            if other_family == family and other_key < key:
+                candidates.append((other_key, other))
+        return max(candidates)[1] if candidates else None
+
+    def _output_for(self, relative: str) -> str:
+        path = Path(relative)
+        return str(self.output_dir / path.parent / path.stem)
+
+    def poll(self) -> int:
+        """1回走査し、落ち着いた新しいファイルを処理する。比較を登録した数を返す"""
+        now = time.monotonic()
+        files = self.scan()
+        for relative in [r for r in self.index.files if r not in files and r not in self.running]:
+            del self.index.files[relative]  # 削除されたファイル (同じ名前で置き直されたら新しいファイルとして扱う)
+        for relative in [r for r in self.observed if r not in files]:
+            del self.observed[relative]
+        self.incomplete &= set(self.observed)
+        if self.initial_scan == "index":
+            self.preexisting = set(files)
+        self.preexisting &= set(files)
+
+        ready = []
+        for relative, stat in files.items():
+            if self.index.is_current(relative, stat) or relative in self.running:
+                self.observed.pop(relative, None)
+                continue
+            if self._stable(relative, stat, now):
+                ready.append((relative, stat))
+        if not ready and not self.initial_scan:
+            return 0
+
+        # 同じ図面の複数の版が同時に届いた場合に、古い版から順に記録して次の版の比較相手にする
+        ready.sort(key=lambda item: self.rule.parse(item[0])[1])
+        submitted = indexed = 0
+        for relative, stat in ready:
+            self.observed.pop(relative, None)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                     "seen_at": datetime.now().isoformat(timespec="seconds")}
+            previous = None if relative in self.preexisting else self._predecessor(relative)
+            if relative in self.preexisting:
+                self.preexisting.discard(relative)
+                indexed += 1
+            if previous is None:
+                self.index.files[relative] = dict(entry, status="seen")
+                continue
+            self.index.files[relative] = dict(entry, status="queued", previous=previous, output=self._output_for(relative))
+            self._submit(relative)
+            submitted += 1
+        if indexed:
+            waiting = f"、落ち着くのを待っているもの {len(self.preexisting)} ファイル" if self.preexisting else ""
+            logger.info(f"既存の {indexed} ファイルを記録しました (比較は新しいファイルから{waiting})")
+        self.initial_scan = None
+        self.index.save()
+        return submitted
+
+    def _submit(self, relative: str):
+        entry = self.index.files[relative]
+        logger.info(f"比較を開始: {entry['previous']} → {relative}")
+        self.running[relative] = self.pool.submit(run_pair, str(self.watch_dir / entry["previous"]),
+                                                  str(self.watch_dir / relative), entry["output"], self.settings)
+
+    def resume(self) -> int:
+        """前回の実行で終わらなかった比較を登録し直す"""
+        pending = [r for r, e in self.index.files.items() if e.get("status") == "queued" and (self.watch_dir / r).exists()]
+        for relative in pending:
+            self._submit(relative)
+        if pending:
+            logger.info(f"前回終わらなかった {len(pending)} 件の比較を再開します")
+        return len(pending)
+
+    def collect(self) -> int:
+        """終わった比較の結果を記録する。記録した数を返す"""
+        finished = [r for r, future in self.running.items() if future.done()]
+        if not finished:
+            return 0
+        with open(self.output_dir / SUMMARY_FILENAME, "a", encoding="utf-8") as summary:
+            for relative in finished:
+                try:
+                    record = self.running.pop(relative).result()
+                except Exception as e:
+                    # ワーカープロセスの異常終了 (メモリ不足など)。記録は queued のまま残し、再起動後に再試行する
+                    logger.error(f"比較中にワーカーが終了しました: {relative}: {type(e).__name__}: {e}")
+                    continue
+                record["revision"] = relative
+                summary.write(json.dumps(record, ensure_ascii=False) + "\n")
+                entry = self.index.files.get(relative)
+                if entry is None:
+                    continue
+                entry["finished_at"] = datetime.now().isoformat(timespec="seconds")
+                if record["status"] == "ok":
+                    entry.update(status="done", total_changes=record["total_changes"],
+                                 changed_pages=record["changed_pages"], summary_pdf=record.get("summary_pdf"))
+                    logger.info(f"比較が完了: {relative} (変更 {record['total_changes']} ピクセル, "
+                                f"ページ {record['changed_pages']})")
+                else:
+                    entry.update(status="error", error=record.get("error"))
+                    logger.error(f"比較に失敗: {relative}: {record.get('error')}")
+        self.index.save()
+        return len(finished)
+
+    def idle(self) -> bool:
+        # 末尾に %%EOF のないファイルは待ち続けない (--once の次の実行で確認し直す)
+        return not self.running and self.initial_scan is None and all(r in self.incomplete for r in self.observed)
+
+    def run(self, poll_interval: float = 5.0, stop: threading.Event = None, once: bool = False):
+        """stop が設定されるまで (once なら処理するものがなくなるまで) 監視する"""
+        stop = stop or threading.Event()
+        self.resume()
+        try:
+            while not stop.is_set():
+                self.collect()
+                self.poll()
+                if once and self.idle():
+                    break
+                stop.wait(min(poll_interval, self.settle) if self.observed else poll_interval)
+            wait(list(self.running.values()))
+            self.collect()
+        finally:
+            self.pool.shutdown(wait=True)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="SpotPDF ホットフォルダ監視 (新しいリビジョンを前の版と自動で比較)")
+    parser.add_argument("watch_dir", help="監視するフォルダ (サブフォルダも対象)")
+    parser.add_argument("-o", "--output", help="出力フォルダ (既定: 監視フォルダと同じ階層の <名前>_diff)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="版を判定する正規表現 (拡張子を除くファイル名に一致させ、base と rev のグループを持つ)")
+    parser.add_argument("--poll", type=float, default=5.0, help="走査の間隔 (秒)")
+    parser.add_argument("--settle", type=float, default=10.0, help="サイズと更新時刻がこの秒数変わらなければ書き込み完了とみなす")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="同時に実行する比較の数")
+    parser.add_argument("--initial-scan", choices=["index", "diff"], default="index",
+                        help="初回起動時に既にあるファイルの扱い: index は記録のみ、diff は前の版との比較も行う")
+    parser.add_argument("--once", action="store_true", help="処理するものがなくなったら終了する")
+    parser.add_argument("--sensitivity", type=int, default=10, help="差分検出感度 (1-50)")
+    parser.add_argument("--match-pages", action="store_true", help="ページを内容で対応付ける (挿入・削除・並び替えに対応)")
+    parser.add_argument("--summary-mode", choices=["layered", "vector", "raster"], default="layered",
+                        help="統合PDFの形式 (batch_diff.py と同じ)")
+    parser.add_argument("--export-all", action="store_true", help="both/added/removed の全パターンを出力")
+    parser.add_argument("--deadline-sec", type=float, default=None, help="1件あたりの制限時間 (秒)")
+    return parser
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    watch_dir = Path(args.watch_dir).resolve()
+    if not watch_dir.is_dir():
+        parser.error(f"監視するフォルダがありません: {watch_dir}")
+    try:
+        rule = RevisionRule(args.pattern)
+    except (re.error, ValueError) as e:
+        parser.error(f"--pattern が正しくありません: {e}")
+    output_dir = args.output or str(watch_dir.parent / f"{watch_dir.name}_diff")
+    settings = {
+        "sensitivity": args.sensitivity,
+        "display_filter": {"added": True, "removed": True},
+        "export_all_patterns": args.export_all,
+        "page_matching": args.match_pages,
+        "summary_mode": args.summary_mode,
+        "deadline_sec": args.deadline_sec,
+        # 比較の途中で止めても、再起動後に完了済みのページから再開する
+        "checkpoint": True,
+    }
+
+    watcher = HotFolderWatcher(str(watch_dir), output_dir, settings, rule=rule, settle=args.settle,
+                               workers=args.workers, initial_scan=args.initial_scan)
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("終了要求を受け付けました (実行中の比較を終えてから終了します)")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logger.info(f"監視を開始: {watch_dir} (出力: {output_dir})")
+    watcher.run(args.poll, stop, once=args.once)
+    logger.info("監視を終了しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+比較ジョブのページごとのチェックポイント (コンテナの再起動・強制終了からの再開用)
+
+create_pixel_diff_output を settings["checkpoint"] = True で実行すると、出力フォルダに
+次のファイルを残しながら処理します。
+
+    checkpoints/state.json        入力PDFのハッシュ・設定・ページの対応付け・完了フラグ
+    checkpoints/p0001.json        完了したページの結果 (変更数・出力ファイル名・中間データ)
+    checkpoints/p0001_00.jpg      そのページの統合PDF用の画像 (統合PDFの作成後に削除)
+    checkpoints/p0001_00_00.png   統合PDFの vector・layered モードで重ねる変更領域の画像 (同上)
+
+同じ入力・設定で同じ出力先に再実行すると、このフォルダを見つけて完了済みのページを飛ばし、
+残りのページと統合PDFだけを処理します。
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+CHECKPOINT_DIR = "checkpoints"
+STATE_FILENAME = "state.json"
+CHECKPOINT_VERSION = 1
+
+
+def file_digest(path) -> str:
+    """ファイル内容 (パス、またはPDFのバイト列) の SHA-256 (同じジョブの再実行かどうかの判定に使う)"""
+    if isinstance(path, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(path).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json(path: Path, data: Dict):
+    # 書きかけのファイルを残さないよう、一時ファイルに書いてから置き換える
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    temp_path.replace(path)
+
+
+def _read_json(path: Path) -> Optional[Dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class JobCheckpoint:
+    """1つの出力フォルダのチェックポイント"""
+
+    def __init__(self, output_path: Path, fingerprint: Dict):
+        self.output_path = Path(output_path)
+        self.directory = self.output_path / CHECKPOINT_DIR
+        self.fingerprint = fingerprint
+        self.state = _read_json(self.directory / STATE_FILENAME) or {}
+
+    @staticmethod
+    def find(output_dir: Path, folder_prefix: str, fingerprint: Dict) -> Optional[Path]:
+        """output_dir 内で、同じ入力・設定のチェックポイントを持つ最新の出力フォルダを探す"""
+        candidates = []
+        for folder in Path(output_dir).glob(f"{folder_prefix}*"):
+            state = _read_json(folder / CHECKPOINT_DIR / STATE_FILENAME)
+            if state and state.get("version") == CHECKPOINT_VERSION and state.get("fingerprint") == fingerprint:
+                candidates.append(folder)
+        return max(candidates, key=lambda p: p.name) if candidates else None
+
+    @property
+    def complete(self) -> bool:
+        return bool(self.state.get("complete"))
+
+    @property
+    def page_pairs(self) -> Optional[List[Dict]]:
+        return self.state.get("page_pairs")
+
+    def start(self, page_pairs: List[Dict]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.state = {"version": CHECKPOINT_VERSION, "fingerprint": self.fingerprint, "page_pairs": page_pairs, "complete": False}
+        _write_json(self.directory / STATE_FILENAME, self.state)
+
+    def completed_pages(self) -> Dict[int, Dict]:
+        """完了済みのページ (位置 → 保存した内容)"""
+        pages = {}
+        for path in sorted(self.directory.glob("p[0-9][0-9][0-9][0-9].json")):
+            page = _read_json(path)
+            if page is not None:
+                pages[page["position"]] = page
+        return pages
+
+    def save_page(self, position: int, page: Dict, summary_pages: List[Dict]):
+        """ページの結果と統合PDF用の画像を保存する (この書き込みが終わったページを完了とみなす)"""
+        summary_files = []
+        for index, summary_page in enumerate(summary_pages):
+            entry = {k: v for k, v in summary_page.items() if k not in ("jpeg", "overlays")}
+            if "jpeg" in summary_page:
+                entry["file"] = f"p{position:04d}_{index:02d}.jpg"
+                (self.directory / entry["file"]).write_bytes(summary_page["jpeg"])
+            if "overlays" in summary_page:
+                entry["overlays"] = []
+                for number, overlay in enumerate(summary_page["overlays"]):
+                    name = f"p{position:04d}_{index:02d}_{number:02d}.png"
+                    (self.directory / name).write_bytes(overlay["png"])
+                    entry["overlays"].append(dict({k: v for k, v in overlay.items() if k != "png"}, file=name))
+            summary_files.append(entry)
+        _write_json(self.directory / f"p{position:04d}.json", {"position": position, "page": page, "summary_pages": summary_files})
+
+    def load_summary_pages(self, saved: Dict) -> List[Dict]:
+        summary_pages = []
+        for entry in saved["summary_pages"]:
+            summary_page = {k: v for k, v in entry.items() if k not in ("file", "overlays")}
+            if "file" in entry:
+                summary_page["jpeg"] = (self.directory / entry["file"]).read_bytes()
+            if "overlays" in entry:
+                summary_page["overlays"] = [dict({k: v for k, v in overlay.items() if k != "file"}, png=(self.directory / overlay["file"]).read_bytes())
+                                            for overlay in entry["overlays"]]
+            summary_pages.append(summary_page)
+        return summary_pages
+
+    def finish(self, results: Dict):
+        """完了を記録し、統合PDF用の画像を削除する (再実行時は保存した結果をそのまま返す)"""
+        self.state.update(complete=True, results=results)
+        _write_json(self.directory / STATE_FILENAME, self.state)
+        for pattern in ("*.jpg", "*.png"):
+            for path in self.directory.glob(pattern):
+                path.unlink()
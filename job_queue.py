@@ -0,0 +1,196 @@
+"""
+共有ボリューム上の SQLite による永続的なジョブキュー
+
+Web コンテナはジョブを登録 (enqueue) して結果を返すだけにし、比較処理は diff_worker.py の
+ワーカーが取り出して実行します。ワーカーはジョブをリース (lease_expires まで有効な占有権) 付きで
+取得し、処理中は heartbeat() でリースを延長します。ワーカーがクラッシュ・強制終了すると
+リースが切れ、ジョブは別のワーカーに再び割り当てられます (max_attempts 回まで)。
+
+    queue = JobQueue("data/jobs.sqlite3")
+    job_id = queue.enqueue("diff", {"old_path": ..., "new_path": ..., "output_dir": ...})
+
+    job = queue.claim("worker-1", lease_seconds=60)
+    queue.heartbeat(job.id, "worker-1", lease_seconds=60)
+    queue.complete(job.id, "worker-1", results)
+
+状態は queued → running → done / failed / cancelled と遷移します。待機中のジョブは cancel() で
+すぐに cancelled になり、実行中のジョブはワーカーが中止要求 (cancellation.request_cancel) を
+検知して cancelled を登録します。データベースは WAL モードで開くため、
+同じホスト上の複数のプロセス・コンテナから同時に読み書きできます (NFS などのネットワーク
+ファイルシステム上には置かないでください)。
+"""
+import json
+import os
+import secrets
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 3
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            TEXT PRIMARY KEY,
+    kind          TEXT NOT NULL,
+    payload       TEXT NOT NULL,
+    owner         TEXT,
+    status        TEXT NOT NULL DEFAULT 'queued',
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    lease_owner   TEXT,
+    lease_expires REAL,
+    result        TEXT,
+    error         TEXT,
+    created_at    REAL NOT NULL,
+    updated_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, created_at);
+"""
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    payload: Dict
+    owner: Optional[str]
+    status: str
+    attempts: int
+    lease_owner: Optional[str]
+    lease_expires: Optional[float]
+    result: Optional[Dict]
+    error: Optional[str]
+    created_at: float
+    updated_at: float
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "Job":
+        values = dict(row)
+        values["payload"] = json.loads(values["payload"])
+        values["result"] = json.loads(values["result"]) if values["result"] else None
+        return cls(**values)
+
+
+def cleanup_inputs(job: Job):
+    """アップロードされた入力ファイル (共有ボリューム上、payload["input_dir"]) を削除する"""
+    input_dir = job.payload.get("input_dir")
+    if input_dir and os.path.isdir(input_dir):
+        shutil.rmtree(input_dir, ignore_errors=True)
+
+
+class JobQueue:
+    """SQLite ファイル1つで複数のプロセス・コンテナが共有するジョブキュー"""
+
+    def __init__(self, db_path: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.db_path = str(db_path)
+        self.max_attempts = max_attempts
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # 呼び出しごとに接続する (スレッド・フォークをまたいで接続を共有しないため)
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """書き込みロックを先に取るトランザクション (取得と更新の間に他のワーカーが割り込まない)"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def enqueue(self, kind: str, payload: Dict, owner: str = None, job_id: str = None) -> str:
+        job_id = job_id or secrets.token_hex(8)
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO jobs (id, kind, payload, owner, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (job_id, kind, json.dumps(payload, ensure_ascii=False), owner, now, now))
+        return job_id
+
+    def claim(self, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> Optional[Job]:
+        """待機中のジョブ、またはリースの切れたジョブを1つ取得して worker_id の占有にする"""
+        now = time.time()
+        with self._transaction() as conn:
+            # 何度実行してもワーカーごと落ちるジョブ (メモリ不足など) は打ち切る
+            abandoned = [Job.from_row(row) for row in conn.execute(
+                "SELECT * FROM jobs WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts)).fetchall()]
+            conn.executemany("UPDATE jobs SET status = 'failed', lease_owner = NULL, lease_expires = NULL, updated_at = ?, "
+                             "error = 'ワーカーが応答しなくなったため ' || attempts || ' 回で打ち切りました' WHERE id = ?",
+                             [(now, job.id) for job in abandoned])
+            row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                               "ORDER BY created_at LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, "
+                             "lease_expires = ?, updated_at = ? WHERE id = ?",
+                             (worker_id, now + lease_seconds, now, row["id"]))
+                row = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        # 打ち切ったジョブの入力は、ほかの失敗と同じく削除する (コミット後に)
+        for job in abandoned:
+            cleanup_inputs(job)
+        return Job.from_row(row) if row is not None else None
+
+    def heartbeat(self, job_id: str, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """リースを延長する。False ならリースは既に別のワーカーに移っている"""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                                  "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                                  (now + lease_seconds, now, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, result: Dict) -> bool:
+        return self._finish(job_id, worker_id, "done", result=json.dumps(result, ensure_ascii=False))
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return self._finish(job_id, worker_id, "failed", error=str(error))
+
+    def cancelled(self, job_id: str, worker_id: str, reason: str) -> bool:
+        """実行中のジョブが中止要求で止まったことを登録する"""
+        return self._finish(job_id, worker_id, "cancelled", error=str(reason))
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """待機中のジョブを取り消し、変更後の状態を返す (実行中のジョブの状態は変えない)"""
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'cancelled', error = '実行前に取り消されました', updated_at = ? "
+                         "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["status"] if row else None
+
+    def _finish(self, job_id: str, worker_id: str, status: str, result: str = None, error: str = None) -> bool:
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, lease_owner = NULL, "
+                                  "lease_expires = NULL, updated_at = ? "
+                                  "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                                  (status, result, error, time.time(), job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job.from_row(row) if row else None
+
+    def counts(self) -> Dict[str, int]:
+        """状態ごとのジョブ数"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = dict.fromkeys(JOB_STATUSES, 0)
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
@@ -0,0 +1,62 @@
+"""
+重い拡張モジュール (cv2, fitz など) の読み込みを最初の使用時まで遅らせる
+
+    cv2 = lazy_import("cv2")   # ここでは読み込まない
+    cv2.imread(...)            # 最初の属性アクセスで import する
+
+Web アプリの起動 (/status が応答できるまで) やバッチ CLI の引数エラーでは
+OpenCV・PyMuPDF が不要なため、その読み込み時間 (合計で数百ミリ秒) を省けます。
+本番の gunicorn はマスタープロセスで preload_modules() を呼び、ワーカーが読み込み済みの
+状態でフォークされるようにしています。
+"""
+import importlib
+import sys
+import threading
+from types import ModuleType
+
+# 本番サーバーでフォーク前に読み込んでおくモジュール
+HEAVY_MODULES = ("numpy", "cv2", "fitz")
+
+
+class _LazyModule(ModuleType):
+    """属性に最初にアクセスされたときに実際のモジュールを import する代理オブジェクト"""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_lock"] = threading.Lock()
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self) -> ModuleType:
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            with self.__dict__["_lazy_lock"]:
+                module = self.__dict__["_lazy_module"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        # 2回目以降は通常の属性として引けるようにキャッシュする
+        self.__dict__[attr] = value
+        return value
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name: str) -> ModuleType:
+    """name のモジュールを遅延読み込みする代理オブジェクトを返す (読み込み済みならそのモジュール)"""
+    module = sys.modules.get(name)
+    return module if module is not None else _LazyModule(name)
+
+
+def preload_modules(names=HEAVY_MODULES):
+    """遅延読み込みの対象モジュールを今すぐ読み込む (サーバーのウォームアップ用)"""
+    for name in names:
+        importlib.import_module(name)
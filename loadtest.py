@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Web サービスの負荷試験 (ネットワーク不要)
+
+一時フォルダで gunicorn (gunicorn.conf.py) の web_app を起動し、複数の仮想ユーザーから
+/upload と /download を同時に実行して、スループット・レイテンシ (p50/p95/p99)・エラー率・
+サーバーの RSS の推移を表示します。Google には接続しません。
+
+    偽の ID プロバイダー  google_token_verifier.FakeGoogleIdentity の証明書を GOOGLE_CERTS_URL に設定し、
+                          同じ鍵で署名した ID トークンで /auth/google から通常どおりログインする
+    偽の許可ユーザー     AUTHORIZED_USERS_FILE の CSV に仮想ユーザーを登録する (スプレッドシートの代わり)
+    PDF のコーパス       画像中心のページ (要件定義の「20ページ・画像中心のPDF」) を生成し、一部のページを変更する
+
+Flask-Limiter の制限は RATELIMIT_ENABLED=false で外します (1つのアドレスから大量に送るため)。
+
+使用例:
+    python loadtest.py                                   # 20ページ × 2ユーザー × 60秒
+    python loadtest.py --users 1 2 4 --duration 120      # 同時ユーザー数ごとに計測して上限を探す
+    python loadtest.py --queue-workers 2 --users 4       # ジョブキュー + diff_worker.py 2つで計測
+    python loadtest.py --json loadtest.json              # 結果を JSON でも保存
+
+要件 (2 vCPU / 4 GB で 20 ページを 60 秒以内) の確認には、docker run --cpus 2 --memory 4g などで
+同じ条件のコンテナ内から実行してください。
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+from google_token_verifier import FakeGoogleIdentity
+
+REPO_DIR = Path(__file__).resolve().parent
+CLIENT_ID = "loadtest.apps.googleusercontent.com"
+PAGE_SIZE = (842, 595)  # A3 横 (pt)
+IMAGE_DPI = 150
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# ---------------------------------------------------------------- コーパス
+
+def _page_image(rng, width: int, height: int, seed: int):
+    """スキャンした図面風のグレースケール画像 (線・矩形・ノイズ)"""
+    import numpy as np
+
+    page_rng = np.random.default_rng(seed)
+    image = np.full((height, width), 245, dtype=np.uint8)
+    image += page_rng.integers(0, 8, size=image.shape, dtype=np.uint8)  # 紙のノイズ
+    for _ in range(120):
+        x, y = int(page_rng.integers(0, width - 40)), int(page_rng.integers(0, height - 40))
+        if page_rng.random() < 0.5:
+            length = int(page_rng.integers(40, width // 3))
+            image[y:y + 2, x:min(width, x + length)] = 20
+        else:
+            w, h = int(page_rng.integers(20, 160)), int(page_rng.integers(20, 160))
+            image[y:min(height, y + h), x:x + 2] = 30
+            image[y:min(height, y + h), min(width - 2, x + w):min(width, x + w + 2)] = 30
+            image[y:y + 2, x:min(width, x + w)] = 30
+            image[min(height - 2, y + h):min(height, y + h + 2), x:min(width, x + w)] = 30
+    return image
+
+
+def generate_pair(directory: Path, name: str, pages: int, changed_ratio: float, seed: int):
+    """旧版と新版の PDF を作る (新版は changed_ratio の割合のページの一部を描き変える)"""
+    import fitz
+    import numpy as np
+
+    rng = random.Random(seed)
+    width, height = (round(side * IMAGE_DPI / 72) for side in PAGE_SIZE)
+    old_doc, new_doc = fitz.open(), fitz.open()
+    changed = set(rng.sample(range(pages), max(1, round(pages * changed_ratio))))
+    for number in range(pages):
+        image = _page_image(rng, width, height, seed * 1000 + number)
+        for doc, variant in ((old_doc, image), (new_doc, image.copy() if number in changed else image)):
+            if variant is not image:
+                x, y = rng.randrange(0, width - 300), rng.randrange(0, height - 200)
+                variant[y:y + 200, x:x + 300] = 245
+                variant[y + 90:y + 110, x + 20:x + 280] = 10
+            pixmap = fitz.Pixmap(fitz.csGRAY, width, height, np.ascontiguousarray(variant).tobytes(), False)
+            page = doc.new_page(width=PAGE_SIZE[0], height=PAGE_SIZE[1])
+            page.insert_image(page.rect, stream=pixmap.tobytes("jpeg", jpg_quality=85))
+            page.insert_text((36, 36), f"{name} sheet {number + 1}", fontsize=14)
+    paths = (directory / f"{name}_old.pdf", directory / f"{name}_new.pdf")
+    old_doc.save(paths[0], garbage=3, deflate=True)
+    new_doc.save(paths[1], garbage=3, deflate=True)
+    return paths
+
+
+# ---------------------------------------------------------------- サーバー
+
+class Server:
+    """一時フォルダを作業ディレクトリとして gunicorn (と diff_worker.py) を起動する"""
+
+    def __init__(self, workdir: Path, identity: FakeGoogleIdentity, users_file: Path, args):
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.workdir = workdir
+        self.env = dict(os.environ,
+                        PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_DIR), os.getenv("PYTHONPATH")])),
+                        PORT=str(self.port), SECRET_KEY="loadtest", GOOGLE_CLIENT_ID=CLIENT_ID,
+                        GOOGLE_CERTS_URL=identity.certs_url, AUTHORIZED_USERS_FILE=str(users_file),
+                        RATELIMIT_ENABLED="false", WEB_LOG_LEVEL="warning")
+        if args.web_workers:
+            self.env["WEB_WORKERS"] = str(args.web_workers)
+        if args.queue_workers:
+            self.env["JOB_QUEUE_DB"] = str(workdir / "jobs.sqlite3")
+        self.queue_workers = args.queue_workers
+        self.processes: List[subprocess.Popen] = []
+        self.log = open(workdir / "server.log", "wb")
+
+    def start(self, timeout: float = 60.0):
+        self.processes.append(subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", str(REPO_DIR / "gunicorn.conf.py"), "web_app:app"],
+            cwd=self.workdir, env=self.env, stdout=self.log, stderr=subprocess.STDOUT))
+        for _ in range(self.queue_workers):
+            self.processes.append(subprocess.Popen([sys.executable, str(REPO_DIR / "diff_worker.py"), "--poll", "0.2"],
+                                                   cwd=self.workdir, env=self.env, stdout=self.log, stderr=subprocess.STDOUT))
+        import requests
+
+        started = time.monotonic()
+        while time.monotonic() - started < timeout:
+            if self.processes[0].poll() is not None:
+                raise RuntimeError(f"gunicorn が終了しました (ログ: {self.workdir / 'server.log'})")
+            try:
+                if requests.get(f"{self.base_url}/status", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise TimeoutError(f"{timeout} 秒以内にサーバーが応答しませんでした")
+
+    def rss_mb(self) -> float:
+        """gunicorn のマスター・ワーカーと diff_worker の RSS の合計 (MB、Linux の /proc から)"""
+        pids = {p.pid for p in self.processes if p.poll() is None}
+        children = defaultdict(list)
+        for status in Path("/proc").glob("[0-9]*/stat"):
+            try:
+                fields = status.read_text().rsplit(")", 1)[1].split()
+                children[int(fields[1])].append(int(status.parent.name))
+            except (OSError, IndexError, ValueError):
+                continue
+        stack = list(pids)
+        while stack:
+            for child in children.get(stack.pop(), []):
+                if child not in pids:
+                    pids.add(child)
+                    stack.append(child)
+        total_kb = 0
+        for pid in pids:
+            try:
+                for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+            except OSError:
+                continue
+        return total_kb / 1024
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.log.close()
+
+
+# ---------------------------------------------------------------- 負荷
+
+class Recorder:
+    """リクエストごとの結果をスレッドセーフに記録する"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.pages = 0
+        self.jobs = 0
+
+    def add(self, name: str, seconds: float, status):
+        with self.lock:
+            self.statuses[name][status] += 1
+            if status == 200:
+                self.samples[name].append(seconds)
+
+
+def virtual_user(number: int, server: Server, identity: FakeGoogleIdentity, corpus, args,
+                 recorder: Recorder, stop: threading.Event):
+    import requests
+
+    session = requests.Session()
+    email = f"loadtest{number}@example.com"
+    started = time.perf_counter()
+    response = session.post(f"{server.base_url}/auth/google", json={"credential": identity.token(email, CLIENT_ID)})
+    recorder.add("login", time.perf_counter() - started, response.status_code)
+    if response.status_code != 200:
+        return
+    rng = random.Random(number)
+    while not stop.is_set():
+        old_path, new_path = rng.choice(corpus)
+        started = time.perf_counter()
+        try:
+            with open(old_path, "rb") as old_file, open(new_path, "rb") as new_file:
+                response = session.post(f"{server.base_url}/upload",
+                                        files={"old_pdf": (old_path.name, old_file, "application/pdf"),
+                                               "new_pdf": (new_path.name, new_file, "application/pdf")},
+                                        data={"sensitivity": "10", "summary_mode": args.summary_mode},
+                                        timeout=args.request_timeout)
+            body = response.json()
+            status = response.status_code
+            if status == 202:  # ジョブキュー: 完了までポーリング
+                status_url = f"{server.base_url}{body['status_url']}"
+                while not stop.is_set() or args.drain:
+                    time.sleep(0.5)
+                    poll = session.get(status_url, timeout=30)
+                    body = poll.json()
+                    if body.get("status") in ("done", "failed", "cancelled"):
+                        status = 200 if body["status"] == "done" else body["status"]
+                        break
+                else:
+                    status = "unfinished"
+        except (requests.RequestException, ValueError) as e:
+            status, body = type(e).__name__, {}
+        recorder.add("upload", time.perf_counter() - started, status)
+        if status == 503:  # 受け付け制御 (空きのジョブ枠なし): 指定された秒数待ってから次へ
+            stop.wait(float(response.headers.get("Retry-After", "1")))
+        if status != 200:
+            continue
+        with recorder.lock:
+            recorder.jobs += 1
+            recorder.pages += args.pages
+        results = body.get("results", {})
+        downloads = [results.get("summary_pdf")] + (results.get("diff_images") or [])[:1]
+        for path in filter(None, downloads):
+            started = time.perf_counter()
+            try:
+                response = session.get(f"{server.base_url}/download/{path}", timeout=args.request_timeout)
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            recorder.add("download", time.perf_counter() - started, status)
+
+
+def run_level(users: int, server: Server, identity: FakeGoogleIdentity, corpus, args) -> Dict:
+    """同時ユーザー数 users で duration 秒負荷をかけ、結果をまとめる"""
+    recorder = Recorder()
+    stop = threading.Event()
+    rss = []
+    threads = [threading.Thread(target=virtual_user, args=(n, server, identity, corpus, args, recorder, stop), daemon=True)
+               for n in range(users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while time.perf_counter() - started < args.duration:
+        rss.append((round(time.perf_counter() - started, 1), round(server.rss_mb(), 1)))
+        time.sleep(args.sample_interval)
+    stop.set()
+    for thread in threads:
+        thread.join()  # 実行中のリクエストは最後まで待つ
+    elapsed = time.perf_counter() - started
+    rss.append((round(elapsed, 1), round(server.rss_mb(), 1)))
+
+    endpoints = {}
+    for name in ("login", "upload", "download"):
+        samples, statuses = recorder.samples[name], recorder.statuses[name]
+        total = sum(statuses.values())
+        endpoints[name] = {
+            "requests": total,
+            "errors": total - statuses[200],
+            "error_rate": (total - statuses[200]) / total if total else 0.0,
+            "statuses": {str(k): v for k, v in statuses.items()},
+            "p50": percentile(samples, 50), "p95": percentile(samples, 95), "p99": percentile(samples, 99),
+            "max": max(samples) if samples else float("nan"),
+        }
+    return {"users": users, "elapsed": elapsed, "jobs": recorder.jobs, "pages": recorder.pages,
+            "jobs_per_min": recorder.jobs / elapsed * 60, "pages_per_sec": recorder.pages / elapsed,
+            "endpoints": endpoints, "rss_mb": rss, "peak_rss_mb": max(value for _, value in rss)}
+
+
+def print_level(result: Dict, target_sec: float):
+    print(f"\n同時ユーザー {result['users']}: {result['elapsed']:.0f} 秒で {result['jobs']} ジョブ "
+          f"({result['jobs_per_min']:.1f} ジョブ/分, {result['pages_per_sec']:.2f} ページ/秒)")
+    print(f"  {'':9} {'requests':>8} {'errors':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for name, stats in result["endpoints"].items():
+        if stats["requests"]:
+            print(f"  {name:9} {stats['requests']:>8} {stats['error_rate']:>8.1%} {stats['p50']:>7.2f}s "
+                  f"{stats['p95']:>7.2f}s {stats['p99']:>7.2f}s {stats['max']:>7.2f}s")
+        errors = {k: v for k, v in stats["statuses"].items() if k != "200"}
+        if errors:
+            print(f"  {'':9} エラーの内訳: {errors}")
+    print("  RSS (MB): " + ", ".join(f"{t:.0f}s={mb:.0f}" for t, mb in result["rss_mb"]))
+    upload = result["endpoints"]["upload"]
+    if upload["p95"] == upload["p95"]:  # NaN でない
+        verdict = "満たす" if upload["p95"] <= target_sec and upload["error_rate"] == 0 else "満たさない"
+        print(f"  /upload の p95 {upload['p95']:.1f} 秒 (目標 {target_sec:.0f} 秒以内): {verdict}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="SpotPDF Web サービスの負荷試験 (偽の認証でオフライン実行)")
+    parser.add_argument("--users", type=int, nargs="+", default=[2], help="同時ユーザー数 (複数指定で順に計測)")
+    parser.add_argument("--duration", type=float, default=60, help="同時ユーザー数ごとの計測時間 (秒)")
+    parser.add_argument("--pages", type=int, default=20, help="1つのPDFのページ数")
+    parser.add_argument("--documents", type=int, default=3, help="生成するPDFの組の数")
+    parser.add_argument("--changed-ratio", type=float, default=0.3, help="新版で変更するページの割合")
+    parser.add_argument("--summary-mode", default="layered", choices=["layered", "vector", "raster"])
+    parser.add_argument("--web-workers", type=int, default=0, help="gunicorn のワーカー数 (既定は WEB_WORKERS)")
+    parser.add_argument("--queue-workers", type=int, default=0,
+                        help="ジョブキューを使い diff_worker.py をこの数だけ起動する (0 は Web プロセス内で比較)")
+    parser.add_argument("--drain", action="store_true", help="計測時間の終了後もキューのジョブの完了を待つ")
+    parser.add_argument("--target-sec", type=float, default=60, help="/upload の p95 の目標 (秒)")
+    parser.add_argument("--request-timeout", type=float, default=900)
+    parser.add_argument("--sample-interval", type=float, default=5, help="RSS の記録間隔 (秒)")
+    parser.add_argument("--keep", action="store_true", help="作業フォルダ (コーパス・出力・server.log) を残す")
+    parser.add_argument("--json", help="結果を JSON で保存するファイル")
+    args = parser.parse_args(argv)
+
+    workdir = Path(tempfile.mkdtemp(prefix="spotpdf-loadtest-"))
+    corpus_dir = workdir / "corpus"
+    corpus_dir.mkdir()
+    print(f"作業フォルダ: {workdir}")
+    started = time.perf_counter()
+    corpus = [generate_pair(corpus_dir, f"doc{n}", args.pages, args.changed_ratio, seed=n) for n in range(args.documents)]
+    size_mb = sum(p.stat().st_size for pair in corpus for p in pair) / 1024 / 1024
+    print(f"コーパス: {args.documents} 組 × {args.pages} ページ ({size_mb:.1f} MB, {time.perf_counter() - started:.1f} 秒で生成)")
+
+    users_file = workdir / "authorized_users.csv"
+    expires = (date.today() + timedelta(days=30)).isoformat()
+    with open(users_file, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["email", "expiration_date"])
+        writer.writerows([f"loadtest{n}@example.com", expires] for n in range(max(args.users)))
+
+    results = []
+    with FakeGoogleIdentity() as identity:
+        server = Server(workdir, identity, users_file, args)
+        try:
+            server.start()
+            print(f"サーバー起動: {server.base_url} (起動直後の RSS {server.rss_mb():.0f} MB)")
+            for users in args.users:
+                result = run_level(users, server, identity, corpus, args)
+                print_level(result, args.target_sec)
+                results.append(result)
+        finally:
+            server.stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "cpu_count": os.cpu_count(), "levels": results}, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {args.json}")
+    if args.keep:
+        print(f"作業フォルダを残しました: {workdir}")
+    else:
+        import shutil
+        shutil.rmtree(workdir, ignore_errors=True)
+    failed = any(level["endpoints"][name]["error_rate"] > 0 for level in results for name in ("login", "upload"))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import numpy as np
+import logging
+from typing import List, Dict, Optional, Tuple
+from lazy_import import lazy_import
+
+cv2 = lazy_import("cv2")
+fitz = lazy_import("fitz")  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_DPI = 36
+THUMBNAIL_SIZE = 32
+
+
+def page_signature(page) -> Dict:
+    """低解像度レンダリングのサムネイルとテキストの単語集合からページ署名を作る
+
+    白地に線が疎に描かれた図面では平均/差分ハッシュがほぼ同じ値になるため、
+    インク量 (255 - 輝度) のサムネイルを正規化したベクトルを知覚的な指紋として使う。
+    """
+    zoom = SIGNATURE_DPI / 72
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+    ink = 255.0 - cv2.resize(gray, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    norm = np.linalg.norm(ink)
+    thumbnail = (ink / norm).flatten() if norm > 0 else ink.flatten()
+    words = frozenset(w[4] for w in page.get_text("words"))
+    return {"thumbnail": thumbnail, "words": words, "size": (page.rect.width, page.rect.height)}
+
+
+def document_signatures(doc) -> List[Dict]:
+    return [page_signature(page) for page in doc]
+
+
+def signature_similarity(a: Dict, b: Dict) -> float:
+    """2つのページ署名の類似度 (0.0〜1.0)"""
+    if not a["thumbnail"].any() and not b["thumbnail"].any():
+        image_sim = 1.0  # 両方とも白紙
+    else:
+        image_sim = float(np.dot(a["thumbnail"], b["thumbnail"]))
+    if a["words"] or b["words"]:
+        # Dice 係数: 改訂で数語追加された程度なら高い値を保つ
+        text_sim = 2 * len(a["words"] & b["words"]) / (len(a["words"]) + len(b["words"]))
+        similarity = 0.6 * image_sim + 0.4 * text_sim
+    else:
+        similarity = image_sim
+    # 用紙サイズが異なるページは別シートとみなしやすくする
+    (w1, h1), (w2, h2) = a["size"], b["size"]
+    if abs(w1 - w2) > 0.05 * max(w1, w2) or abs(h1 - h2) > 0.05 * max(h1, h2):
+        similarity *= 0.5
+    return float(similarity)
+
+
+def align_pages(old_sigs: List[Dict], new_sigs: List[Dict], min_similarity: float = 0.75) -> List[Dict]:
+    """ページ署名の列を順序を保ってアラインメントし、ページの対応を返す
+
+    類似度が min_similarity を超えるペアの (類似度 - min_similarity) の総和が最大になる
+    ように対応付ける (ギャップは 0 点)。対応が付かなかったページのうち、十分に
+    似ているものは並び替え (moved) として対応付ける。
+
+    戻り値は {"old": int|None, "new": int|None, "similarity": float|None, "status": str} のリストで、
+    status は "matched" / "moved" / "added" / "removed"。
+    """
+    n, m = len(old_sigs), len(new_sigs)
+    sim = np.zeros((n, m))
+    for i in range(n):
+        for j in range(m):
+            sim[i, j] = signature_similarity(old_sigs[i], new_sigs[j])
+    gain = sim - min_similarity
+
+    score = np.zeros((n + 1, m + 1))
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            diag = score[i - 1, j - 1] + gain[i - 1, j - 1] if gain[i - 1, j - 1] > 0 else -np.inf
+            score[i, j] = max(diag, score[i - 1, j], score[i, j - 1])
+
+    matches: List[Tuple[int, int]] = []
+    i, j = n, m
+    while i > 0 and j > 0:
+        if gain[i - 1, j - 1] > 0 and score[i, j] == score[i - 1, j - 1] + gain[i - 1, j - 1]:
+            matches.append((i - 1, j - 1)); i -= 1; j -= 1
+        elif score[i, j] == score[i - 1, j]:
+            i -= 1
+        else:
+            j -= 1
+    matches.reverse()
+
+    pairs = [{"old": o, "new": nw, "similarity": round(float(sim[o, nw]), 3), "status": "matched"} for o, nw in matches]
+
+    # 順序を保つ対応から外れたページ同士で、よく似ているものは並び替えとみなす
+    unmatched_old = set(range(n)) - {o for o, _ in matches}
+    unmatched_new = set(range(m)) - {nw for _, nw in matches}
+    moved_threshold = min_similarity + (1.0 - min_similarity) / 2
+    candidates = sorted(((sim[o, nw], o, nw) for o in unmatched_old for nw in unmatched_new), reverse=True)
+    for similarity, o, nw in candidates:
+        if similarity < moved_threshold:
+            break
+        if o in unmatched_old and nw in unmatched_new:
+            pairs.append({"old": o, "new": nw, "similarity": round(float(similarity), 3), "status": "moved"})
+            unmatched_old.discard(o); unmatched_new.discard(nw)
+
+    pairs += [{"old": None, "new": nw, "similarity": None, "status": "added"} for nw in unmatched_new]
+    pairs += [{"old": o, "new": None, "similarity": None, "status": "removed"} for o in unmatched_old]
+    # 新版のページ順 (削除ページは直前の旧版ページの位置) に並べる
+    pairs.sort(key=lambda p: (p["new"] if p["new"] is not None else _removed_position(p["old"], pairs), p["old"] or 0))
+    return pairs
+
+
+def _removed_position(old_index: int, pairs: List[Dict]) -> float:
+    preceding = [p["new"] for p in pairs if p["new"] is not None and p["old"] is not None and p["old"] < old_index]
+    return (max(preceding) if preceding else -1) + 0.5
+
+
+def match_documents(old_doc, new_doc, min_similarity: float = 0.75) -> List[Dict]:
+    """2つの文書のページ対応を求める"""
+    old_sigs, new_sigs = document_signatures(old_doc), document_signatures(new_doc)
+    pairs = align_pages(old_sigs, new_sigs, min_similarity)
+    logger.info("ページ対応付け: " + ", ".join(
+        f"{_label(p['old'])}->{_label(p['new'])}({p['status']})" for p in pairs))
+    return pairs
+
+
+def index_pairs(old_count: int, new_count: int) -> List[Dict]:
+    """従来どおりページ番号で対応付ける"""
+    pairs = []
+    for index in range(max(old_count, new_count)):
+        old = index if index < old_count else None
+        new = index if index < new_count else None
+        pairs.append({"old": old, "new": new, "similarity": None, "status": "matched" if old is not None and new is not None else ("added" if old is None else "removed")})
+    return pairs
+
+
+def _label(index: Optional[int]) -> str:
+    return "-" if index is None else str(index + 1)
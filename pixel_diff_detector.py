@@ -1,12 +1,63 @@
-
-import cv2
 import numpy as np
-from PIL import Image
-import fitz  # PyMuPDF
 import logging
+import json
+import math
+import shutil
 from pathlib import Path
 from datetime import datetime
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
+from buffer_arena import BufferArena
+from cancellation import CancellationToken, JobCancelledError
+from png_encoder import encode_png, encode_mask_png
+from diff_profiler import DiffProfiler, NullProfiler, current_rss_bytes
+from diff_intermediates import INTERMEDIATES_DIR, save_signed_diff, load_signed_diff, load_base_image, write_manifest, read_manifest
+from job_checkpoint import JobCheckpoint, file_digest
+from diff_io import PdfSource, DirectorySink, input_name, is_path, open_pdf, read_input
+from page_matcher import match_documents, index_pairs
+from vector_prediff import compare_pages, page_content_digest
+from shared_raster_pool import ParallelPageRenderer
+from lazy_import import lazy_import
+
+# OpenCV と PyMuPDF は最初の比較で読み込む (Web アプリやCLIの起動を速くするため)
+cv2 = lazy_import("cv2")
+fitz = lazy_import("fitz")  # PyMuPDF
+
+# 1ピクセルあたりのピークメモリ見積もり (バイト)
+# レンダリング結果 RGB x2、位置合わせ後の画像 RGB x2、グレースケール x2、
+# 差分・マスク・モルフォロジー x3、オーバーレイ RGB と PNG エンコードの作業領域程度
+# (バッファはアリーナで使い回すため、ページ数には比例しない)
+PEAK_BYTES_PER_PIXEL = 26
+# タイル分割時の最小の帯の高さ (pt)
+MIN_TILE_HEIGHT_PT = 36
+# 帯・変更領域ごとの比較結果をまとめるページ全体のバッファ (1ピクセルあたりのバイト数)
+# 下地 RGB、グレースケール x2、差分マスク、出力時のオーバーレイ RGB・選択マスク x2・符号付き差分
+PAGE_CANVAS_BYTES_PER_PIXEL = 14
+# 統合PDFに埋め込む JPEG の品質 (従来の PIL 既定値)
+SUMMARY_JPEG_QUALITY = 75
+# ブラウザ側で重ね合わせるためのレイヤー (グレースケールの下地 + 追加/削除の1ビットマスク)
+LAYER_KINDS = ("base", "added", "removed")
+# 統合PDFの作り方: "raster" は差分画像を JPEG で埋め込む (従来)、"vector" は新版の元のページの上に
+# 変更画素だけの透過PNG (変更領域ごとに切り出し) と枠を重ねる (ファイルが小さく、作成も速い)。
+# "layered" は vector と同じ構成で、元のページ・追加・削除を PDF のレイヤー (OCG) に分ける
+SUMMARY_MODES = ("raster", "vector", "layered")
+# layered モードのレイヤー名 (PDFビューアのレイヤー一覧に表示される)
+SUMMARY_LAYER_NAMES = {"base": "新版のページ", "added": "追加", "removed": "削除"}
+# vector モードで変更領域をまとめるときの縮小率 (この画素数のセル単位で近い変更を1つの領域にする)
+SUMMARY_REGION_CELL = 8
+# 1ページ (タイル) あたりの変更領域の上限。超えたら全変更の外接矩形1つにまとめる
+SUMMARY_MAX_OVERLAYS = 64
+# vector モードで変更領域を囲む枠の色 (RGB 0-1) と太さ (pt)
+SUMMARY_REGION_COLOR = (0.0, 0.4, 1.0)
+SUMMARY_REGION_WIDTH = 0.5
+# 再出力 (rethreshold_output) で vector モードの統合PDFを作るために保存する新版PDFの写し
+SUMMARY_SOURCE_FILENAME = "summary_source.pdf"
+# 簡易チェック (quick_check) でハッシュが一致しなかったページを比較する解像度
+QUICK_CHECK_DPI = 50
+
+
+class MemoryBudgetExceededError(MemoryError):
+    """ページの推定メモリ使用量が設定された上限に収まらない"""
+
 
 class PixelDiffDetector:
     """ピクセルレベル差分検出クラス"""
@@ -18,10 +69,22 @@ class PixelDiffDetector:
         self.dpi = 300
         self.added_color = (0, 255, 0)
         self.removed_color = (0, 0, 255)
+        self.profiler = NullProfiler()
+        # ページごとの大きな配列確保をなくすため、作業用バッファをページ間で使い回す
+        self.arena = BufferArena()
 
-    def create_pixel_diff_output(self, old_pdf_path: str, new_pdf_path: str, 
+    def create_pixel_diff_output(self, old_pdf_path: PdfSource, new_pdf_path: PdfSource, 
                                 output_dir: str = "pixel_diff_output", 
-                                progress_callback=None, settings: Dict = None) -> Dict:
+                                progress_callback=None, settings: Dict = None,
+                                cancel_token: CancellationToken = None, sink=None, page_callback=None) -> Dict:
+        """2つのPDFを比較し、差分画像と統合PDFを出力する
+
+        入力はパス・バイト列・ファイルのようなオブジェクトのいずれでもよい (diff_io)。出力は sink
+        (既定は出力フォルダの DirectorySink) に書き出し、結果の diff_images などには sink.write の戻り値が入る。
+        page_callback を渡すと、ページの結果 (results["pages"] の要素) が確定するたびにページ順に呼び出す。
+        settings["render_processes"] を指定すると、入力がファイルのパスのとき旧版・新版のページをその数の
+        ワーカープロセスで同時にレンダリングする (ページ全体を比較するページのみ)。
+        """
         
         def log(message):
             self.logger.info(message)
@@ -33,120 +96,921 @@ class PixelDiffDetector:
         pixel_threshold = settings.get("sensitivity", self.default_pixel_threshold)
         display_filter = settings.get("display_filter", {"added": True, "removed": True})
         export_all = settings.get("export_all_patterns", False)
+        # 感度・表示フィルタだけを変えた再出力 (rethreshold_output) 用に符号付き差分を残す
+        save_intermediates = settings.get("save_intermediates", False)
+        mask_layers = settings.get("mask_layers", False)
+        summary_mode = self._summary_mode(settings)
+        vector_summary = summary_mode in ("vector", "layered")
+        # ページの合間・段階の区切りで中止要求と制限時間 (settings["deadline_sec"]) を確認する
+        cancel_token = cancel_token or CancellationToken(timeout=settings.get("deadline_sec"))
+        self.profiler = DiffProfiler() if settings.get("profile", False) else NullProfiler()
+        profiler = self.profiler
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        old_stem = Path(old_pdf_path).stem
-        new_stem = Path(new_pdf_path).stem
+        old_name, new_name = input_name(old_pdf_path, "old.pdf"), input_name(new_pdf_path, "new.pdf")
+        old_stem = Path(old_name).stem
+        new_stem = Path(new_name).stem
+        # ファイルのようなオブジェクトは一度だけ読み込み、以降はバイト列として扱う
+        old_pdf_path, new_pdf_path = read_input(old_pdf_path), read_input(new_pdf_path)
         sub_dir_name = f"{old_stem}_vs_{new_stem}_{timestamp}"
         output_path = Path(output_dir) / sub_dir_name
-        output_path.mkdir(exist_ok=True, parents=True)
         base_filename = f"{old_stem}_vs_{new_stem}"
 
+        if sink is None: sink = DirectorySink(output_path)
+        checkpoint = None
+        if settings.get("checkpoint", False):
+            if getattr(sink, "directory", None) is None:
+                raise ValueError("チェックポイントは出力フォルダへの書き出し (DirectorySink) でのみ使えます")
+            # 同じ入力・設定の中断したジョブがあれば、そのフォルダで続きから処理する
+            fingerprint = {"old_pdf": file_digest(old_pdf_path), "new_pdf": file_digest(new_pdf_path),
+                           "dpi": self.dpi, "settings": self._manifest_settings(settings)}
+            output_path = JobCheckpoint.find(output_dir, f"{base_filename}_", fingerprint) or output_path
+            checkpoint = JobCheckpoint(output_path, fingerprint)
+            if checkpoint.complete:
+                log(f"完了済みのジョブです。保存された結果を返します: '{output_path}'")
+                return checkpoint.state["results"]
+            sink = DirectorySink(output_path)
         log(f"差分検出を開始 (感度: {pixel_threshold})")
-        log(f"結果はフォルダ '{output_path}' に保存されます")
+        if getattr(sink, "directory", None) is not None:
+            log(f"結果はフォルダ '{sink.directory}' に保存されます")
 
-        results = {"diff_images": [], "summary_pdf": None, "total_changes": 0, "output_path": str(output_path)}
+        results = {"diff_images": [], "summary_pdf": None, "total_changes": 0, "output_path": str(output_path), "page_count": 0, "pages": []}
+        job_span = profiler.span("job", "job", old_pdf=old_stem, new_pdf=new_stem, sensitivity=pixel_threshold)
+        old_doc = new_doc = renderer = None
         
         try:
-            old_doc, new_doc = fitz.open(old_pdf_path), fitz.open(new_pdf_path)
-            max_pages = max(len(old_doc), len(new_doc))
-            summary_images = []
-            
-            for page_num in range(max_pages):
-                log(f"ページ {page_num + 1}/{max_pages} を解析中...")
-                old_image, new_image = self._get_high_res_page(old_doc, page_num), self._get_high_res_page(new_doc, page_num)
+            with job_span:
+                old_doc, new_doc = open_pdf(old_pdf_path), open_pdf(new_pdf_path)
+                cancel_token.check()
+                if checkpoint and checkpoint.page_pairs is not None:
+                    page_pairs = checkpoint.page_pairs
+                elif settings.get("page_matching", False):
+                    log("ページの対応付けを解析中...")
+                    with profiler.span("page_matching", "match"):
+                        page_pairs = match_documents(old_doc, new_doc, settings.get("page_match_threshold", 0.75))
+                else:
+                    page_pairs = index_pairs(len(old_doc), len(new_doc))
+                results["page_count"] = len(page_pairs)
+                if settings.get("memory_budget_mb") and settings.get("memory_policy") == "fail":
+                    # レンダリングを始める前 (出力フォルダを作る前) に全ページを検査して早期に失敗させる
+                    for pair in page_pairs:
+                        if pair["old"] is not None and pair["new"] is not None:
+                            self._plan_page_memory(old_doc[pair["old"]].rect, new_doc[pair["new"]].rect, None, settings)
+                # メモリ上の出力先では、ディスクに残すもの (中間データ・チェックポイント・プロファイル) がなければフォルダを作らない
+                if getattr(sink, "directory", None) is not None or save_intermediates or checkpoint or profiler.enabled:
+                    output_path.mkdir(exist_ok=True, parents=True)
+                if vector_summary and save_intermediates:
+                    # 入力PDFが削除された後の再出力でも元のページを使えるよう、新版の写しを残す
+                    (output_path / INTERMEDIATES_DIR).mkdir(exist_ok=True)
+                    if is_path(new_pdf_path):
+                        shutil.copyfile(new_pdf_path, output_path / INTERMEDIATES_DIR / SUMMARY_SOURCE_FILENAME)
+                    else:
+                        (output_path / INTERMEDIATES_DIR / SUMMARY_SOURCE_FILENAME).write_bytes(new_pdf_path)
+                # 統合PDFの vector モードで元のページを描くときは、開いている新版をそのまま使う
+                summary_key = str(new_pdf_path) if is_path(new_pdf_path) else new_name
+                use_prediff = settings.get("vector_prediff", False)
+                if settings.get("render_processes") and is_path(old_pdf_path) and is_path(new_pdf_path):
+                    renderer = ParallelPageRenderer(old_pdf_path, new_pdf_path, settings["render_processes"])
+                results["added_pages"] = [p["new"] + 1 for p in page_pairs if p["status"] == "added"]
+                results["removed_pages"] = [p["old"] + 1 for p in page_pairs if p["status"] == "removed"]
+                summary_pages = []
+                page_intermediates = []
+                completed_pages = {}
+                if checkpoint:
+                    completed_pages = checkpoint.completed_pages()
+                    if completed_pages:
+                        log(f"中断したジョブを再開: {len(completed_pages)}/{len(page_pairs)} ページは完了済み")
+                    else:
+                        checkpoint.start(page_pairs)
                 
-                if old_image is not None and new_image is not None:
-                    diff_data = self._detect_pixel_differences(old_image, new_image, pixel_threshold)
-                    if diff_data["has_changes"]:
-                        log(f"  - ページ {page_num + 1}: {diff_data['change_count']} ピクセルの変更を検出")
-                        results["total_changes"] += diff_data['change_count']
-                        
-                        # --- 画像生成ロジック ---
-                        if export_all:
-                            # 全パターン出力
-                            filters_to_export = {
-                                "both": {"added": True, "removed": True},
-                                "added": {"added": True, "removed": False},
-                                "removed": {"added": False, "removed": True},
-                            }
-                            main_diff_image = None
-                            for name, current_filter in filters_to_export.items():
-                                diff_image = self._create_precise_diff_display(diff_data, current_filter)
-                                diff_filename = f"{base_filename}_p{page_num + 1:03d}_{name}.png"
-                                self._save_image(diff_image, output_path / diff_filename, results)
-                                if name == "both": main_diff_image = diff_image
-                            if main_diff_image is not None: summary_images.append(main_diff_image)
+                for position, pair in enumerate(page_pairs, 1):
+                    # 前のページは (途中の continue で抜けたページも含めて) ここで確定している
+                    if page_callback and results["pages"]: page_callback(results["pages"][-1])
+                    cancel_token.check()
+                    old_index, new_index = pair["old"], pair["new"]
+                    page_no = (new_index if new_index is not None else old_index) + 1
+                    page_entry = {"page": page_no, "old_page": None if old_index is None else old_index + 1,
+                                  "new_page": None if new_index is None else new_index + 1,
+                                  "status": pair["status"], "change_count": None, "diff_images": []}
+                    results["pages"].append(page_entry)
+                    page_intermediates.append([])
+                    if position in completed_pages:
+                        saved = completed_pages[position]
+                        page_entry.update(self._restore_page(saved["page"], output_path))
+                        page_intermediates[-1] = page_entry.pop("intermediates")
+                        results["diff_images"].extend(page_entry["diff_images"])
+                        results["total_changes"] += page_entry["change_count"] or 0
+                        summary_pages.extend(checkpoint.load_summary_pages(saved))
+                        continue
+                    if old_index is None or new_index is None:
+                        # 対応するページがない場合は高解像度の比較を行わない
+                        log(f"ページ {position}/{len(page_pairs)}: " + (f"新版 {page_no} ページは追加されたページです" if old_index is None else f"旧版 {page_no} ページは削除されたページです"))
+                        continue
+                    log(f"ページ {position}/{len(page_pairs)} を解析中..." + ("" if old_index == new_index else f" (旧版 {old_index + 1} ↔ 新版 {new_index + 1})"))
+                    images_before, summary_before = len(results["diff_images"]), len(summary_pages)
+                    with profiler.span("page", "page", page=page_no) as page_args:
+                        clip = None
+                        if use_prediff:
+                            # ベクター構造の比較で変更領域を絞り込み、その範囲だけをラスタ比較する
+                            with profiler.span("vector_prediff", "prediff") as span_args:
+                                prediff = compare_pages(old_doc[old_index], new_doc[new_index])
+                                span_args["reason"] = prediff["reason"]
+                            if not prediff["full_page"] and prediff["clip"] is None:
+                                log(f"  - ページ {page_no}: 構造的な変更なし (ラスタ比較を省略)")
+                                page_entry["change_count"] = 0
+                                continue
+                            if prediff["full_page"]:
+                                log(f"  - ページ {page_no}: 全面ラスタで比較 ({prediff['reason']})")
+                            else:
+                                clip = prediff["clip"]
+                                page_entry["clip"] = [round(v, 2) for v in clip]
+                                log(f"  - ページ {page_no}: {prediff['reason']}、変更領域のみラスタ比較")
+                        # メモリ上限に応じて DPI を下げる・帯状に分割する・中止するのいずれかを決める
+                        plan = self._plan_page_memory(old_doc[old_index].rect, new_doc[new_index].rect, clip, settings)
+                        page_entry["dpi"] = page_args["dpi"] = plan["dpi"]
+                        if plan["tiles"]:
+                            page_entry["tiles"] = len(plan["tiles"])
+                            log(f"  - ページ {page_no}: メモリ上限のため {len(plan['tiles'])} 分割で比較")
+                        elif plan["dpi"] != self.dpi:
+                            log(f"  - ページ {page_no}: メモリ上限のため {plan['dpi']} DPI で比較")
+
+                        page_entry["change_count"] = 0
+                        if mask_layers: page_entry["layers"] = []
+                        file_prefix = f"{base_filename}_p{page_no:03d}"
+                        cancel_token.check()
+                        if plan["tiles"] or clip is not None:
+                            # 帯・変更領域ごとに比較してページ全体にまとめる (出力は全面で比較した場合と同じくページごとに1枚)
+                            diff_data = self._compare_regions(old_doc, new_doc, old_index, new_index, plan["tiles"] or [clip], plan["dpi"],
+                                                              pixel_threshold, cancel_token, partial=clip is not None)
                         else:
-                            # 選択されたパターンのみ出力
-                            diff_image = self._create_precise_diff_display(diff_data, display_filter)
-                            diff_filename = f"{base_filename}_p{page_num + 1:03d}.png"
-                            self._save_image(diff_image, output_path / diff_filename, results)
-                            summary_images.append(diff_image)
-                    else:
-                        log(f"  - ページ {page_num + 1}: 差分は見つかりませんでした")
+                            if renderer is not None:
+                                old_image, new_image = self._render_pair_traced(renderer, old_doc, old_index, new_doc, new_index, plan["dpi"])
+                            else:
+                                old_image = self._render_page_traced(old_doc, old_index, "old", None, plan["dpi"])
+                                new_image = self._render_page_traced(new_doc, new_index, "new", None, plan["dpi"])
+                            cancel_token.check()
+                            diff_data = None if old_image is None or new_image is None else \
+                                self._detect_pixel_differences(old_image, new_image, pixel_threshold)
+                        if diff_data is None:
+                            page_entry["change_count"] = None
+                        else:
+                            # 統合PDFの vector モードで差分を重ねる元のページと、画像の左上の位置 (pt)
+                            summary_source = {"pdf": summary_key, "page": new_index,
+                                              "clip": None,
+                                              "origin": diff_data["new_origin"], "layered": summary_mode == "layered"}
+                            if save_intermediates:
+                                with profiler.span("save_intermediates", "encode"):
+                                    record = save_signed_diff(
+                                        output_path, file_prefix, diff_data["old_gray"], diff_data["new_gray"], diff_data["base_image"],
+                                        self.arena.get("signed_diff", diff_data["old_gray"].shape, np.int16), plan["dpi"])
+                                    record["summary_source"] = {k: v for k, v in summary_source.items() if k not in ("pdf", "layered")}
+                                    page_intermediates[-1].append(record)
+                            if diff_data["has_changes"]:
+                                page_entry["change_count"] += diff_data["change_count"]
+                                summary_pages.append(self._write_page_outputs(diff_data, file_prefix, sink, results, export_all, display_filter, plan["dpi"],
+                                                                              summary_source if vector_summary else None))
+                                if mask_layers:
+                                    page_entry["layers"].append(self._write_mask_layers(diff_data, file_prefix, sink, plan["dpi"]))
+                            del diff_data
+
+                        page_args["change_count"] = page_entry["change_count"]
+                        if page_entry["change_count"]:
+                            log(f"  - ページ {page_no}: {page_entry['change_count']} ピクセルの変更を検出")
+                            results["total_changes"] += page_entry["change_count"]
+                        elif page_entry["change_count"] == 0:
+                            log(f"  - ページ {page_no}: 差分は見つかりませんでした")
+                        page_entry["diff_images"] = results["diff_images"][images_before:]
+                    if checkpoint:
+                        checkpoint.save_page(position, self._manifest_page(page_entry, page_intermediates[-1]), summary_pages[summary_before:])
+                    if profiler.enabled: profiler.counter("memory", rss_bytes=current_rss_bytes())
+                if page_callback and results["pages"]: page_callback(results["pages"][-1])
 
-            if summary_images:
-                log("差分画像の統合PDFを作成中...")
-                results["summary_pdf"] = str(self._create_summary_pdf(summary_images, output_path, base_filename))
-            
-            old_doc.close(); new_doc.close()
+                cancel_token.check()
+                if summary_pages:
+                    log("差分画像の統合PDFを作成中...")
+                    with profiler.span("summary_pdf", "encode", pages=len(summary_pages)) as span_args:
+                        results["summary_pdf"], span_args["bytes"] = self._create_summary_pdf(summary_pages, sink, base_filename, display_filter,
+                                                                                              {summary_key: new_doc})
+                if save_intermediates:
+                    self._write_job_manifest(output_path, base_filename, old_name, new_name, settings, results, page_intermediates)
+                if checkpoint:
+                    checkpoint.finish(results)
             log(f"差分検出完了: {results['total_changes']} 箇所の変更を検出")
             return results
+        except JobCancelledError as e:
+            log(f"差分検出を中止: {e}"); self._discard_output(output_path, e); raise
         except Exception as e:
             self.logger.error(f"差分検出エラー: {e}"); log(f"エラー: {e}"); raise
+        finally:
+            for doc in (old_doc, new_doc):
+                if doc is not None: doc.close()
+            if renderer is not None: renderer.close()
+            if profiler.enabled and output_path.exists():
+                results["profile_trace"] = str(profiler.write(output_path / f"{base_filename}_trace.json"))
+                log(f"プロファイル結果を保存しました: {results['profile_trace']}")
+            self.profiler = NullProfiler()
+
+    def quick_check(self, old_pdf_path: PdfSource, new_pdf_path: PdfSource, settings: Dict = None) -> Dict:
+        """画像を出力せずに、変更があるかどうかとそのページだけを素早く調べる
+
+        ページの描画内容のハッシュが一致すればそのページは変更なしとし、一致しないページだけを
+        低解像度 (QUICK_CHECK_DPI) のグレースケールで比較して、変更のおおよその面積と範囲を返す。
+        settings["first_change_only"] が真なら最初の変更が見つかった時点で打ち切る (残りは未確認)。
+        """
+        if settings is None: settings = {}
+        pixel_threshold = settings.get("sensitivity", self.default_pixel_threshold)
+        first_change_only = settings.get("first_change_only", False)
+        started = datetime.now()
+        with open_pdf(old_pdf_path) as old_doc, open_pdf(new_pdf_path) as new_doc:
+            if settings.get("page_matching", False):
+                page_pairs = match_documents(old_doc, new_doc, settings.get("page_match_threshold", 0.75))
+            else:
+                page_pairs = index_pairs(len(old_doc), len(new_doc))
+            pages = [{"page": (p["new"] if p["new"] is not None else p["old"]) + 1,
+                      "old_page": None if p["old"] is None else p["old"] + 1, "new_page": None if p["new"] is None else p["new"] + 1,
+                      "status": p["status"], "changed": p["status"] != "matched", "method": None} for p in page_pairs]
+            found_change = any(page["changed"] for page in pages)
+            old_memo, new_memo = {}, {}  # 共有リソース (フォントなど) のハッシュはページ間で使い回す
+            for page, pair in zip(pages, page_pairs):
+                if page["status"] != "matched":
+                    continue
+                if first_change_only and found_change:
+                    page["changed"] = None  # 未確認
+                    continue
+                old_page, new_page = old_doc[pair["old"]], new_doc[pair["new"]]
+                if page_content_digest(old_page, old_memo) == page_content_digest(new_page, new_memo):
+                    page.update(changed=False, method="hash")
+                    continue
+                page.update(method="raster", **self._quick_raster_diff(old_page, new_page, pixel_threshold))
+                found_change = found_change or page["changed"]
+        return {
+            "changed": found_change,
+            "page_count": len(pages),
+            "changed_pages": [page["page"] for page in pages if page["changed"]],
+            "added_pages": [page["new_page"] for page in pages if page["status"] == "added"],
+            "removed_pages": [page["old_page"] for page in pages if page["status"] == "removed"],
+            "pages": pages,
+            "dpi": QUICK_CHECK_DPI,
+            "elapsed_sec": round((datetime.now() - started).total_seconds(), 3),
+        }
+
+    def _quick_raster_diff(self, old_page, new_page, pixel_threshold: int) -> Dict:
+        """低解像度のグレースケールで比較し、変更の有無・面積 (pt²)・割合・外接矩形 (pt) を返す"""
+        zoom = QUICK_CHECK_DPI / 72
+        grays = []
+        for page in (old_page, new_page):
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+            grays.append(np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width])
+        # 寸法の異なるページは白で余白を付けて揃える
+        shape = (max(g.shape[0] for g in grays), max(g.shape[1] for g in grays))
+        if any(g.shape != shape for g in grays):
+            padded = []
+            for gray in grays:
+                canvas = np.full(shape, 255, np.uint8)
+                canvas[:gray.shape[0], :gray.shape[1]] = gray
+                padded.append(canvas)
+            grays = padded
+        _, mask = cv2.threshold(cv2.absdiff(grays[0], grays[1]), pixel_threshold, 255, cv2.THRESH_BINARY)
+        changed_pixels = int(np.count_nonzero(mask))
+        result = {"changed": changed_pixels > 0, "changed_pixels": changed_pixels,
+                  "change_ratio": round(changed_pixels / mask.size, 6), "change_area_pt2": round(changed_pixels / zoom ** 2, 1), "bbox": None}
+        if changed_pixels:
+            x, y, w, h = cv2.boundingRect(cv2.findNonZero(mask))
+            result["bbox"] = [round(v / zoom, 1) for v in (x, y, x + w, y + h)]
+        return result
+
+    def rethreshold_output(self, job_dir: str, progress_callback=None, settings: Dict = None) -> Dict:
+        """保存済みの中間データから、感度・表示フィルタだけを変えて差分画像と統合PDFを作り直す
+
+        create_pixel_diff_output を settings["save_intermediates"] = True で実行したフォルダが対象。
+        PDFのレンダリングと位置合わせは行わず、しきい値処理・ノイズ除去・オーバーレイ・出力のみを行う。
+        settings で指定しなかった項目は元のジョブの設定を引き継ぐ。戻り値は create_pixel_diff_output と同じ形式。
+        """
+
+        def log(message):
+            self.logger.info(message)
+            if progress_callback:
+                progress_callback(message)
+
+        job_dir = Path(job_dir)
+        sink = DirectorySink(job_dir)
+        manifest = read_manifest(job_dir)
+        settings = dict(manifest["settings"], **(settings or {}))
+        pixel_threshold = settings.get("sensitivity", self.default_pixel_threshold)
+        display_filter = settings.get("display_filter", {"added": True, "removed": True})
+        export_all = settings.get("export_all_patterns", False)
+        mask_layers = settings.get("mask_layers", False)
+        base_filename = manifest["base_filename"]
+        summary_source_pdf = job_dir / INTERMEDIATES_DIR / SUMMARY_SOURCE_FILENAME
+        summary_mode = self._summary_mode(settings)
+        vector_summary = summary_mode in ("vector", "layered") and summary_source_pdf.exists()
+        if summary_mode != "raster" and not vector_summary:
+            log("新版PDFの写しがないため、統合PDFは raster モードで作成します")
+        log(f"保存済みの差分から再出力を開始 (感度: {pixel_threshold})")
+
+        # 前回の出力は設定によってファイル構成が変わるため削除してから作り直す
+        previous_layers = [layer[kind] for page in manifest["pages"] for layer in page.get("layers", []) for kind in LAYER_KINDS]
+        for name in manifest["diff_images"] + previous_layers + ([manifest["summary_pdf"]] if manifest.get("summary_pdf") else []):
+            (job_dir / name).unlink(missing_ok=True)
+
+        results = {"diff_images": [], "summary_pdf": None, "total_changes": 0, "output_path": str(job_dir),
+                   "page_count": manifest["page_count"], "pages": [],
+                   "added_pages": manifest["added_pages"], "removed_pages": manifest["removed_pages"]}
+        summary_pages = []
+        for page in manifest["pages"]:
+            page_entry = {key: value for key, value in page.items() if key not in ("intermediates", "layers")}
+            page_entry["diff_images"] = []
+            results["pages"].append(page_entry)
+            if not page["intermediates"]:
+                continue  # 追加・削除されたページ、または構造比較で変更なしと判定されたページ
+            images_before = len(results["diff_images"])
+            page_entry["change_count"] = 0
+            if mask_layers: page_entry["layers"] = []
+            for record in page["intermediates"]:
+                diff_data = self._rethreshold_tile(job_dir, record, pixel_threshold)
+                if diff_data["has_changes"]:
+                    page_entry["change_count"] += diff_data["change_count"]
+                    diff_data["base_image"] = load_base_image(job_dir, record)
+                    summary_source = None
+                    if vector_summary and "summary_source" in record:
+                        summary_source = dict(record["summary_source"], pdf=str(summary_source_pdf), layered=summary_mode == "layered")
+                    summary_pages.append(self._write_page_outputs(diff_data, record["prefix"], sink, results, export_all, display_filter, record["dpi"],
+                                                                  summary_source))
+                    if mask_layers:
+                        page_entry["layers"].append(self._write_mask_layers(diff_data, record["prefix"], sink, record["dpi"]))
+            if page_entry["change_count"]:
+                log(f"  - ページ {page_entry['page']}: {page_entry['change_count']} ピクセルの変更を検出")
+                results["total_changes"] += page_entry["change_count"]
+            page_entry["diff_images"] = results["diff_images"][images_before:]
+
+        if summary_pages:
+            log("差分画像の統合PDFを作成中...")
+            results["summary_pdf"] = self._create_summary_pdf(summary_pages, sink, base_filename, display_filter)[0]
+        manifest.update(settings=self._manifest_settings(settings), diff_images=[Path(p).name for p in results["diff_images"]],
+                        summary_pdf=Path(results["summary_pdf"]).name if results["summary_pdf"] else None,
+                        pages=[self._manifest_page(entry, page["intermediates"]) for entry, page in zip(results["pages"], manifest["pages"])])
+        write_manifest(job_dir, manifest)
+        log(f"再出力完了: {results['total_changes']} 箇所の変更を検出")
+        return results
+
+    def _rethreshold_tile(self, job_dir: Path, record: Dict, pixel_threshold: int) -> Dict:
+        shape, arena = tuple(record["shape"]), self.arena
+        pixel_diff = arena.get("pixel_diff", shape)
+        added, removed = arena.get("added", shape, bool), arena.get("removed", shape, bool)
+        load_signed_diff(job_dir, record, pixel_diff, added, removed)
+        diff_mask, change_count = self._mask_from_difference(pixel_diff, pixel_threshold)
+        return {"has_changes": change_count > 0, "change_count": change_count, "diff_mask": diff_mask, "added": added, "removed": removed}
+
+    @staticmethod
+    def _manifest_settings(settings: Dict) -> Dict:
+        keys = ("sensitivity", "display_filter", "export_all_patterns", "mask_layers", "page_matching", "vector_prediff", "memory_budget_mb", "memory_policy",
+                "summary_mode")
+        return {key: settings[key] for key in keys if key in settings}
+
+    def _write_job_manifest(self, output_path: Path, base_filename: str, old_name: str, new_name: str,
+                            settings: Dict, results: Dict, page_intermediates: List[List[Dict]]):
+        write_manifest(output_path, {
+            "old_pdf": old_name, "new_pdf": new_name, "base_filename": base_filename,
+            "created_at": datetime.now().isoformat(timespec="seconds"), "settings": self._manifest_settings(settings),
+            "page_count": results["page_count"], "added_pages": results["added_pages"], "removed_pages": results["removed_pages"],
+            "diff_images": [Path(p).name for p in results["diff_images"]],
+            "summary_pdf": Path(results["summary_pdf"]).name if results["summary_pdf"] else None,
+            "pages": [self._manifest_page(entry, records) for entry, records in zip(results["pages"], page_intermediates)],
+        })
+
+    @staticmethod
+    def _manifest_page(entry: Dict, records: List[Dict]) -> Dict:
+        """結果のページ情報をマニフェスト用に変換する (出力ファイルはジョブフォルダからの相対名)"""
+        page = dict(entry, diff_images=[Path(p).name for p in entry["diff_images"]], intermediates=records)
+        if "layers" in entry:
+            page["layers"] = [dict(layer, **{kind: Path(layer[kind]).name for kind in LAYER_KINDS}) for layer in entry["layers"]]
+        return page
+
+    @staticmethod
+    def _restore_page(page: Dict, output_path: Path) -> Dict:
+        """_manifest_page で保存したページ情報の出力ファイル名を output_path 内のパスに戻す"""
+        entry = dict(page, diff_images=[str(output_path / name) for name in page["diff_images"]])
+        if "layers" in page:
+            entry["layers"] = [dict(layer, **{kind: str(output_path / layer[kind]) for kind in LAYER_KINDS}) for layer in page["layers"]]
+        return entry
+
+    def create_revision_chain_output(self, pdf_paths: List[PdfSource], output_dir: str = "pixel_diff_output",
+                                     progress_callback=None, settings: Dict = None,
+                                     cancel_token: CancellationToken = None) -> Dict:
+        """複数リビジョン (v1→v2→v3...) を順に比較する
+
+        各リビジョンの各ページは1回だけラスタライズし、隣接ペアの比較
+        (settings["compare_to_first"] が真なら各リビジョンと初版の比較も) で共有する。
+        """
+
+        def log(message):
+            self.logger.info(message)
+            if progress_callback:
+                progress_callback(message)
+
+        if settings is None: settings = {}
+        if len(pdf_paths) < 2:
+            raise ValueError("リビジョン比較には2つ以上のPDFが必要です")
+
+        pixel_threshold = settings.get("sensitivity", self.default_pixel_threshold)
+        display_filter = settings.get("display_filter", {"added": True, "removed": True})
+        export_all = settings.get("export_all_patterns", False)
+        summary_mode = self._summary_mode(settings)
+        vector_summary = summary_mode in ("vector", "layered")
+        cancel_token = cancel_token or CancellationToken(timeout=settings.get("deadline_sec"))
+        self.profiler = DiffProfiler() if settings.get("profile", False) else NullProfiler()
+        profiler = self.profiler
+
+        names = [input_name(p, f"rev{i + 1}.pdf") for i, p in enumerate(pdf_paths)]
+        stems = [Path(name).stem for name in names]
+        pdf_paths = [read_input(p) for p in pdf_paths]
+        # 統合PDFの vector モードで元のページを描くときは、開いている各リビジョンをそのまま使う
+        summary_keys = [str(p) if is_path(p) else f"{i:02d}_{name}" for i, (p, name) in enumerate(zip(pdf_paths, names))]
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        base_filename = f"{stems[0]}_chain_{stems[-1]}"
+        output_path = Path(output_dir) / f"{base_filename}_{timestamp}"
+        output_path.mkdir(exist_ok=True, parents=True)
+        sink = DirectorySink(output_path)
+
+        # 比較ステップ: 隣接ペア + (任意で) 初版との比較
+        step_pairs = [(i - 1, i) for i in range(1, len(pdf_paths))]
+        if settings.get("compare_to_first", False):
+            step_pairs += [(0, i) for i in range(2, len(pdf_paths))]
+        steps = [{"step": n + 1, "old": stems[o], "new": stems[i], "old_index": o, "new_index": i,
+                  "total_changes": 0, "pages": [], "diff_images": []} for n, (o, i) in enumerate(step_pairs)]
+
+        log(f"リビジョン比較を開始: {' → '.join(stems)} (感度: {pixel_threshold}, {len(steps)} ステップ)")
+        log(f"結果はフォルダ '{output_path}' に保存されます")
+
+        results = {"diff_images": [], "summary_pdf": None, "report": None, "total_changes": 0,
+                   "output_path": str(output_path), "revisions": stems, "page_count": 0, "steps": steps}
+        step_summary_pages = [[] for _ in steps]
+        docs = []
+
+        try:
+            with profiler.span("job", "job", revisions=len(pdf_paths), steps=len(steps), sensitivity=pixel_threshold):
+                docs = [open_pdf(p) for p in pdf_paths]
+                max_pages = max(len(d) for d in docs)
+                results["page_count"] = max_pages
+
+                for page_num in range(max_pages):
+                    cancel_token.check()
+                    log(f"ページ {page_num + 1}/{max_pages} を解析中...")
+                    with profiler.span("page", "page", page=page_num + 1):
+                        # 各リビジョンのラスタはこのページの全ステップで再利用する
+                        images = [self._render_page_traced(doc, page_num, stem, buffer_name=f"render_{i}")
+                                  for i, (doc, stem) in enumerate(zip(docs, stems))]
+                        for step, step_pages in zip(steps, step_summary_pages):
+                            old_image, new_image = images[step["old_index"]], images[step["new_index"]]
+                            old_missing = page_num >= len(docs[step["old_index"]])
+                            new_missing = page_num >= len(docs[step["new_index"]])
+                            if old_missing and new_missing:
+                                continue  # このステップのどちらのリビジョンにもないページ (他のリビジョンだけにある)
+                            if old_image is None or new_image is None:
+                                page_entry = {"page": page_num + 1, "change_count": None}
+                                if old_missing or new_missing:
+                                    page_entry["status"] = "added" if old_missing else "removed"
+                                step["pages"].append(page_entry)
+                                continue
+                            cancel_token.check()
+                            with profiler.span("step", "step", step=step["step"]):
+                                diff_data = self._detect_pixel_differences(old_image, new_image, pixel_threshold)
+                                change_count = diff_data.get("change_count", 0)
+                                step["pages"].append({"page": page_num + 1, "change_count": change_count})
+                                if diff_data["has_changes"]:
+                                    log(f"  - {step['old']} → {step['new']} ページ {page_num + 1}: {change_count} ピクセルの変更を検出")
+                                    step["total_changes"] += change_count
+                                    images_before = len(results["diff_images"])
+                                    file_prefix = f"{base_filename}_s{step['step']:02d}_{step['old']}_vs_{step['new']}_p{page_num + 1:03d}"
+                                    summary_source = None
+                                    if vector_summary:
+                                        summary_source = {"pdf": summary_keys[step["new_index"]], "page": page_num, "clip": None,
+                                                          "origin": diff_data["new_origin"], "layered": summary_mode == "layered"}
+                                    step_pages.append(self._write_page_outputs(diff_data, file_prefix, sink, results, export_all, display_filter,
+                                                                               summary_source=summary_source))
+                                    step["diff_images"] += results["diff_images"][images_before:]
+                        del images
+                    if profiler.enabled: profiler.counter("memory", rss_bytes=current_rss_bytes())
+
+                cancel_token.check()
+                results["total_changes"] = sum(step["total_changes"] for step in steps)
+                summary_pages = [page for step_pages in step_summary_pages for page in step_pages]
+                if summary_pages:
+                    log("差分画像の統合PDFを作成中...")
+                    with profiler.span("summary_pdf", "encode", pages=len(summary_pages)):
+                        results["summary_pdf"] = self._create_summary_pdf(summary_pages, sink, base_filename, display_filter,
+                                                                          dict(zip(summary_keys, docs)))[0]
+
+                report_path = output_path / f"{base_filename}_report.json"
+                with open(report_path, "w", encoding="utf-8") as f:
+                    json.dump({key: value for key, value in results.items() if key != "diff_images"}, f, ensure_ascii=False, indent=2)
+                results["report"] = str(report_path)
+
+            for step in steps:
+                log(f"  ステップ {step['step']}: {step['old']} → {step['new']}: {step['total_changes']} ピクセル")
+            log(f"リビジョン比較完了: {results['total_changes']} 箇所の変更を検出")
+            return results
+        except JobCancelledError as e:
+            log(f"リビジョン比較を中止: {e}"); self._discard_output(output_path, e); raise
+        except Exception as e:
+            self.logger.error(f"リビジョン比較エラー: {e}"); log(f"エラー: {e}"); raise
+        finally:
+            for doc in docs: doc.close()
+            if profiler.enabled and output_path.exists():
+                results["profile_trace"] = str(profiler.write(output_path / f"{base_filename}_trace.json"))
+            self.profiler = NullProfiler()
+
+    def _discard_output(self, output_path: Path, error: JobCancelledError):
+        """中止したジョブの書きかけの出力 (チェックポイントを含む) を削除する
+
+        リースを失ったワーカー (reason="abandoned") の出力は、引き継いだワーカーが使うため残す。
+        """
+        if error.reason == "abandoned":
+            return
+        shutil.rmtree(output_path, ignore_errors=True)
+        self.logger.info(f"中止したジョブの出力を削除しました: {output_path}")
+
+    def _render_page_traced(self, doc, page_num: int, label: str, clip=None, dpi: int = None, buffer_name: str = None):
+        with self.profiler.span("render", "render", side=label, page=page_num + 1, clipped=clip is not None, dpi=dpi or self.dpi) as span_args:
+            image = self._get_high_res_page(doc, page_num, clip, dpi, buffer_name or f"render_{label}")
+            span_args["bytes"] = 0 if image is None else image.nbytes
+        return image
+
+    def _render_pair_traced(self, renderer: ParallelPageRenderer, old_doc, old_index: int, new_doc, new_index: int, dpi: int):
+        with self.profiler.span("render", "render", side="both", page=new_index + 1, clipped=False, dpi=dpi) as span_args:
+            try:
+                images = renderer.render_pair(old_index, new_index, old_doc[old_index].rect, new_doc[new_index].rect, dpi, self.arena)
+            except Exception as e:
+                self.logger.error(f"高解像度ページ {new_index} 取得エラー: {e}")
+                return None, None
+            span_args["bytes"] = sum(image.nbytes for image in images)
+        return images
+
+    def estimate_page_peak_bytes(self, width_pt: float, height_pt: float, dpi: int = None) -> int:
+        """指定サイズ (pt) の領域を比較するときのピークメモリ使用量の見積もり (バイト)"""
+        dpi = dpi or self.dpi
+        pixels = math.ceil(width_pt * dpi / 72) * math.ceil(height_pt * dpi / 72)
+        return pixels * PEAK_BYTES_PER_PIXEL
+
+    def _compare_regions(self, old_doc, new_doc, old_index: int, new_index: int, regions: List, dpi: int,
+                         pixel_threshold: int, cancel_token: CancellationToken, partial: bool = False) -> Optional[Dict]:
+        """ページを領域 (ページ座標の fitz.Rect) ごとに比較し、ページ全体の差分データにまとめる
+
+        メモリ上限で帯状に分けて比較しても、出力 (差分画像・レイヤー・統合PDF・中間データ) は
+        分けない場合と同じくページ全体の1枚になる。両方のページの大きさが同じであること。
+        partial=True (構造比較で絞り込んだ変更領域) では新版のページ全体をレンダリングして下地にし、
+        領域の外は変更なしとする。戻り値は _detect_pixel_differences と同じ形式 (レンダリングできなければ None)。
+        """
+        arena = self.arena
+        matrix = fitz.Matrix(dpi / 72, dpi / 72)
+        page_box = (new_doc[new_index].rect * matrix).irect
+        shape = (page_box.height, page_box.width)
+        old_gray, new_gray = arena.get("page_old_gray", shape), arena.get("page_new_gray", shape)
+        diff_mask = arena.get("page_diff_mask", shape)
+        diff_mask.fill(0)
+        if partial:
+            base_image = self._render_page_traced(new_doc, new_index, "new", None, dpi, "page_base")
+            if base_image is None:
+                return None
+            cv2.cvtColor(base_image, cv2.COLOR_RGB2GRAY, dst=new_gray)
+            np.copyto(old_gray, new_gray)
+        else:
+            base_image = arena.get("page_base", shape + (3,))
+        for region in regions:
+            cancel_token.check()
+            old_image = self._render_page_traced(old_doc, old_index, "old", region, dpi)
+            new_image = self._render_page_traced(new_doc, new_index, "new", region, dpi)
+            if old_image is None or new_image is None:
+                return None
+            cancel_token.check()
+            tile = self._detect_pixel_differences(old_image, new_image, pixel_threshold)
+            # 領域のレンダリングはページ全体のレンダリングの (region * matrix).irect の位置に当たる
+            box = (region * matrix).irect
+            target = (slice(box.y0, box.y0 + tile["diff_mask"].shape[0]), slice(box.x0, box.x0 + tile["diff_mask"].shape[1]))
+            if not partial:
+                # partial の下地はページ全体のレンダリングのまま (領域だけのレンダリングは陰影がわずかに違うことがある)
+                np.copyto(base_image[target], tile["base_image"])
+            np.copyto(old_gray[target], tile["old_gray"])
+            np.copyto(new_gray[target], tile["new_gray"])
+            np.copyto(diff_mask[target], tile["diff_mask"])
+        # 隣り合う帯は境界の1行が重なることがあるため、変更数はまとめたマスクから数える
+        change_count = int(np.count_nonzero(diff_mask))
+        return {"has_changes": change_count > 0, "change_count": change_count, "base_image": base_image, "old_gray": old_gray,
+                "new_gray": new_gray, "diff_mask": diff_mask, "new_origin": (0, 0)}
+
+    def _plan_page_memory(self, old_rect, new_rect, clip, settings: Dict) -> Dict:
+        """ページのメモリ使用量を見積もり、予算に収まる DPI または分割方法を決める
+
+        settings["memory_budget_mb"] が未設定なら常に既定の DPI を使う。
+        settings["memory_policy"]: "reduce_dpi" (既定) / "tile" / "fail"
+        """
+        region = clip if clip is not None else fitz.Rect(0, 0, max(old_rect.width, new_rect.width), max(old_rect.height, new_rect.height))
+        plan = {"dpi": self.dpi, "tiles": None}
+        budget_mb = settings.get("memory_budget_mb")
+        if not budget_mb:
+            return plan
+        budget = budget_mb * 1024 * 1024
+        # 変更領域だけを比較するときや帯状に分けるときは、結果をページ全体のバッファにまとめる
+        canvas = math.ceil(new_rect.width * self.dpi / 72) * math.ceil(new_rect.height * self.dpi / 72) * PAGE_CANVAS_BYTES_PER_PIXEL
+        estimate = self.estimate_page_peak_bytes(region.width, region.height) + (canvas if clip is not None else 0)
+        if estimate <= budget:
+            return plan
+
+        policy = settings.get("memory_policy", "reduce_dpi")
+        min_dpi = settings.get("min_dpi", 72)
+        too_large = (f"ページの推定メモリ使用量 {estimate / 1024 / 1024:.0f}MB ({region.width:.0f}x{region.height:.0f}pt, {self.dpi} DPI) が"
+                     f"上限 {budget_mb}MB を超えています")
+        if policy == "tile" and (clip is not None or old_rect == new_rect):
+            rows = max(0, budget - canvas) // (math.ceil(region.width * self.dpi / 72) * PEAK_BYTES_PER_PIXEL)
+            band = rows * 72 / self.dpi
+            if band >= MIN_TILE_HEIGHT_PT:
+                source = clip if clip is not None else new_rect
+                plan["tiles"] = [fitz.Rect(source.x0, y, source.x1, min(y + band, source.y1))
+                                 for y in np.arange(source.y0, source.y1, band)]
+                return plan
+            # ページ全体のバッファと最小の帯が上限に収まらない (大判の図面など) ときは DPI を下げる
+        if policy in ("reduce_dpi", "tile"):
+            # 用紙サイズの異なるページは中央揃えで比較するため分割できず、DPI を下げる
+            area = PEAK_BYTES_PER_PIXEL * region.width * region.height
+            if clip is not None:
+                area += PAGE_CANVAS_BYTES_PER_PIXEL * new_rect.width * new_rect.height
+            dpi = int(72 * math.sqrt(budget / area))
+            if dpi < min_dpi:
+                raise MemoryBudgetExceededError(too_large + f" (最低 {min_dpi} DPI でも収まりません)")
+            plan["dpi"] = dpi
+            return plan
+        if policy == "fail":
+            raise MemoryBudgetExceededError(too_large)
+        raise ValueError(f"不明なメモリポリシー: {policy}")
+
+    def _write_page_outputs(self, diff_data: Dict, file_prefix: str, sink, results: Dict,
+                            export_all: bool, display_filter: Dict, dpi: int = None, summary_source: Dict = None) -> Dict:
+        """1ページ分の差分画像を保存し、統合PDFに使うページ (JPEG エンコード済み) を返す
+
+        画像はアリーナのバッファ上にあり次のページで上書きされるため、統合PDF用には圧縮済みのデータだけを残す。
+        summary_source (元のページ) を渡すと、統合PDF用には vector / layered モードの重ね合わせ画像を返す。
+        """
+        profiler = self.profiler
+        if export_all:
+            # 全パターン出力
+            filters_to_export = {
+                "both": {"added": True, "removed": True},
+                "added": {"added": True, "removed": False},
+                "removed": {"added": False, "removed": True},
+            }
+            if summary_source and summary_source.get("layered"):
+                # 追加/削除の切り替えはレイヤー付きの統合PDFで行えるため、PNG は両方を表示したもの1枚にする
+                filters_to_export = {"both": filters_to_export["both"]}
+            for name, current_filter in filters_to_export.items():
+                with profiler.span("overlay", "overlay", pattern=name):
+                    diff_image = self._create_precise_diff_display(diff_data, current_filter)
+                self._save_image(diff_image, sink, f"{file_prefix}_{name}.png", results, dpi)
+                if name == "both" and not summary_source: summary_page = self._encode_summary_page(diff_image, dpi)
+            if summary_source:
+                return self._encode_summary_overlay(diff_data, filters_to_export["both"], dpi, summary_source)
+            return summary_page
+        # 選択されたパターンのみ出力
+        with profiler.span("overlay", "overlay", pattern="selected"):
+            diff_image = self._create_precise_diff_display(diff_data, display_filter)
+        self._save_image(diff_image, sink, f"{file_prefix}.png", results, dpi)
+        if summary_source:
+            return self._encode_summary_overlay(diff_data, display_filter, dpi, summary_source)
+        return self._encode_summary_page(diff_image, dpi)
+
+    def _encode_summary_page(self, image: np.ndarray, dpi: int = None) -> Dict:
+        with self.profiler.span("jpeg_encode", "encode"):
+            # PNG と同じく配列は BGR として書き出される
+            ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, SUMMARY_JPEG_QUALITY])
+        return {"jpeg": encoded.tobytes(), "width": image.shape[1], "height": image.shape[0], "dpi": dpi or self.dpi}
+
+    def _encode_summary_overlay(self, diff_data: Dict, display_filter: Dict, dpi: int, source: Dict) -> Dict:
+        """統合PDFの vector / layered モード用のページ: 元のページへの参照と、変更領域ごとに切り出した透過PNG
+
+        変更のない画素は透明なので、統合PDFでは新版のベクターのページの上に変更画素だけが重なる。
+        rect は元のページ上の位置 (pt)。画像の左上は clip の左上から origin (位置合わせの余白, px) を引いた位置。
+        layered モード (source["layered"]) では追加と削除を別の画像 (kind 付き) にし、表示フィルタに関係なく両方を含める
+        (表示の初期状態はレイヤーのオン/オフで表す)。
+        """
+        dpi = dpi or self.dpi
+        scale = 72 / dpi
+        clip_x, clip_y = source["clip"][:2] if source.get("clip") else (0.0, 0.0)
+        origin_x, origin_y = source.get("origin") or (0, 0)
+        layered = bool(source.get("layered"))
+        kinds = [(kind, color) for kind, color in (("added", self.added_color), ("removed", self.removed_color))
+                 if layered or display_filter.get(kind)]
+        overlays = []
+        with self.profiler.span("summary_overlay", "encode") as span_args:
+            for x, y, width, height in self._change_regions(diff_data["diff_mask"]) if kinds else []:
+                # ページ全体ではなく変更領域の中だけで追加/削除を判定する (_select_changes と同じ規則)
+                region = (slice(y, y + height), slice(x, x + width))
+                changed = diff_data["diff_mask"][region] > 0
+                x0, y0 = clip_x + (x - origin_x) * scale, clip_y + (y - origin_y) * scale
+                rect = [x0, y0, x0 + width * scale, y0 + height * scale]
+                tile = None
+                for kind, color in kinds:
+                    if kind in diff_data:
+                        direction = diff_data[kind][region]
+                    elif kind == "added":
+                        direction = diff_data["new_gray"][region] > diff_data["old_gray"][region]
+                    else:
+                        direction = diff_data["new_gray"][region] < diff_data["old_gray"][region]
+                    if tile is None or layered:
+                        tile = np.zeros((height, width, 4), np.uint8)
+                    tile[changed & direction] = (*color, 255)
+                    if layered and tile[..., 3].any():
+                        overlays.append({"png": encode_png(tile), "rect": rect, "kind": kind})
+                if not layered and tile[..., 3].any():
+                    overlays.append({"png": encode_png(tile), "rect": rect})
+            span_args["regions"] = len(overlays)
+            span_args["bytes"] = sum(len(overlay["png"]) for overlay in overlays)
+        return {"source": source["pdf"], "page": source["page"], "layered": layered, "overlays": overlays}
+
+    def _change_regions(self, diff_mask: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """差分マスクの変更領域の外接矩形 (x, y, 幅, 高さ) の一覧 (近い変更は1つにまとめる)"""
+        height, width = diff_mask.shape
+        cell = SUMMARY_REGION_CELL
+        # セルの整数倍に余白を足してから面積平均で縮小する (整数倍の縮小は速い)。
+        # 変更画素を1つでも含むセルは 0 より大きくなる
+        padded = cv2.copyMakeBorder(diff_mask, 0, -height % cell, 0, -width % cell, cv2.BORDER_CONSTANT, value=0)
+        small = cv2.resize(padded, (padded.shape[1] // cell, padded.shape[0] // cell), interpolation=cv2.INTER_AREA)
+        small = cv2.dilate(np.greater(small, 0).view(np.uint8), np.ones((3, 3), np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(small, connectivity=8)
+        regions = []
+        for x, y, w, h, _ in stats[1:]:
+            x0, y0 = x * cell, y * cell
+            x1, y1 = min(width, (x + w) * cell), min(height, (y + h) * cell)
+            regions.append((int(x0), int(y0), int(x1 - x0), int(y1 - y0)))
+        if len(regions) > SUMMARY_MAX_OVERLAYS:
+            x0, y0 = min(r[0] for r in regions), min(r[1] for r in regions)
+            x1, y1 = max(r[0] + r[2] for r in regions), max(r[1] + r[3] for r in regions)
+            regions = [(x0, y0, x1 - x0, y1 - y0)]
+        return regions
+
+    @staticmethod
+    def _summary_mode(settings: Dict) -> str:
+        mode = settings.get("summary_mode", "raster")
+        if mode not in SUMMARY_MODES:
+            raise ValueError(f"統合PDFのモードが不正です: {mode} ({' / '.join(SUMMARY_MODES)})")
+        return mode
 
     def _detect_pixel_differences(self, old_image: np.ndarray, new_image: np.ndarray, pixel_threshold: int) -> Dict:
-        old_aligned, new_aligned = self._align_images_precise(old_image, new_image)
-        old_gray = cv2.cvtColor(old_aligned, cv2.COLOR_RGB2GRAY)
-        new_gray = cv2.cvtColor(new_aligned, cv2.COLOR_RGB2GRAY)
-        pixel_diff = cv2.absdiff(old_gray, new_gray)
-        _, diff_mask = cv2.threshold(pixel_diff, pixel_threshold, 255, cv2.THRESH_BINARY)
+        """2つの画像の差分を検出する (戻り値の配列はアリーナのバッファで、次のページの比較で上書きされる)"""
+        profiler = self.profiler
+        arena = self.arena
+        with profiler.span("align", "diff"):
+            old_aligned, new_aligned = self._align_images_precise(old_image, new_image)
+        shape = old_aligned.shape[:2]
+        with profiler.span("grayscale", "diff"):
+            old_gray = cv2.cvtColor(old_aligned, cv2.COLOR_RGB2GRAY, dst=arena.get("old_gray", shape))
+            new_gray = cv2.cvtColor(new_aligned, cv2.COLOR_RGB2GRAY, dst=arena.get("new_gray", shape))
+        with profiler.span("absdiff", "diff"):
+            pixel_diff = cv2.absdiff(old_gray, new_gray, dst=arena.get("pixel_diff", shape))
+        diff_mask, change_count = self._mask_from_difference(pixel_diff, pixel_threshold)
+        # 位置合わせで新版の画像の周りに付いた余白 (px)。統合PDFで差分を元のページに重ねる位置に使う
+        new_origin = ((shape[1] - new_image.shape[1]) // 2, (shape[0] - new_image.shape[0]) // 2)
+        return {"has_changes": change_count > 0, "change_count": change_count, "base_image": new_aligned, "old_gray": old_gray, "new_gray": new_gray, "diff_mask": diff_mask,
+                "new_origin": new_origin}
+
+    def _mask_from_difference(self, pixel_diff: np.ndarray, pixel_threshold: int) -> Tuple[np.ndarray, int]:
+        """|new - old| の画像をしきい値処理・ノイズ除去し、差分マスクと変更ピクセル数を返す"""
+        profiler, arena, shape = self.profiler, self.arena, pixel_diff.shape
+        with profiler.span("threshold", "diff"):
+            _, diff_mask = cv2.threshold(pixel_diff, pixel_threshold, 255, cv2.THRESH_BINARY, dst=arena.get("threshold_mask", shape))
         if self.noise_filter_size > 0:
-            kernel = np.ones((self.noise_filter_size, self.noise_filter_size), np.uint8)
-            diff_mask = cv2.morphologyEx(diff_mask, cv2.MORPH_OPEN, kernel)
-        change_count = np.count_nonzero(diff_mask)
-        if change_count == 0: return {"has_changes": False}
-        return {"has_changes": True, "change_count": change_count, "base_image": new_aligned, "old_gray": old_gray, "new_gray": new_gray, "diff_mask": diff_mask}
+            with profiler.span("morphology", "diff", kernel=self.noise_filter_size):
+                kernel = np.ones((self.noise_filter_size, self.noise_filter_size), np.uint8)
+                diff_mask = cv2.morphologyEx(diff_mask, cv2.MORPH_OPEN, kernel, dst=arena.get("diff_mask", shape))
+        return diff_mask, int(np.count_nonzero(diff_mask))
 
     def _create_precise_diff_display(self, diff_data: Dict, display_filter: Dict) -> np.ndarray:
-        result = diff_data["base_image"].copy()
+        base_image, arena = diff_data["base_image"], self.arena
+        result = arena.get("overlay", base_image.shape)
+        np.copyto(result, base_image)
         if not display_filter.get("added") and not display_filter.get("removed"): return result
-        diff_pixels_coords = np.where(diff_data["diff_mask"] > 0)
-        for y, x in zip(diff_pixels_coords[0], diff_pixels_coords[1]):
-            old_val = int(diff_data["old_gray"][y, x])
-            new_val = int(diff_data["new_gray"][y, x])
-            if (new_val > old_val) and display_filter.get("added"): result[y, x] = self.added_color
-            elif (new_val < old_val) and display_filter.get("removed"): result[y, x] = self.removed_color
+        if display_filter.get("added"):
+            result[self._select_changes(diff_data, "added")] = self.added_color
+        if display_filter.get("removed"):
+            result[self._select_changes(diff_data, "removed")] = self.removed_color
         return result
 
-    def _save_image(self, image: np.ndarray, path: Path, results_dict: Dict):
-        Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(path, dpi=(self.dpi, self.dpi), quality=95)
-        results_dict["diff_images"].append(str(path))
+    def _select_changes(self, diff_data: Dict, kind: str) -> np.ndarray:
+        """差分マスクのうち追加 (kind="added") または削除された画素の bool 配列 (アリーナのバッファ)"""
+        shape = diff_data["diff_mask"].shape
+        changed = np.greater(diff_data["diff_mask"], 0, out=self.arena.get("changed", shape, bool))
+        selected = self.arena.get("selected", shape, bool)
+        # 再出力時は保存済みの符号 (added/removed) を、通常はグレースケールの大小を使う
+        if kind in diff_data:
+            direction = diff_data[kind]
+        elif kind == "added":
+            direction = np.greater(diff_data["new_gray"], diff_data["old_gray"], out=selected)
+        else:
+            direction = np.less(diff_data["new_gray"], diff_data["old_gray"], out=selected)
+        return np.logical_and(changed, direction, out=selected)
+
+    def _write_mask_layers(self, diff_data: Dict, file_prefix: str, sink, dpi: int = None) -> Dict:
+        """ブラウザで色付け・重ね合わせするためのレイヤー画像を保存する
+
+        下地はグレースケール、追加/削除はビットパックされた1ビットPNG (変更のない画素は透明) で、
+        表示フィルタの切り替えをサーバーの再処理やフルカラーPNGの再取得なしに行える。
+        """
+        dpi = dpi or self.dpi
+        with self.profiler.span("mask_layers", "encode") as span_args:
+            base_gray = diff_data.get("new_gray")
+            if base_gray is None:
+                base_gray = cv2.cvtColor(diff_data["base_image"], cv2.COLOR_RGB2GRAY, dst=self.arena.get("new_gray", diff_data["diff_mask"].shape))
+            layer = {"width": int(base_gray.shape[1]), "height": int(base_gray.shape[0]), "dpi": dpi}
+            data = encode_png(base_gray, dpi)
+            layer["base"], size = sink.write(f"{file_prefix}_layer_base.png", data), len(data)
+            for kind in ("added", "removed"):
+                mask = self._select_changes(diff_data, kind)
+                layer[f"{kind}_count"] = int(np.count_nonzero(mask))
+                data = encode_mask_png(mask.view(np.uint8), dpi)
+                layer[kind], size = sink.write(f"{file_prefix}_layer_{kind}.png", data), size + len(data)
+            span_args["bytes"] = size
+        return layer
 
-    def _get_high_res_page(self, doc, page_num: int):
+    def _save_image(self, image: np.ndarray, sink, name: str, results_dict: Dict, dpi: int = None):
+        dpi = dpi or self.dpi
+        with self.profiler.span("png_encode", "encode", file=name) as span_args:
+            # 配列は BGR として書き出される (従来の BGR2RGB 変換 + PIL 保存と同じ画素になる)
+            data = encode_png(image, dpi)
+            span_args["bytes"] = len(data)
+            results_dict["diff_images"].append(sink.write(name, data))
+
+    def _get_high_res_page(self, doc, page_num: int, clip=None, dpi: int = None, buffer_name: str = None):
         if not doc or page_num >= len(doc): return None
+        dpi = dpi or self.dpi
         try:
-            page = doc[page_num]; mat = fitz.Matrix(self.dpi/72, self.dpi/72); pix = page.get_pixmap(matrix=mat)
-            img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-            if pix.n == 4: return cv2.cvtColor(img_array, cv2.COLOR_RGBA2RGB)
-            elif pix.n == 1: return cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB)
-            return img_array
+            page = doc[page_num]; mat = fitz.Matrix(dpi/72, dpi/72); pix = page.get_pixmap(matrix=mat, clip=clip)
+            img_array = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            out = self.arena.get(buffer_name or "render", (pix.height, pix.width, 3))
+            if pix.n == 4: return cv2.cvtColor(img_array, cv2.COLOR_RGBA2RGB, dst=out)
+            elif pix.n == 1: return cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB, dst=out)
+            np.copyto(out, img_array)
+            return out
         except Exception as e: self.logger.error(f"高解像度ページ {page_num} 取得エラー: {e}"); return None
 
     def _align_images_precise(self, img1: np.ndarray, img2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # 同じサイズなら余白を付ける必要がないのでそのまま使う (コピーしない)
+        if img1.shape[:2] == img2.shape[:2]: return img1, img2
         h1, w1 = img1.shape[:2]; h2, w2 = img2.shape[:2]; max_h, max_w = max(h1, h2), max(w1, w2)
-        img1_aligned = np.full((max_h, max_w, 3), 255, dtype=np.uint8); img2_aligned = np.full((max_h, max_w, 3), 255, dtype=np.uint8)
+        img1_aligned = self.arena.get("aligned_old", (max_h, max_w, 3)); img2_aligned = self.arena.get("aligned_new", (max_h, max_w, 3))
+        img1_aligned.fill(255); img2_aligned.fill(255)
         y1, x1 = (max_h - h1) // 2, (max_w - w1) // 2; y2, x2 = (max_h - h2) // 2, (max_w - w2) // 2
-        img1_aligned[y1:y1+h1, x1:x1+w1] = img1; img2_aligned[y2:y2+h2, x2:x2+w2] = img2
+        np.copyto(img1_aligned[y1:y1+h1, x1:x1+w1], img1); np.copyto(img2_aligned[y2:y2+h2, x2:x2+w2], img2)
         return img1_aligned, img2_aligned
 
-    def _create_summary_pdf(self, diff_images: List[np.ndarray], output_path: Path, base_filename: str) -> Path:
-        pdf_path = output_path / f"{base_filename}_summary.pdf"
-        if diff_images:
-            images_to_save = [Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)) for img in diff_images]
-            images_to_save[0].save(pdf_path, save_all=True, append_images=images_to_save[1:], dpi=(self.dpi, self.dpi))
-        return pdf_path
+    def _create_summary_pdf(self, summary_pages: List[Dict], sink, base_filename: str,
+                            display_filter: Dict = None, documents: Dict = None) -> Tuple[str, int]:
+        """統合PDFを作る
+
+        JPEG エンコード済みのページ (raster モード) はそのまま埋め込む。vector モードのページは元のPDFの
+        ページをそのまま (ベクターのまま) 描き、変更領域の透過PNGと枠を重ねる。同じページの複数のタイルは1ページにまとめる。
+        layered モードのページは元のページ・追加・削除をそれぞれレイヤー (OCG) に載せ、PDFビューアで切り替えられる
+        ようにする (追加・削除レイヤーの初期状態は display_filter に従う)。
+        元のページは documents (参照 → 開いている文書) にあればそれを使い、なければパスとして開く。
+        sink に書き出した参照とバイト数を返す。
+        """
+        display_filter = display_filter or {"added": True, "removed": True}
+        documents = documents or {}
+        data = b""
+        if summary_pages:
+            sources = {}
+            try:
+                with fitz.open() as summary:
+                    layers = {}
+                    if any(summary_page.get("layered") for summary_page in summary_pages):
+                        layers = {kind: summary.add_ocg(name, on=kind == "base" or bool(display_filter.get(kind)))
+                                  for kind, name in SUMMARY_LAYER_NAMES.items()}
+                    page, page_key = None, None
+                    for summary_page in summary_pages:
+                        if "jpeg" in summary_page:
+                            dpi = summary_page["dpi"]
+                            page = summary.new_page(width=summary_page["width"] * 72 / dpi, height=summary_page["height"] * 72 / dpi)
+                            page.insert_image(page.rect, stream=summary_page["jpeg"])
+                            page_key = None
+                            continue
+                        if (summary_page["source"], summary_page["page"]) != page_key:
+                            page_key = (summary_page["source"], summary_page["page"])
+                            source_doc = documents.get(summary_page["source"])
+                            if source_doc is None:
+                                if summary_page["source"] not in sources:
+                                    sources[summary_page["source"]] = fitz.open(summary_page["source"])
+                                source_doc = sources[summary_page["source"]]
+                            source_rect = source_doc[summary_page["page"]].rect
+                            page = summary.new_page(width=source_rect.width, height=source_rect.height)
+                            page.show_pdf_page(page.rect, source_doc, summary_page["page"],
+                                               oc=layers["base"] if summary_page.get("layered") else 0)
+                        for overlay in summary_page["overlays"]:
+                            rect = fitz.Rect(overlay["rect"])
+                            # layered モードでは枠も追加/削除のレイヤーに載せ、非表示にしたときに一緒に消えるようにする
+                            oc = layers[overlay["kind"]] if "kind" in overlay else 0
+                            page.insert_image(rect, stream=overlay["png"], oc=oc)
+                            page.draw_rect(rect, color=SUMMARY_REGION_COLOR, width=SUMMARY_REGION_WIDTH, oc=oc)
+                    data = summary.tobytes(garbage=3, deflate=True)
+            finally:
+                for source_doc in sources.values(): source_doc.close()
+        return sink.write(f"{base_filename}_summary.pdf", data), len(data)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
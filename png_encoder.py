@@ -0,0 +1,74 @@
+import struct
+import zlib
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from lazy_import import lazy_import
+
+cv2 = lazy_import("cv2")
+
+
+@lru_cache(maxsize=None)
+def fast_png_params() -> tuple:
+    # 白地に線画の図面ではフィルタなし + RLE が、既定設定 (全フィルタ試行 + 通常の deflate) と
+    # ほぼ同じサイズで 3 倍以上速い。IMWRITE_PNG_FILTER は OpenCV 4.11 以降のみ
+    params = [cv2.IMWRITE_PNG_COMPRESSION, 1, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+    if hasattr(cv2, "IMWRITE_PNG_FILTER"):
+        params += [cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_NONE]
+    return tuple(params)
+
+
+@lru_cache(maxsize=None)
+def mask_png_params() -> tuple:
+    # 2値マスクは 1 ビット/画素 (ビットパック) で最大圧縮する。疎なマスクなら数KB
+    return (cv2.IMWRITE_PNG_BILEVEL, 1, cv2.IMWRITE_PNG_COMPRESSION, 9)
+
+# PNG シグネチャ (8バイト) + IHDR チャンク (4+4+13+4 バイト) の直後に補助チャンクを挿入する
+_IHDR_END = 33
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def encode_png(image: np.ndarray, dpi: int = None) -> bytes:
+    """配列を PNG に高速エンコードする (cv2.imwrite と同じくチャンネル順は BGR とみなす)
+
+    dpi を指定すると解像度 (pHYs チャンク) を書き込む。cv2 は PNG の解像度を書き出せないため。
+    """
+    ok, encoded = cv2.imencode(".png", image, fast_png_params())
+    if not ok:
+        raise ValueError("PNG エンコードに失敗しました")
+    data = encoded.tobytes()
+    if dpi:
+        data = data[:_IHDR_END] + _phys_chunk(dpi) + data[_IHDR_END:]
+    return data
+
+
+def encode_mask_png(mask: np.ndarray, dpi: int = None) -> bytes:
+    """2値マスク (0 / 非0) を 1 ビットのグレースケール PNG にする
+
+    値 0 の画素は透明 (tRNS チャンク) になるため、ブラウザでは変更画素だけが白く不透明に描画され、
+    色付けや重ね合わせをクライアント側で行える。
+    """
+    ok, encoded = cv2.imencode(".png", mask, mask_png_params())
+    if not ok:
+        raise ValueError("PNG エンコードに失敗しました")
+    data = encoded.tobytes()
+    chunks = _chunk(b"tRNS", struct.pack(">H", 0)) + (_phys_chunk(dpi) if dpi else b"")
+    return data[:_IHDR_END] + chunks + data[_IHDR_END:]
+
+
+def _phys_chunk(dpi: int) -> bytes:
+    pixels_per_meter = int(round(dpi / 0.0254))
+    return _chunk(b"pHYs", struct.pack(">IIB", pixels_per_meter, pixels_per_meter, 1))
+
+
+def write_png(path: Path, image: np.ndarray, dpi: int = None, mask: bool = False) -> int:
+    """PNG を書き出し、ファイルサイズ (バイト) を返す (mask=True なら encode_mask_png を使う)"""
+    data = encode_mask_png(image, dpi) if mask else encode_png(image, dpi)
+    with open(path, "wb") as f:
+        f.write(data)
+    return len(data)
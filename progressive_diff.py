@@ -0,0 +1,129 @@
+"""
+段階的な比較 (低解像度のプレビューをすぐに出し、300 DPI の結果でページごとに置き換える)
+
+300 DPI の比較は大きな図面で数分かかりますが、変更のほとんどは 72〜100 DPI でも見つかります。
+ProgressiveDiff は文書全体をまず PREVIEW_DPI で比較して結果を公開し、続けて通常の解像度で
+比較しながら、終わったページから順にプレビューの結果を置き換えます。
+
+    runner = ProgressiveDiff(job_dir, settings)
+    preview = runner.preview(old_pdf, new_pdf)    # 数秒。create_pixel_diff_output と同じ形式の結果
+    results = runner.refine(old_pdf, new_pdf)     # 300 DPI。完了したページから progress.json を更新
+
+進み具合は job_dir/progress.json に書き出します (Web の GET /jobs/<job_id> が読む)。
+
+    phase          "preview" → "refining" → "done" (中止は "cancelled"、失敗・制限時間切れは "failed")
+    results        現時点の結果。pages[].resolution はそのページの解像度 ("preview" / "full")、
+                   summary_pdf は完了するまでプレビューのもの
+    pages_refined  300 DPI の結果に置き換わったページ数 (page_count ページ中)
+
+プレビューの出力は job_dir/preview/ に置き、完了したら削除します。
+"""
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from cancellation import JobCancelledError
+from pixel_diff_detector import PixelDiffDetector
+
+PREVIEW_DPI = 96
+PREVIEW_DIR = "preview"
+PROGRESS_FILENAME = "progress.json"
+# プレビューでは再出力・再開・計測用のデータを残さず、表示するパターンだけを出力する
+PREVIEW_SETTINGS = {"save_intermediates": False, "checkpoint": False, "profile": False, "export_all_patterns": False}
+
+
+def _write_json(path: Path, data: Dict):
+    # 読み取り側 (Web の別のワーカー) が書きかけのファイルを読まないよう、一時ファイルから置き換える
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    temp_path.replace(path)
+
+
+def read_progress(job_dir: str) -> Optional[Dict]:
+    """段階的な比較の進み具合 (段階的な比較でなければ None)"""
+    try:
+        with open(Path(job_dir) / PROGRESS_FILENAME, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class ProgressiveDiff:
+    """1つのジョブフォルダでプレビューと通常の解像度の比較を順に行う"""
+
+    def __init__(self, job_dir: str, settings: Dict = None, progress_callback=None):
+        self.job_dir = Path(job_dir)
+        self.settings = dict(settings or {})
+        self.preview_dpi = int(self.settings.get("preview_dpi") or PREVIEW_DPI)
+        self.progress_callback = progress_callback
+        self.state = {}
+
+    def _write(self, **changes):
+        self.state.update(changes, updated_at=datetime.now().isoformat(timespec="seconds"))
+        _write_json(self.job_dir / PROGRESS_FILENAME, self.state)
+
+    def _stopped(self, error: Exception):
+        if isinstance(error, JobCancelledError) and error.reason == "abandoned":
+            return  # 引き継いだワーカーが進み具合を書いている
+        if isinstance(error, JobCancelledError) and error.reason != "deadline":
+            self._write(phase="cancelled", error=str(error))
+            shutil.rmtree(self.job_dir / PREVIEW_DIR, ignore_errors=True)
+        else:
+            # プレビューの結果は残す (失敗を表示しても、それまでの結果は見られるように)
+            self._write(phase="failed", error=str(error))
+
+    def preview(self, old_pdf, new_pdf, cancel_token=None) -> Dict:
+        """文書全体を PREVIEW_DPI で比較して公開し、その結果を返す"""
+        preview_dir = self.job_dir / PREVIEW_DIR
+        shutil.rmtree(preview_dir, ignore_errors=True)
+        detector = PixelDiffDetector()
+        full_dpi, detector.dpi = detector.dpi, self.preview_dpi
+        self._write(phase="preview", preview_dpi=self.preview_dpi, dpi=full_dpi, page_count=None, pages_refined=0, results=None)
+        try:
+            results = detector.create_pixel_diff_output(old_pdf, new_pdf, str(preview_dir), self.progress_callback,
+                                                        dict(self.settings, **PREVIEW_SETTINGS), cancel_token)
+        except Exception as e:
+            self._stopped(e)
+            raise
+        for page in results["pages"]:
+            page["resolution"] = "preview"
+        self._write(phase="refining", page_count=results["page_count"], results=results)
+        return results
+
+    def refine(self, old_pdf, new_pdf, cancel_token=None) -> Dict:
+        """通常の解像度で比較し、終わったページからプレビューの結果を置き換える"""
+        current = self.state["results"]
+        pages = current["pages"]
+        refined = 0
+
+        def page_done(page: Dict):
+            nonlocal refined
+            page = dict(page, resolution="full")
+            if refined < len(pages):
+                pages[refined] = page
+            else:
+                pages.append(page)
+            refined += 1
+            current["diff_images"] = [image for entry in pages for image in entry.get("diff_images", [])]
+            current["total_changes"] = sum(entry.get("change_count") or 0 for entry in pages)
+            self._write(pages_refined=refined, results=current)
+
+        try:
+            results = PixelDiffDetector().create_pixel_diff_output(old_pdf, new_pdf, str(self.job_dir), self.progress_callback,
+                                                                   self.settings, cancel_token, page_callback=page_done)
+        except Exception as e:
+            self._stopped(e)
+            raise
+        for page in results["pages"]:
+            page["resolution"] = "full"
+        self._write(phase="done", page_count=results["page_count"], pages_refined=results["page_count"], results=results)
+        shutil.rmtree(self.job_dir / PREVIEW_DIR, ignore_errors=True)
+        return results
+
+    def run(self, old_pdf, new_pdf, cancel_token=None) -> Dict:
+        """プレビューと通常の解像度の比較を続けて行い、最終的な結果を返す"""
+        self.preview(old_pdf, new_pdf, cancel_token)
+        return self.refine(old_pdf, new_pdf, cancel_token)
@@ -5,6 +5,7 @@ SpotPDF Web Application Launcher
 import os
 import sys
 import logging
+from importlib.util import find_spec
 from pathlib import Path
 
 def setup_environment():
@@ -31,7 +32,7 @@ def setup_environment():
     )
 
 def check_dependencies():
-    """Check if required dependencies are installed."""
+    """Check if required dependencies are installed (without importing them)."""
     required_packages = [
         'flask',
         'werkzeug', 
@@ -47,8 +48,10 @@ def check_dependencies():
     missing_packages = []
     for package in required_packages:
         try:
-            __import__(package)
-        except ImportError:
+            found = find_spec(package) is not None
+        except ModuleNotFoundError:  # parent package of a dotted name is missing
+            found = False
+        if not found:
             missing_packages.append(package)
     
     if missing_packages:
@@ -58,6 +61,18 @@ def check_dependencies():
         print("\nInstall them with: pip install -r requirements_web.txt")
         sys.exit(1)
 
+def run_production():
+    """Replace this process with gunicorn (preforked, warm workers; see gunicorn.conf.py)."""
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print("gunicorn is not installed. Install it with: pip install -r requirements_web.txt")
+        sys.exit(1)
+    
+    print("Starting SpotPDF Web Application with gunicorn...")
+    sys.stdout.flush()
+    os.execvp(sys.executable, [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'web_app:app'])
+
 def main():
     """Main function to run the web application."""
     print("=" * 50)
@@ -74,7 +89,10 @@ def main():
         print("Please ensure the configuration file exists with Google OAuth settings.")
         sys.exit(1)
     
-    # Import and run the web app
+    if '--production' in sys.argv[1:]:
+        run_production()
+    
+    # Import and run the web app (development server)
     try:
         from web_app import app
         
@@ -0,0 +1,255 @@
+"""
+プロセス間でページラスタをコピーせずに受け渡すための共有メモリバッファプール
+
+レンダリング用ワーカーは PyMuPDF のピクセルデータを共有メモリ上のバッファへ直接書き込み、
+差分用ワーカーは同じバッファを NumPy のビューとして読み出します。プロセス間で受け渡すのは
+小さな RasterHandle (共有メモリ名・形状) だけなので、数百MBの配列を pickle せずに済みます。
+
+プール (SharedRasterPool) は親プロセスが所有し、バッファの参照カウントを管理します。
+参照がなくなったバッファは破棄せずに空きリストへ戻し、次のページで再利用します。
+
+    with SharedRasterPool() as pool, ProcessPoolExecutor() as executor:
+        handle = pool.acquire(raster_shape(page_rect, dpi))
+        executor.submit(render_page_into, handle, pdf_path, page_index, dpi).result()
+        ...
+        pool.release(handle)
+
+ワーカーはタスクの間だけバッファにアタッチします (アタッチしたままのプロセスがあると、プールが
+バッファを破棄しても共有メモリが解放されないため)。PixelDiffDetector は settings["render_processes"]
+を指定すると ParallelPageRenderer で旧版・新版のページを同時にレンダリングします。
+"""
+import math
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# バッファ容量を丸める単位。近いサイズのページでバッファを使い回せるようにする
+ALLOCATION_GRANULARITY = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class RasterHandle:
+    """共有メモリ上のラスタを指す pickle 可能なハンドル"""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str = "uint8"
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # 所有者ではないプロセスでは resource_tracker に登録しない。登録すると、ワーカー側の
+    # トラッカーが終了時に親の使用中のバッファを「リーク」とみなして unlink してしまう
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _with_views(handles: Sequence[RasterHandle], func: Callable):
+    """ハンドルのバッファにアタッチし、NumPy のビュー (コピーなし) を func に渡して戻り値を返す
+
+    func が戻ったら切り離すため、ビューを戻り値などで持ち出さないこと。
+    """
+    segments = [_attach(handle.name) for handle in handles]
+    try:
+        return func(*[np.ndarray(handle.shape, dtype=handle.dtype, buffer=shm.buf) for handle, shm in zip(handles, segments)])
+    finally:
+        for shm in segments:
+            try:
+                shm.close()
+            except BufferError:
+                pass  # 例外のトレースバックがビューを参照している。ビューとともに回収されるときに閉じる
+
+
+def raster_shape(page_rect, dpi: int, channels: int = 3) -> Tuple[int, int, int]:
+    """page.get_pixmap(matrix=Matrix(dpi/72, dpi/72)) が返すピクセルマップの形状"""
+    import fitz  # PyMuPDF
+    zoom = dpi / 72
+    irect = (fitz.Rect(page_rect) * fitz.Matrix(zoom, zoom)).irect
+    return (irect.height, irect.width, channels)
+
+
+class SharedRasterPool:
+    """参照カウント付きの共有メモリバッファプール (親プロセスで使用)"""
+
+    def __init__(self, max_free_bytes: int = 2 * 1024 ** 3):
+        self.max_free_bytes = max_free_bytes
+        self._lock = threading.Lock()
+        self._blocks: Dict[str, shared_memory.SharedMemory] = {}
+        self._refcounts: Dict[str, int] = {}
+        self._free: List[str] = []
+        self.stats = {"allocated": 0, "reused": 0, "released": 0}
+
+    def acquire(self, shape: Tuple[int, ...], dtype: str = "uint8") -> RasterHandle:
+        """shape を格納できるバッファを確保し、参照カウント 1 のハンドルを返す"""
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with self._lock:
+            # 容量が足りる空きバッファのうち最小のものを再利用する
+            candidates = [name for name in self._free if self._blocks[name].size >= nbytes]
+            if candidates:
+                name = min(candidates, key=lambda n: self._blocks[n].size)
+                self._free.remove(name)
+                self.stats["reused"] += 1
+            else:
+                size = max(ALLOCATION_GRANULARITY, math.ceil(nbytes / ALLOCATION_GRANULARITY) * ALLOCATION_GRANULARITY)
+                shm = shared_memory.SharedMemory(create=True, size=size)
+                name = shm.name
+                self._blocks[name] = shm
+                self.stats["allocated"] += 1
+            self._refcounts[name] = 1
+        return RasterHandle(name, tuple(int(v) for v in shape), dtype)
+
+    def retain(self, handle: RasterHandle) -> RasterHandle:
+        """別の利用者がハンドルを保持する場合に参照カウントを増やす"""
+        with self._lock:
+            if self._refcounts.get(handle.name, 0) <= 0:
+                raise ValueError(f"解放済みのバッファです: {handle.name}")
+            self._refcounts[handle.name] += 1
+        return handle
+
+    def release(self, handle: RasterHandle):
+        """参照カウントを減らし、0 になったバッファを再利用待ちに戻す"""
+        with self._lock:
+            count = self._refcounts.get(handle.name, 0) - 1
+            if count < 0:
+                raise ValueError(f"解放済みのバッファです: {handle.name}")
+            self._refcounts[handle.name] = count
+            if count > 0:
+                return
+            self.stats["released"] += 1
+            self._free.append(handle.name)
+            # 空きバッファが多すぎる場合は大きいものから破棄する
+            free_bytes = sum(self._blocks[n].size for n in self._free)
+            while free_bytes > self.max_free_bytes and self._free:
+                largest = max(self._free, key=lambda n: self._blocks[n].size)
+                free_bytes -= self._blocks[largest].size
+                self._free.remove(largest)
+                self._destroy(largest)
+
+    def view(self, handle: RasterHandle) -> np.ndarray:
+        """親プロセス側でハンドルのバッファをビューとして参照する"""
+        return np.ndarray(handle.shape, dtype=handle.dtype, buffer=self._blocks[handle.name].buf)
+
+    def _destroy(self, name: str):
+        shm = self._blocks.pop(name)
+        self._refcounts.pop(name, None)
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        """すべてのバッファを破棄する"""
+        with self._lock:
+            for name in list(self._blocks):
+                self._destroy(name)
+            self._free.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class ParallelPageRenderer:
+    """旧版・新版のページを別々のワーカープロセスで同時にレンダリングする (親プロセスで使用)
+
+    ワーカーはプールのバッファへ直接書き込み、親は受け取り先 (BufferArena のバッファ) へ1回コピーして
+    すぐにバッファをプールへ戻す。ページ配列の pickle は発生しない。入力はファイルのパスに限る。
+    """
+
+    def __init__(self, old_pdf: str, new_pdf: str, processes: int = 2):
+        self.paths = (str(old_pdf), str(new_pdf))
+        self.pool = SharedRasterPool()
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+
+    def render_pair(self, old_index: int, new_index: int, old_rect, new_rect, dpi: int, arena) -> Tuple[np.ndarray, np.ndarray]:
+        """2ページをレンダリングし、arena の "render_old" / "render_new" バッファの RGB 配列を返す"""
+        handles = [self.pool.acquire(raster_shape(rect, dpi)) for rect in (old_rect, new_rect)]
+        try:
+            futures = [self.executor.submit(render_page_into, handle, path, index, dpi)
+                       for handle, path, index in zip(handles, self.paths, (old_index, new_index))]
+            for future in futures:
+                future.result()
+            images = []
+            for label, handle in zip(("old", "new"), handles):
+                image = arena.get(f"render_{label}", handle.shape)
+                np.copyto(image, self.pool.view(handle))
+                images.append(image)
+            return images[0], images[1]
+        finally:
+            for handle in handles:
+                self.pool.release(handle)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+# --- ワーカープロセスで実行する関数 ---
+
+# ワーカープロセスごとに開いたPDF (ページごとに開き直さない)
+_documents: Dict[str, "fitz.Document"] = {}
+
+
+def render_page_into(handle: RasterHandle, pdf_path: str, page_index: int, dpi: int) -> Tuple[int, ...]:
+    """ページをレンダリングし、ピクセルデータをハンドルのバッファへ書き込む
+
+    pix.samples (bytes へのコピー) ではなく pix.samples_mv を使い、
+    MuPDF のピクセルバッファから共有メモリへの 1 回のコピーだけで済ませる。
+    """
+    import fitz  # PyMuPDF
+    doc = _documents.get(pdf_path)
+    if doc is None:
+        doc = _documents[pdf_path] = fitz.open(pdf_path)
+    zoom = dpi / 72
+    pix = doc[page_index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    shape = (pix.height, pix.width, pix.n)
+    if shape != tuple(handle.shape):
+        raise ValueError(f"バッファの形状 {handle.shape} とページの形状 {shape} が一致しません")
+    _with_views([handle], lambda target: np.copyto(target, np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(shape)))
+    return shape
+
+
+def diff_shared(old_handle: RasterHandle, new_handle: RasterHandle, pixel_threshold: int,
+                mask_handle: RasterHandle = None, noise_filter_size: int = 2) -> int:
+    """共有メモリ上の2つのラスタを比較し、変更ピクセル数を返す
+
+    mask_handle を渡すと差分マスクをそのバッファへ書き込む (親プロセスで出力画像を作る場合)。
+    """
+    import cv2
+    if old_handle.shape != new_handle.shape:
+        raise ValueError("diff_shared は同じ形状のラスタのみ比較できます")
+
+    def compare(old_image: np.ndarray, new_image: np.ndarray, mask: np.ndarray = None) -> int:
+        old_gray = cv2.cvtColor(old_image, cv2.COLOR_RGB2GRAY)
+        new_gray = cv2.cvtColor(new_image, cv2.COLOR_RGB2GRAY)
+        if mask is None:
+            mask = np.empty_like(old_gray)
+        cv2.absdiff(old_gray, new_gray, dst=old_gray)
+        cv2.threshold(old_gray, pixel_threshold, 255, cv2.THRESH_BINARY, dst=mask)
+        if noise_filter_size > 0:
+            kernel = np.ones((noise_filter_size, noise_filter_size), np.uint8)
+            cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, dst=mask)
+        return int(np.count_nonzero(mask))
+
+    return _with_views([old_handle, new_handle] + ([mask_handle] if mask_handle is not None else []), compare)
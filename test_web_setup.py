@@ -14,6 +14,27 @@ def test_file_structure():
         'web_app.py',
         'run_web.py', 
         'pixel_diff_detector.py',
+        'diff_profiler.py',
+        'batch_diff.py',
+        'page_matcher.py',
+        'vector_prediff.py',
+        'shared_raster_pool.py',
+        'buffer_arena.py',
+        'diff_intermediates.py',
+        'png_encoder.py',
+        'gunicorn.conf.py',
+        'lazy_import.py',
+        'job_queue.py',
+        'diff_worker.py',
+        'job_checkpoint.py',
+        'cancellation.py',
+        'google_token_verifier.py',
+        'loadtest.py',
+        'upload_store.py',
+        'hot_folder.py',
+        'diff_io.py',
+        'capacity.py',
+        'progressive_diff.py',
         'templates/base.html',
         'templates/login.html',
         'templates/index.html',
@@ -114,6 +135,36 @@ def test_config_file():
         print(f"[ERROR] Configuration file error: {e}")
         return False
 
+def test_revision_chain_missing_pages():
+    """Test page labels of a revision chain whose revisions have different page counts."""
+    print("\nTesting revision chain page labels...")
+
+    import tempfile
+    import fitz
+    from pixel_diff_detector import PixelDiffDetector
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # rev1 and rev2 have 1 page, rev3 adds page 2, rev4 removes it again
+        paths = []
+        for index, page_count in enumerate((1, 1, 2, 1), 1):
+            doc = fitz.open()
+            for page_no in range(page_count):
+                doc.new_page().insert_text((72, 72), f"page {page_no + 1}")
+            paths.append(str(Path(tmp) / f"rev{index}.pdf"))
+            doc.save(paths[-1])
+            doc.close()
+        results = PixelDiffDetector().create_revision_chain_output(paths, tmp, settings={"compare_to_first": True})
+
+    labels = {(step["old"], step["new"]): {page["page"]: page.get("status") for page in step["pages"]}
+              for step in results["steps"]}
+    expected = {("rev1", "rev2"): {1: None}, ("rev2", "rev3"): {1: None, 2: "added"},
+                ("rev3", "rev4"): {1: None, 2: "removed"}, ("rev1", "rev3"): {1: None, 2: "added"},
+                ("rev1", "rev4"): {1: None}}
+    # Page 2 exists in neither rev1 nor rev2 (nor rev4), so those steps must not report it
+    assert labels == expected, labels
+    print("[OK] Pages are labelled by the revision that lacks them")
+    return True
+
 def main():
     """Run all tests."""
     print("=" * 50)
@@ -124,7 +175,8 @@ def main():
         test_file_structure,
         test_directories,  
         test_core_imports,
-        test_config_file
+        test_config_file,
+        test_revision_chain_missing_pages
     ]
     
     results = []
@@ -0,0 +1,261 @@
+"""
+内容のハッシュで管理するアップロード置き場 (分割・再開できるアップロードと重複排除)
+
+クライアントはファイル全体の SHA-256 とサイズを先に送ります。同じ利用者が同じ内容を既に
+アップロードしていれば省略し、なければ決まった大きさのチャンクに分けて送ります。接続が切れても
+begin() をもう一度呼べば、まだ届いていないチャンクだけが返ってくるため、続きから送れます。
+
+    store = UploadStore("uploads/store")
+    state = store.begin(sha256, size, "base.pdf", owner=email)   # {"file_id", "complete", "chunk_size", "missing"}
+    for index in state["missing"]:
+        store.put_chunk(sha256, index, data, owner=email)
+    store.finish(sha256, owner=email)                            # 結合して SHA-256 を確認
+    info = store.info(sha256, owner=email)                       # 自分がアップロードしていなければ None
+
+ファイルの内容は利用者をまたいで1つだけ保存しますが、使えるのは実際に内容を送り終えた利用者だけです
+(ハッシュを知っているだけでは complete にならず、ファイル名もそれぞれの利用者が送ったものを返す)。
+
+配置 (file_id はファイル全体の SHA-256 の16進表記):
+
+    blobs/ab/<file_id>.pdf                   完成したファイル (最終更新時刻 = 最後に使われた時刻)
+    blobs/ab/<file_id>.owners/<owner>.json   送り終えた利用者ごとの元のファイル名
+    partial/<owner>/<file_id>/meta.json      アップロード途中のファイルのサイズ・チャンクの大きさ
+    partial/<owner>/<file_id>/000012         届いたチャンク (一時ファイルに書いてから置き換える)
+
+<owner> は利用者 (owner 引数) のハッシュです。途中のアップロードも利用者ごとに分けるため、
+他の利用者のチャンクを使って完成させることはできません。
+
+完成したファイルは最後に使われてから retention 秒、途中のアップロードは最後のチャンクから
+partial_retention 秒で cleanup() により削除されます。書き込みはすべて一時ファイルからの
+置き換えなので、gunicorn の複数のワーカーやコンテナが同じ置き場を共有できます。
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_RETENTION = 7 * 24 * 3600
+DEFAULT_PARTIAL_RETENTION = 24 * 3600
+CLEANUP_INTERVAL = 600
+FILE_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class IncompleteUploadError(Exception):
+    """チャンクが揃っていない (missing にまだ届いていないチャンクの番号)"""
+
+    def __init__(self, message: str, missing: List[int]):
+        super().__init__(message)
+        self.missing = missing
+
+
+def _write_atomic(path: Path, data: bytes):
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    temp_path.write_bytes(data)
+    temp_path.replace(path)
+
+
+class UploadStore:
+    """SHA-256 をキーにしたアップロード置き場"""
+
+    def __init__(self, root: str, chunk_size: int = DEFAULT_CHUNK_SIZE, max_size: int = None,
+                 retention: float = DEFAULT_RETENTION, partial_retention: float = DEFAULT_PARTIAL_RETENTION):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.retention = retention
+        self.partial_retention = partial_retention
+        self._last_cleanup = 0.0
+        (self.root / "blobs").mkdir(parents=True, exist_ok=True)
+        (self.root / "partial").mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def validate_id(file_id: str) -> str:
+        file_id = str(file_id).lower()
+        if not FILE_ID_PATTERN.match(file_id):
+            raise ValueError("file_id は SHA-256 の16進表記 (64文字) で指定してください")
+        return file_id
+
+    @staticmethod
+    def _owner_key(owner: str) -> str:
+        return hashlib.sha256(str(owner or "").encode("utf-8")).hexdigest()[:32]
+
+    def _blob(self, file_id: str) -> Path:
+        return self.root / "blobs" / file_id[:2] / f"{file_id}.pdf"
+
+    def _owner_record(self, file_id: str, owner: str) -> Path:
+        return self._blob(file_id).with_suffix(".owners") / f"{self._owner_key(owner)}.json"
+
+    def _partial(self, file_id: str, owner: str) -> Path:
+        return self.root / "partial" / self._owner_key(owner) / file_id
+
+    def _chunk_count(self, size: int, chunk_size: int) -> int:
+        return max(1, -(-size // chunk_size))
+
+    def info(self, file_id: str, owner: str = None) -> Optional[Dict]:
+        """owner がアップロードを完了したファイルの情報 (なければ None)"""
+        file_id = self.validate_id(file_id)
+        blob = self._blob(file_id)
+        try:
+            meta = json.loads(self._owner_record(file_id, owner).read_text(encoding="utf-8"))
+            size = blob.stat().st_size
+        except (OSError, ValueError):
+            return None
+        return {"file_id": file_id, "size": size, "filename": meta.get("filename") or f"{file_id[:12]}.pdf"}
+
+    def path(self, file_id: str) -> Path:
+        """完成したファイルのパス。使われた時刻を更新して保持期間を延ばす (なければ FileNotFoundError)"""
+        file_id = self.validate_id(file_id)
+        blob = self._blob(file_id)
+        try:
+            os.utime(blob)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"アップロードされたファイルが見つかりません: {file_id}")
+        return blob
+
+    def begin(self, file_id: str, size: int, filename: str = "", owner: str = None) -> Dict:
+        """アップロードを開始 (または再開) し、送る必要のあるチャンクを返す
+
+        owner が同じ内容を既にアップロードしていれば complete=True (送信不要)。他の利用者だけが
+        持っている内容は、内容を持っていることを示すために最初から送る必要がある。
+        """
+        file_id = self.validate_id(file_id)
+        size = int(size)
+        if size <= 0:
+            raise ValueError("size は1以上で指定してください")
+        if self.max_size and size > self.max_size:
+            raise ValueError(f"ファイルが大きすぎます (最大 {self.max_size // (1024 * 1024)}MB)")
+        self.maybe_cleanup()
+
+        info = self.info(file_id, owner)
+        if info is not None:
+            if info["size"] != size:
+                raise ValueError("同じハッシュの既存のファイルとサイズが一致しません")
+            self.path(file_id)
+            return dict(info, complete=True, chunk_size=self.chunk_size, missing=[])
+
+        directory = self._partial(file_id, owner)
+        meta_path = directory / "meta.json"
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            meta = None
+        if meta is None or meta["size"] != size:
+            # 初回、またはサイズの違う申告 (書きかけのチャンクは使えない) は最初から
+            shutil.rmtree(directory, ignore_errors=True)
+            directory.mkdir(parents=True, exist_ok=True)
+            meta = {"size": size, "chunk_size": self.chunk_size, "filename": os.path.basename(filename or "")}
+            _write_atomic(meta_path, json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        return {"file_id": file_id, "size": size, "filename": meta["filename"], "complete": False,
+                "chunk_size": meta["chunk_size"], "missing": self._missing(directory, meta)}
+
+    def _missing(self, directory: Path, meta: Dict) -> List[int]:
+        count = self._chunk_count(meta["size"], meta["chunk_size"])
+        received = {int(p.name) for p in directory.iterdir() if p.name.isdigit()}
+        return [index for index in range(count) if index not in received]
+
+    def _meta(self, file_id: str, owner: str) -> Dict:
+        try:
+            return json.loads((self._partial(file_id, owner) / "meta.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            raise FileNotFoundError(f"開始されていないアップロードです: {file_id}")
+
+    def put_chunk(self, file_id: str, index: int, data: bytes, chunk_sha256: str = None, owner: str = None) -> int:
+        """チャンクを保存し、残りのチャンク数を返す (同じチャンクの再送は上書き)"""
+        file_id = self.validate_id(file_id)
+        meta = self._meta(file_id, owner)
+        count = self._chunk_count(meta["size"], meta["chunk_size"])
+        if not 0 <= index < count:
+            raise ValueError(f"チャンク番号は 0〜{count - 1} で指定してください")
+        expected = meta["chunk_size"] if index < count - 1 else meta["size"] - meta["chunk_size"] * (count - 1)
+        if len(data) != expected:
+            raise ValueError(f"チャンク {index} の大きさが違います ({len(data)} バイト、正しくは {expected} バイト)")
+        if chunk_sha256 and hashlib.sha256(data).hexdigest() != chunk_sha256.lower():
+            raise ValueError(f"チャンク {index} のハッシュが一致しません (転送中に壊れた可能性があります)")
+        directory = self._partial(file_id, owner)
+        _write_atomic(directory / f"{index:06d}", data)
+        return len(self._missing(directory, meta))
+
+    def finish(self, file_id: str, owner: str = None) -> Dict:
+        """チャンクを結合して SHA-256 を確認し、完成したファイルとして owner に登録する"""
+        file_id = self.validate_id(file_id)
+        info = self.info(file_id, owner)
+        if info is not None:
+            return info
+        meta = self._meta(file_id, owner)
+        directory = self._partial(file_id, owner)
+        missing = self._missing(directory, meta)
+        if missing:
+            raise IncompleteUploadError(f"{len(missing)} 個のチャンクが届いていません", missing)
+
+        blob = self._blob(file_id)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = blob.with_name(f".{blob.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        digest = hashlib.sha256()
+        with open(temp_path, "wb") as out:
+            for index in range(self._chunk_count(meta["size"], meta["chunk_size"])):
+                data = (directory / f"{index:06d}").read_bytes()
+                digest.update(data)
+                out.write(data)
+        if digest.hexdigest() != file_id:
+            temp_path.unlink()
+            shutil.rmtree(directory, ignore_errors=True)
+            raise ValueError("結合したファイルのハッシュが一致しません (最初からアップロードし直してください)")
+        # 他の利用者が同じ内容を登録済みでも置き換えてよい (内容は同じ)
+        temp_path.replace(blob)
+        record = self._owner_record(file_id, owner)
+        record.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomic(record, json.dumps({"filename": meta["filename"]}, ensure_ascii=False).encode("utf-8"))
+        shutil.rmtree(directory, ignore_errors=True)
+        return self.info(file_id, owner)
+
+    def link_into(self, file_id: str, directory: str, filename: str) -> str:
+        """完成したファイルを directory に置く (ハードリンク、できなければコピー)。置いたパスを返す"""
+        source = self.path(file_id)
+        target = os.path.join(directory, filename)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+        return target
+
+    def maybe_cleanup(self):
+        """前回から CLEANUP_INTERVAL 秒以上経っていれば cleanup() する"""
+        now = time.time()
+        if now - self._last_cleanup >= CLEANUP_INTERVAL:
+            self._last_cleanup = now
+            self.cleanup(now)
+
+    def cleanup(self, now: float = None) -> int:
+        """保持期間を過ぎたファイルと途中のアップロードを削除し、削除した数を返す"""
+        now = now or time.time()
+        removed = 0
+        for blob in (self.root / "blobs").glob("*/*.pdf"):
+            try:
+                if now - blob.stat().st_mtime > self.retention:
+                    blob.unlink()
+                    shutil.rmtree(blob.with_suffix(".owners"), ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        for directory in (self.root / "partial").glob("*/*"):
+            if not directory.is_dir():
+                continue
+            try:
+                latest = max(p.stat().st_mtime for p in directory.iterdir()) if any(directory.iterdir()) else 0
+            except (FileNotFoundError, ValueError):
+                continue
+            if now - latest > self.partial_retention:
+                shutil.rmtree(directory, ignore_errors=True)
+                removed += 1
+        for owner_directory in (self.root / "partial").iterdir():
+            try:
+                owner_directory.rmdir()  # 空になった利用者のフォルダ
+            except OSError:
+                pass
+        return removed
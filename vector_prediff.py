@@ -0,0 +1,216 @@
+import hashlib
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from lazy_import import lazy_import
+
+fitz = lazy_import("fitz")  # PyMuPDF
+
+# 座標の丸め (pt)。PDF 書き出し時の浮動小数点誤差を差分とみなさないため
+COORD_PRECISION = 2
+# 変更領域の周囲に付ける余白 (pt)。アンチエイリアスや線幅のはみ出し分
+REGION_PADDING = 3.0
+# ページ面積に対する画像の占有率がこれを超えたらスキャン/画像主体とみなす
+IMAGE_COVERAGE_LIMIT = 0.5
+# 変更領域の合計がページのこの割合を超えたら全面ラスタの方が効率的
+MAX_REGION_COVERAGE = 0.6
+# 描画パスの属性のうち比較キーに入れないもの (形状と外接矩形は別に比較し、seqno は描画順の番号)
+PATH_GEOMETRY_KEYS = {"items", "rect", "seqno"}
+# get_drawings() に現れない描画属性 (ブレンドモード・ソフトマスク) を使うグラフィックス状態
+UNCOVERED_GRAPHICS_STATE = re.compile(rb"/BM\s*(?!/Normal\b|/Compatible\b)\S|/SMask\s*(?!/None\b)\S")
+
+
+def _r(value: float) -> float:
+    return round(value, COORD_PRECISION)
+
+
+def _point_key(p) -> Tuple:
+    return (_r(p.x), _r(p.y))
+
+
+def _rect_key(rect) -> Tuple:
+    return (_r(rect.x0), _r(rect.y0), _r(rect.x1), _r(rect.y1))
+
+
+def _item_key(item) -> Tuple:
+    kind, *args = item
+    key = [kind]
+    for arg in args:
+        if isinstance(arg, fitz.Point): key.append(_point_key(arg))
+        elif isinstance(arg, fitz.Rect): key.append(_rect_key(arg))
+        elif isinstance(arg, fitz.Quad): key.append(tuple(_point_key(p) for p in (arg.ul, arg.ur, arg.ll, arg.lr)))
+        else: key.append(arg)
+    return tuple(key)
+
+
+def _color_key(color):
+    return None if color is None else tuple(_r(c) for c in color)
+
+
+def _value_key(value):
+    if isinstance(value, float):
+        return _r(value)
+    if isinstance(value, (tuple, list)):
+        return tuple(_value_key(v) for v in value)
+    return value if value is None or isinstance(value, (str, int, bool)) else repr(value)
+
+
+def _path_key(path: Dict) -> Tuple:
+    # 色・線幅・破線・線端・線の結合・不透明度・塗りの規則・レイヤーなど、形状以外の属性はすべてキーに入れる
+    # (PyMuPDF が属性を増やしても、比較から漏れずに差分として扱われるように)
+    style = tuple(sorted((name, _value_key(value)) for name, value in path.items() if name not in PATH_GEOMETRY_KEYS))
+    return ("path", style, tuple(_item_key(item) for item in path["items"]))
+
+
+def uses_uncovered_graphics_state(page) -> bool:
+    """get_drawings() の属性に現れないブレンドモードやソフトマスクをページ (またはフォーム) が使うか"""
+    doc = page.parent
+    for xref in [page.xref] + [xobject[0] for xobject in page.get_xobjects()]:
+        kind, value = doc.xref_get_key(xref, "Resources/ExtGState")
+        if kind == "xref":
+            value = doc.xref_object(int(value.split()[0]), compressed=True)
+        elif kind != "dict":
+            continue
+        states = [value] + [doc.xref_object(int(ref), compressed=True) for ref in re.findall(r"(\d+) 0 R", value)]
+        if any(UNCOVERED_GRAPHICS_STATE.search(state.encode()) for state in states):
+            return True
+    return False
+
+
+def page_elements(page) -> Counter:
+    """ページの描画パス・テキストスパン・画像・注釈を (比較キー -> 外接矩形) の多重集合にする"""
+    elements = Counter()
+    for path in page.get_drawings():
+        elements[(_path_key(path), _rect_key(path["rect"]))] += 1
+    for block in page.get_text("dict")["blocks"]:
+        for line in block.get("lines", []):
+            for span in line["spans"]:
+                key = ("text", span["text"], span["font"], _r(span["size"]), span["color"], span.get("flags"), span.get("alpha"))
+                elements[(key, _rect_key(fitz.Rect(span["bbox"])))] += 1
+    for info in page.get_image_info(hashes=True):
+        key = ("image", info.get("digest"), tuple(_r(v) for v in info.get("transform", ())))
+        elements[(key, _rect_key(fitz.Rect(info["bbox"])))] += 1
+    for annot in page.annots() or []:
+        key = ("annot", annot.type[0], annot.info.get("content"), _color_key(annot.colors.get("stroke")))
+        elements[(key, _rect_key(annot.rect))] += 1
+    return elements
+
+
+# 間接参照 ("12 0 R")。xref 番号は版ごとに振り直されるため、参照先の内容のハッシュに置き換えて比較する
+OBJECT_REF = re.compile(r"(\d+) (\d+) R")
+# 親へ戻る参照 (ページツリー・注釈のページ)。たどるとページの内容と無関係な文書全体に広がる
+PARENT_REF = re.compile(r"/(?:Parent|P)\s*\d+ \d+ R")
+
+
+def _object_digest(doc, xref: int, memo: Dict) -> str:
+    """オブジェクトとその参照先すべて (ストリームの生データを含む) のハッシュ。xref 番号には依存しない"""
+    if xref in memo:
+        return memo[xref]
+    memo[xref] = "cycle"  # 循環参照
+    digest = hashlib.sha1(_resolve_refs(doc, PARENT_REF.sub("", doc.xref_object(xref, compressed=True)), memo).encode())
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref) or b"")
+    memo[xref] = digest.hexdigest()
+    return memo[xref]
+
+
+def _resolve_refs(doc, text: str, memo: Dict) -> str:
+    return OBJECT_REF.sub(lambda m: _object_digest(doc, int(m.group(1)), memo), text)
+
+
+def _page_resources(doc, xref: int) -> str:
+    # ページに Resources がなければページツリーの祖先から継承する
+    while True:
+        kind, value = doc.xref_get_key(xref, "Resources")
+        if kind != "null":
+            return value
+        kind, value = doc.xref_get_key(xref, "Parent")
+        if kind != "xref":
+            return ""
+        xref = int(value.split()[0])
+
+
+def page_content_digest(page, memo: Dict = None) -> str:
+    """ページの描画内容のハッシュ (一致すれば描画結果も同じとみなしてラスタ比較を省略できる)
+
+    ページ寸法・回転、コンテンツストリーム、リソース辞書全体 (フォント・画像/フォーム・
+    グラフィックス状態・色空間・パターンなど、参照先をすべてたどる)、注釈の辞書と外観から計算する。
+    描画に使うものはすべて含むため、描画結果が変わればハッシュも変わる。内容が同じでも別の手順で
+    書き出し直した PDF では一致しないことがあるが、その場合はラスタ比較に回るだけである。
+    memo には同じ文書のページ間で共有するオブジェクト (フォントなど) のハッシュを保持する (文書ごとに1つの dict)。
+    """
+    doc = page.parent
+    memo = {} if memo is None else memo
+    digest = hashlib.sha1()
+    digest.update(repr((_rect_key(page.rect), page.rotation)).encode())
+    digest.update(page.read_contents())
+    digest.update(_resolve_refs(doc, _page_resources(doc, page.xref), memo).encode())
+    for annot in page.annots() or []:
+        digest.update(_object_digest(doc, annot.xref, memo).encode())
+    return digest.hexdigest()
+
+
+def image_coverage(page) -> float:
+    """ページ面積に対して画像が占める割合 (重なりは重複計上、上限 1.0)"""
+    page_area = abs(page.rect) or 1.0
+    covered = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return min(covered / page_area, 1.0)
+
+
+def merge_rects(rects: List["fitz.Rect"], padding: float = REGION_PADDING) -> List["fitz.Rect"]:
+    """余白を付けた矩形のうち重なるものを統合する"""
+    merged = [fitz.Rect(r) + (-padding, -padding, padding, padding) for r in rects]
+    changed = True
+    # 統合で広がった矩形同士が新たに重なる場合があるので収束するまで繰り返す
+    while changed:
+        changed = False
+        result: List[fitz.Rect] = []
+        for rect in merged:
+            for index, existing in enumerate(result):
+                if existing.intersects(rect):
+                    result[index] = existing | rect
+                    changed = True
+                    break
+            else:
+                result.append(rect)
+        merged = result
+    return merged
+
+
+def compare_pages(old_page, new_page) -> Dict:
+    """2ページの構造比較を行い、変更された領域を返す
+
+    戻り値:
+        full_page: True の場合は構造比較が使えないため、ページ全体をラスタ比較する
+        regions:   変更された領域 (ページ座標の fitz.Rect) のリスト。空なら変更なし
+        clip:      regions の外接矩形 (変更がなければ None)
+        reason:    full_page になった理由
+    """
+    def full(reason):
+        return {"full_page": True, "regions": [], "clip": None, "reason": reason}
+
+    if old_page.rect != new_page.rect or old_page.rotation or new_page.rotation:
+        return full("ページサイズまたは回転が異なる")
+    coverage = max(image_coverage(old_page), image_coverage(new_page))
+    if coverage > IMAGE_COVERAGE_LIMIT:
+        return full(f"画像主体のページ (画像占有率 {coverage:.0%})")
+    if uses_uncovered_graphics_state(old_page) or uses_uncovered_graphics_state(new_page):
+        return full("構造比較で扱えない描画属性 (ブレンドモード・ソフトマスク)")
+
+    old_elements, new_elements = page_elements(old_page), page_elements(new_page)
+    changed = (old_elements - new_elements) + (new_elements - old_elements)
+    rects = [fitz.Rect(bbox) & new_page.rect for (_, bbox) in changed.keys()]
+    regions = [r & new_page.rect for r in merge_rects([r for r in rects if not r.is_empty])]
+    if not regions:
+        if changed:
+            # 外接矩形を持たない要素 (空パスなど) の変化は念のため全面比較に回す
+            return full("位置を特定できない変更")
+        return {"full_page": False, "regions": [], "clip": None, "reason": "構造的な変更なし"}
+
+    clip = fitz.Rect(regions[0])
+    for region in regions[1:]:
+        clip |= region
+    if abs(clip) > MAX_REGION_COVERAGE * abs(new_page.rect):
+        return full("変更領域がページの大部分を占める")
+    return {"full_page": False, "regions": regions, "clip": clip, "reason": f"{len(regions)} 領域が変更"}
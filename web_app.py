@@ -1,21 +1,41 @@
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for
+from flask import Flask, Request, g, render_template, request, jsonify, send_file, session, redirect, url_for
 from werkzeug.utils import secure_filename
 import os
 import tempfile
 import shutil
 from pathlib import Path
 import json
+import csv
 from datetime import datetime
 import logging
-from pixel_diff_detector import PixelDiffDetector
+from pixel_diff_detector import PixelDiffDetector, MemoryBudgetExceededError, SUMMARY_MODES
+from job_queue import JobQueue, cleanup_inputs
+from upload_store import UploadStore, IncompleteUploadError
+from capacity import JobSlots, memory_headroom, disk_headroom
+from cancellation import CANCEL_FILENAME, CancellationToken, JobCancelledError, request_cancel
+from diff_io import buffered_input
+from progressive_diff import PREVIEW_DIR, ProgressiveDiff, read_progress
 import secrets
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-import gspread
-from google.oauth2.service_account import Credentials as ServiceAccountCredentials
+import re
+import socket
+import io
+import functools
+import contextlib
+import threading
+
+class InMemoryUploadRequest(Request):
+    """Request that keeps uploaded files in memory when the whole body fits in UPLOAD_MEMORY_MB."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_MEMORY_MB * 1024 * 1024:
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
 
 app = Flask(__name__)
+app.request_class = InMemoryUploadRequest
 app.secret_key = os.environ.get("SECRET_KEY", secrets.token_hex(16))
+# RATELIMIT_ENABLED=false turns the Flask-Limiter limits off (load tests drive many jobs from one address)
+app.config["RATELIMIT_ENABLED"] = os.getenv("RATELIMIT_ENABLED", "true").lower() in ('1', 'true', 'yes', 'on')
 
 # Optional rate limiting
 try:
@@ -30,14 +50,54 @@ UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'static/outputs'
 ALLOWED_EXTENSIONS = {'pdf'}
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE_MB", "50")) * 1024 * 1024  # override by env MAX_FILE_SIZE_MB
+# Multipart bodies up to this size are parsed into memory instead of werkzeug's spooled temp files;
+# inline comparisons then read the PDFs straight from memory (0 = always spool large uploads to disk)
+UPLOAD_MEMORY_MB = int(os.getenv("UPLOAD_MEMORY_MB", "128"))
+# Per-job memory budget for page rasters (0 = unlimited) and what to do when a page exceeds it:
+# "reduce_dpi" (default), "tile" or "fail"
+JOB_MEMORY_BUDGET_MB = int(os.getenv("JOB_MEMORY_BUDGET_MB", "0"))
+JOB_MEMORY_POLICY = os.getenv("JOB_MEMORY_POLICY", "reduce_dpi")
+# Summary PDF style: "layered" draws the changed regions over the new PDF's original page with the
+# page / added / removed parts as toggleable PDF layers, "vector" the same without layers (both small
+# and fast), "raster" embeds the full diff image of every changed page
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "layered")
+# Shared-volume SQLite job queue. When set, /upload and /upload/chain only enqueue the job
+# (uploads are kept under UPLOAD_FOLDER for the workers) and diff_worker.py processes it;
+# poll GET /jobs/<job_id> for the result. Unset = compare inside the web process.
+JOB_QUEUE_DB = os.getenv("JOB_QUEUE_DB", "")
+job_queue = JobQueue(JOB_QUEUE_DB) if JOB_QUEUE_DB else None
+# Wall-clock limit per comparison in seconds (0 = none). Checked between pages; keep it below the
+# gunicorn WEB_TIMEOUT so an inline job is stopped cleanly instead of its worker being killed.
+JOB_DEADLINE_SEC = int(os.getenv("JOB_DEADLINE_SEC", "0"))
+# Readiness (/readyz) and admission control. JOB_SLOTS comparisons run at once in this container
+# (default one per gunicorn worker, shared across workers); a comparison request beyond that, or
+# one that arrives while memory or output disk is below the minimum, gets 503 + Retry-After so
+# nginx can try another instance. With JOB_QUEUE_DB, MAX_QUEUED_JOBS caps the queue (0 = no cap).
+JOB_SLOTS = int(os.getenv("JOB_SLOTS", os.getenv("WEB_WORKERS", "2")))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "0"))
+READY_MIN_FREE_MEMORY_MB = int(os.getenv("READY_MIN_FREE_MEMORY_MB", str(JOB_MEMORY_BUDGET_MB or 1024)))
+READY_MIN_FREE_DISK_MB = int(os.getenv("READY_MIN_FREE_DISK_MB", "1024"))
+RETRY_AFTER_SEC = int(os.getenv("RETRY_AFTER_SEC", "10"))
+job_slots = JobSlots(JOB_SLOTS)
 
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 os.makedirs('static', exist_ok=True)
 
+# Content-addressed store for chunked, resumable uploads (POST /uploads ...). A file whose SHA-256
+# is already stored is not sent again; /upload and /upload/chain accept the stored file ids.
+# Kept under UPLOAD_FOLDER so queue workers on the shared volume can read the files.
+UPLOAD_CHUNK_MB = int(os.getenv("UPLOAD_CHUNK_MB", "4"))
+UPLOAD_RETENTION_HOURS = float(os.getenv("UPLOAD_RETENTION_HOURS", "168"))
+upload_store = UploadStore(os.path.join(UPLOAD_FOLDER, 'store'), chunk_size=UPLOAD_CHUNK_MB * 1024 * 1024,
+                           max_size=MAX_FILE_SIZE, retention=UPLOAD_RETENTION_HOURS * 3600)
+
 # Load configuration
 CONFIG_FILE = Path("GoogleLoginLauncher/SpotPDFLauncher.config.json")
+# Optional CSV (email,expiration_date) used instead of the Google Sheet for authorized users,
+# e.g. for offline load tests or a deployment without a service account
+AUTHORIZED_USERS_FILE = os.getenv("AUTHORIZED_USERS_FILE", "")
 
 def load_config():
     """Load configuration from environment or JSON file and export frontend config."""
@@ -53,6 +113,8 @@ def load_config():
             "ServiceAccountKeyPath": sa_key_path,
             "SpreadsheetUrl": sheet_url,
         }
+    elif client_id and AUTHORIZED_USERS_FILE:
+        config = {"GoogleClientId": client_id}
     else:
         # Fallback to local JSON config
         try:
@@ -75,13 +137,210 @@ def load_config():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def is_truthy(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def settings_from_request():
+    """Build detector settings from the current form / query string."""
+    summary_mode = request.form.get('summary_mode', SUMMARY_MODE)
+    return {
+        'sensitivity': int(request.form.get('sensitivity', 10)),
+        'display_filter': {
+            'added': is_truthy(request.form.get('show_added', 'true')),
+            'removed': is_truthy(request.form.get('show_removed', 'true'))
+        },
+        'export_all_patterns': is_truthy(request.form.get('export_all', 'false')),
+        # Pair pages by content signature so inserted/deleted/reordered sheets don't shift the diff
+        'page_matching': is_truthy(request.form.get('match_pages', 'false')),
+        # Localize changes from drawing/text/image structure and rasterize only that region
+        'vector_prediff': is_truthy(request.form.get('vector_prediff', 'false')),
+        # Per-job Chrome trace; accepted as a query flag (?profile=1) or form field
+        'profile': is_truthy(request.args.get('profile', request.form.get('profile', 'false'))),
+        'memory_budget_mb': JOB_MEMORY_BUDGET_MB or None,
+        'memory_policy': JOB_MEMORY_POLICY,
+        # Keep per-page signed differences so /jobs/<id>/rethreshold can skip rendering
+        'save_intermediates': True,
+        # Grayscale base + 1-bit added/removed masks; the viewer composites and toggles them client-side
+        'mask_layers': True,
+        # Checkpoint every finished page so a worker that takes over a crashed job resumes where it stopped
+        'checkpoint': True,
+        'deadline_sec': JOB_DEADLINE_SEC or None,
+        # Publish a low-resolution pass of the whole document first, then refine page by page at full DPI
+        'progressive': is_truthy(request.form.get('progressive', 'false')),
+        'summary_mode': summary_mode if summary_mode in SUMMARY_MODES else SUMMARY_MODE
+    }
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+JOB_INFO_FILENAME = 'job_info.json'
+
+def new_job_dir():
+    """Create an output directory for a new job; returns (job_id, path).
+
+    The page may pick the id itself (form field job_id) so it can cancel the job while the
+    upload request is still running; an id that is already taken raises FileExistsError.
+    """
+    requested_id = request.form.get('job_id', '')
+    job_id = requested_id if JOB_ID_PATTERN.match(requested_id) else secrets.token_hex(8)
+    job_dir = os.path.join(OUTPUT_FOLDER, job_id)
+    os.makedirs(job_dir)
+    with open(os.path.join(job_dir, JOB_INFO_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump({'owner': session.get('user_email'), 'created_at': datetime.now().isoformat(timespec='seconds')}, f)
+    return job_id, job_dir
+
+def find_job_dir(job_id):
+    """Return the directory of a job owned by the current user, or None."""
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    job_dir = os.path.join(OUTPUT_FOLDER, job_id)
+    try:
+        with open(os.path.join(job_dir, JOB_INFO_FILENAME), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return job_dir if info.get('owner') == session.get('user_email') else None
+
+def update_job_info(job_dir, **changes):
+    """Merge fields into a job's job_info.json (written via a temp file so readers never see half of it)."""
+    info_path = os.path.join(job_dir, JOB_INFO_FILENAME)
+    with open(info_path, 'r', encoding='utf-8') as f:
+        info = json.load(f)
+    info.update(changes)
+    temp_path = f'{info_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    os.replace(temp_path, info_path)
+
+@contextlib.contextmanager
+def inline_job(job_dir):
+    """Record how a job run inside this request ended (done / failed / cancelled) in its job_info.json."""
+    status = 'failed'
+    try:
+        yield
+        status = 'done'
+    except JobCancelledError:
+        status = 'cancelled'
+        raise
+    finally:
+        update_job_info(job_dir, status=status, finished_at=datetime.now().isoformat(timespec='seconds'))
+
+def inline_job_status(job_dir):
+    """Status of a job run by the web process: running, done, failed or cancelled."""
+    progress = read_progress(job_dir)
+    if progress:
+        return PROGRESS_STATUS.get(progress['phase'], 'running')
+    try:
+        with open(os.path.join(job_dir, JOB_INFO_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f).get('status', 'running')
+    except (FileNotFoundError, json.JSONDecodeError):
+        return 'running'
+
+def find_job_output(job_id):
+    """Return the detector output directory of a job owned by the current user, or None."""
+    job_dir = find_job_dir(job_id)
+    if not job_dir:
+        return None
+    outputs = [d for d in Path(job_dir).iterdir() if d.is_dir() and d.name != PREVIEW_DIR]
+    return str(outputs[0]) if len(outputs) == 1 else None
+
+def client_disconnected_probe():
+    """Return a callable that is True once the client has closed the connection, or None.
+
+    Only gunicorn exposes the client socket. The request body has been read by the time a job
+    runs, so a peek that returns b'' means the peer (browser or nginx) hung up.
+    """
+    sock = request.environ.get('gunicorn.socket')
+    if sock is None or not hasattr(socket, 'MSG_DONTWAIT'):
+        return None
+
+    def disconnected():
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+    return disconnected
+
+def job_cancel_token(job_dir, settings):
+    """Cancellation token for a job run inside this request.
+
+    Cancelled by DELETE /jobs/<id> (a marker file, so it works from any gunicorn worker),
+    by the client disconnecting, or by the JOB_DEADLINE_SEC limit.
+    """
+    token = CancellationToken(timeout=settings.get('deadline_sec'), cancel_file=os.path.join(job_dir, CANCEL_FILENAME))
+    probe = client_disconnected_probe()
+    if probe:
+        token.watch(probe, 'Client disconnected')
+    return token
+
+def cancelled_response(error):
+    if error.reason == 'deadline':
+        return jsonify({'error': f'Processing stopped: {error}', 'cancelled': True}), 504
+    return jsonify({'error': 'Job was cancelled', 'cancelled': True}), 409
+
+def remap_result_paths(results):
+    """Rewrite output file paths in detector results to paths relative to OUTPUT_FOLDER.
+
+    Returns the job's output sub-directory relative to OUTPUT_FOLDER,
+    e.g. "old_vs_new_20250101_120000/old_vs_new_20250101_120000".
+    """
+    outputs_root_abs = os.path.abspath(OUTPUT_FOLDER)
+    out_abs = os.path.abspath(results['output_path'])
+    sub_rel = os.path.relpath(out_abs, outputs_root_abs)
+
+    def to_url(path):
+        # Progressive results mix preview and full-resolution files from different sub-directories
+        rel = os.path.relpath(os.path.abspath(path), outputs_root_abs)
+        return rel.replace(os.sep, '/') if not rel.startswith('..') else f"{sub_rel}/{os.path.basename(path)}"
+
+    # Map to paths relative to OUTPUT_FOLDER for /download/<path>
+    try:
+        results['diff_images'] = [to_url(p) for p in results.get('diff_images', []) or []]
+        for entry in results.get('pages', []) + results.get('steps', []):
+            entry['diff_images'] = [to_url(p) for p in entry.get('diff_images', [])]
+            for layer in entry.get('layers', []):
+                for kind in ('base', 'added', 'removed'):
+                    layer[kind] = to_url(layer[kind])
+        for key in ('summary_pdf', 'profile_trace', 'report'):
+            if results.get(key):
+                results[key] = to_url(results[key])
+    except Exception as e:
+        logging.warning(f"Failed to remap result paths: {e}")
+    return sub_rel
+
+def parse_authorized_users(records):
+    """Map lower-cased email -> expiration date from sheet/CSV rows with email and expiration_date."""
+    authorized_users = {}
+    for record in records:
+        email = record.get('email')
+        exp_date_str = record.get('expiration_date')
+        if email and exp_date_str:
+            try:
+                exp_date = datetime.strptime(str(exp_date_str), "%Y-%m-%d").date()
+                authorized_users[email.lower()] = exp_date
+            except ValueError:
+                logging.warning(f"Invalid date format for user {email}: {exp_date_str}")
+    return authorized_users
+
 def get_authorized_users():
-    """Get authorized users from Google Sheets."""
+    """Get authorized users from Google Sheets (or AUTHORIZED_USERS_FILE when set)."""
+    if AUTHORIZED_USERS_FILE:
+        try:
+            with open(AUTHORIZED_USERS_FILE, 'r', encoding='utf-8', newline='') as f:
+                return parse_authorized_users(csv.DictReader(f))
+        except OSError as e:
+            logging.error(f"Error reading authorized users file: {e}")
+            return {}
+
     config = load_config()
     if not config:
         return {}
     
     try:
+        # Imported on first use: the Google client stack is slow to import and not needed to serve /status
+        import gspread
+        from google.oauth2.service_account import Credentials as ServiceAccountCredentials
+
         sa_creds = ServiceAccountCredentials.from_service_account_file(
             config["ServiceAccountKeyPath"],
             scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
@@ -94,19 +353,7 @@ def get_authorized_users():
             worksheet = spreadsheet.worksheet(sheet_name)
         except Exception:
             worksheet = spreadsheet.sheet1
-        records = worksheet.get_all_records()
-        
-        authorized_users = {}
-        for record in records:
-            email = record.get('email')
-            exp_date_str = record.get('expiration_date')
-            if email and exp_date_str:
-                try:
-                    exp_date = datetime.strptime(str(exp_date_str), "%Y-%m-%d").date()
-                    authorized_users[email.lower()] = exp_date
-                except ValueError:
-                    logging.warning(f"Invalid date format for user {email}: {exp_date_str}")
-        return authorized_users
+        return parse_authorized_users(worksheet.get_all_records())
     except Exception as e:
         logging.error(f"Error accessing spreadsheet: {e}")
         return {}
@@ -115,7 +362,7 @@ def get_authorized_users():
 def index():
     if 'user_email' not in session:
         return redirect(url_for('login'))
-    return render_template('index.html', user_email=session['user_email'])
+    return render_template('index.html', user_email=session['user_email'], summary_mode=SUMMARY_MODE)
 
 @app.route('/login')
 def login():
@@ -133,10 +380,10 @@ def google_auth():
         return jsonify({'error': 'No token provided'}), 400
     
     try:
-        # Verify the token
-        idinfo = id_token.verify_oauth2_token(
-            token, google_requests.Request(), config["GoogleClientId"]
-        )
+        from google_token_verifier import default_verifier
+
+        # Verify the token (Google's signing certs are cached per their Cache-Control over a pooled session)
+        idinfo = default_verifier().verify(token, config["GoogleClientId"])
         
         user_email = idinfo['email'].lower()
         
@@ -167,23 +414,160 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
+def upload_size(file):
+    """Size of an uploaded file in bytes (the stream is rewound for the detector)."""
+    size = file.stream.seek(0, os.SEEK_END)
+    file.stream.seek(0)
+    return size
+
+def to_mb(value):
+    return None if value is None else value // (1024 * 1024)
+
+def capacity_report(include_slots=True):
+    """Whether this container can take another comparison; returns (ready, report).
+
+    The report has the free job slots (inline mode) or the queue depth (JOB_QUEUE_DB), the memory
+    and output-disk headroom, and the reasons the container is not ready, if any.
+    """
+    report = {'reasons': []}
+    if job_queue:
+        counts = job_queue.counts()
+        report['queue'] = {'queued': counts['queued'], 'running': counts['running'], 'limit': MAX_QUEUED_JOBS or None}
+        if MAX_QUEUED_JOBS and counts['queued'] >= MAX_QUEUED_JOBS:
+            report['reasons'].append('queue_full')
+    elif include_slots:
+        in_use = job_slots.in_use()
+        report['slots'] = {'capacity': job_slots.capacity, 'in_use': in_use, 'free': max(0, job_slots.capacity - in_use)}
+        if in_use >= job_slots.capacity:
+            report['reasons'].append('no_free_slots')
+
+    memory = memory_headroom()
+    report['memory'] = {'available_mb': to_mb(memory['available']), 'limit_mb': to_mb(memory['limit']),
+                        'min_free_mb': READY_MIN_FREE_MEMORY_MB}
+    if memory['available'] is not None and to_mb(memory['available']) < READY_MIN_FREE_MEMORY_MB:
+        report['reasons'].append('low_memory')
+    disk = disk_headroom(OUTPUT_FOLDER)
+    report['disk'] = {'free_mb': to_mb(disk['free']), 'total_mb': to_mb(disk['total']), 'min_free_mb': READY_MIN_FREE_DISK_MB}
+    if to_mb(disk['free']) < READY_MIN_FREE_DISK_MB:
+        report['reasons'].append('low_disk')
+    return not report['reasons'], report
+
+def busy_response(reasons):
+    response = jsonify({'error': 'Server is busy, please retry shortly', 'busy': True, 'reasons': reasons})
+    response.headers['Retry-After'] = str(RETRY_AFTER_SEC)
+    return response, 503
+
+def admit_job(view):
+    """Admission control for comparison requests: 503 + Retry-After when the container is full.
+
+    An inline job holds one of the JOB_SLOTS for the whole request (g.job_slot; a view that keeps
+    working after the response pops it and releases it itself). The check runs before the upload
+    is parsed, so a refused request is cheap and nginx can resend it to another instance.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'user_email' not in session:
+            return view(*args, **kwargs)
+        slot = None
+        if not job_queue:
+            slot = job_slots.try_acquire()
+            if slot is None:
+                return busy_response(['no_free_slots'])
+            g.job_slot = slot
+        try:
+            ready, report = capacity_report(include_slots=False)
+            if not ready:
+                return busy_response(report['reasons'])
+            return view(*args, **kwargs)
+        finally:
+            if slot and g.pop('job_slot', None):
+                slot.release()
+    return wrapper
+
+def stored_input(file_id, directory):
+    """Place a file the current user uploaded to the store into a job's input directory; returns its path."""
+    info = upload_store.info(file_id, owner=session.get('user_email'))
+    if info is None:
+        raise FileNotFoundError(f'Uploaded file not found: {file_id}')
+    os.makedirs(directory, exist_ok=True)
+    filename = secure_filename(info['filename']) or f'{info["file_id"][:12]}.pdf'
+    return upload_store.link_into(info['file_id'], directory, filename)
+
+@app.route('/uploads', methods=['POST'])
+def begin_upload():
+    """Start or resume a chunked upload. Body: {sha256, size, filename}.
+
+    Returns complete=true when this user has already uploaded the content (nothing to send);
+    otherwise the chunk size and the indexes of the chunks the server does not have yet.
+    Content stored only by other users has to be sent again: knowing the hash is not enough.
+    """
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    body = request.get_json(silent=True) or {}
+    filename = str(body.get('filename', ''))
+    if filename and not allowed_file(filename):
+        return jsonify({'error': 'Only PDF files are allowed'}), 400
+    try:
+        state = upload_store.begin(body.get('sha256', ''), body.get('size', 0), filename,
+                                   owner=session['user_email'])
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(dict(state, chunk_count=-(-state['size'] // state['chunk_size'])))
+
+@app.route('/uploads/<file_id>/chunks/<int:index>', methods=['PUT'])
+def put_upload_chunk(file_id, index):
+    """Store one chunk (raw request body). An optional X-Chunk-SHA256 header is verified."""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if (request.content_length or 0) > upload_store.chunk_size:
+        return jsonify({'error': 'Chunk too large'}), 413
+    try:
+        remaining = upload_store.put_chunk(file_id, index, request.get_data(cache=False),
+                                           request.headers.get('X-Chunk-SHA256'), owner=session['user_email'])
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'file_id': file_id, 'index': index, 'remaining': remaining})
+
+@app.route('/uploads/<file_id>/complete', methods=['POST'])
+def complete_upload(file_id):
+    """Join the chunks and verify the SHA-256; the file id can then be used in /upload."""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    try:
+        info = upload_store.finish(file_id, owner=session['user_email'])
+    except IncompleteUploadError as e:
+        return jsonify({'error': str(e), 'missing': e.missing}), 409
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(dict(info, complete=True))
+
 @app.route('/upload', methods=['POST'])
+@admit_job
 def upload_files():
     """Handle PDF file uploads."""
     if 'user_email' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    if 'old_pdf' not in request.files or 'new_pdf' not in request.files:
-        return jsonify({'error': 'Both old and new PDF files are required'}), 400
-    
-    old_file = request.files['old_pdf']
-    new_file = request.files['new_pdf']
-    
-    if old_file.filename == '' or new_file.filename == '':
-        return jsonify({'error': 'No files selected'}), 400
-    
-    if not (allowed_file(old_file.filename) and allowed_file(new_file.filename)):
-        return jsonify({'error': 'Only PDF files are allowed'}), 400
+    # Either both files in the request, or both as ids of files already in the upload store
+    old_file_id = request.form.get('old_file_id')
+    new_file_id = request.form.get('new_file_id')
+    stored = bool(old_file_id and new_file_id)
+    if not stored:
+        if 'old_pdf' not in request.files or 'new_pdf' not in request.files:
+            return jsonify({'error': 'Both old and new PDF files are required'}), 400
+
+        old_file = request.files['old_pdf']
+        new_file = request.files['new_pdf']
+
+        if old_file.filename == '' or new_file.filename == '':
+            return jsonify({'error': 'No files selected'}), 400
+
+        if not (allowed_file(old_file.filename) and allowed_file(new_file.filename)):
+            return jsonify({'error': 'Only PDF files are allowed'}), 400
     
     # Optional global request size guard
     content_length = request.content_length or 0
@@ -191,81 +575,358 @@ def upload_files():
     if content_length and content_length > (MAX_FILE_SIZE * 2 + 2 * 1024 * 1024):
         return jsonify({'error': 'Payload too large'}), 413
 
-    # Create temporary directory for this comparison
-    temp_dir = tempfile.mkdtemp()
+    # Create temporary directory for this comparison (on the shared uploads volume when workers process it).
+    # Uploaded files compared inside this process are read from memory and never written here.
+    temp_dir = tempfile.mkdtemp(dir=UPLOAD_FOLDER if job_queue else None) if job_queue or stored else None
+    queued = False
     
     try:
-        # Save uploaded files
-        old_filename = secure_filename(old_file.filename)
-        new_filename = secure_filename(new_file.filename)
-        
-        old_path = os.path.join(temp_dir, old_filename)
-        new_path = os.path.join(temp_dir, new_filename)
-        
-        old_file.save(old_path)
-        new_file.save(new_path)
+        if stored:
+            # Hard links (copies across file systems) so the job's input cleanup leaves the store intact
+            old_path = stored_input(old_file_id, os.path.join(temp_dir, 'old'))
+            new_path = stored_input(new_file_id, os.path.join(temp_dir, 'new'))
+        elif not job_queue:
+            # The detector reads the uploads directly (file name from FileStorage.filename)
+            if upload_size(old_file) > MAX_FILE_SIZE or upload_size(new_file) > MAX_FILE_SIZE:
+                return jsonify({'error': f'File too large (max {MAX_FILE_SIZE // (1024 * 1024)}MB each)'}), 400
+            old_file.filename, new_file.filename = secure_filename(old_file.filename), secure_filename(new_file.filename)
+            old_path, new_path = old_file, new_file
+        else:
+            # Save uploaded files for the workers
+            old_filename = secure_filename(old_file.filename)
+            new_filename = secure_filename(new_file.filename)
 
-        # Per-file size checks
-        if os.path.getsize(old_path) > MAX_FILE_SIZE or os.path.getsize(new_path) > MAX_FILE_SIZE:
-            return jsonify({'error': ('File too large (max ' + [int](if (){}else{'50'}) + 'MB each)')}), 400
+            old_path = os.path.join(temp_dir, old_filename)
+            new_path = os.path.join(temp_dir, new_filename)
+
+            old_file.save(old_path)
+            new_file.save(new_path)
+
+            # Per-file size checks
+            if os.path.getsize(old_path) > MAX_FILE_SIZE or os.path.getsize(new_path) > MAX_FILE_SIZE:
+                return jsonify({'error': f'File too large (max {MAX_FILE_SIZE // (1024 * 1024)}MB each)'}), 400
         
         # Get settings from request
-        settings = {
-            'sensitivity': int(request.form.get('sensitivity', 10)),
-            'display_filter': {
-                'added': request.form.get('show_added', 'true') == 'true',
-                'removed': request.form.get('show_removed', 'true') == 'true'
-            },
-            'export_all_patterns': request.form.get('export_all', 'false') == 'true'
-        }
+        settings = settings_from_request()
         
         # Process PDF comparison
         detector = PixelDiffDetector()
         
-        # Create output directory
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_name = f"{Path(old_filename).stem}_vs_{Path(new_filename).stem}_{timestamp}"
-        output_path = os.path.join(OUTPUT_FOLDER, output_name)
+        # Create output directory (one per job, addressable as /jobs/<job_id>)
+        job_id, output_path = new_job_dir()
+
+        if job_queue:
+            response = enqueue_job(job_id, 'diff', {
+                'old_path': old_path, 'new_path': new_path, 'output_dir': output_path,
+                'input_dir': temp_dir, 'settings': settings
+            })
+            queued = True
+            return response
+
+        if settings['progressive']:
+            return start_progressive_job(job_id, output_path, old_path, new_path, settings)
         
-        results = detector.create_pixel_diff_output(
-            old_path, new_path, output_path, settings=settings
-        )
+        with inline_job(output_path):
+            results = detector.create_pixel_diff_output(
+                old_path, new_path, output_path, settings=settings,
+                cancel_token=job_cancel_token(output_path, settings)
+            )
 
         # Adapt results to web-relative paths for frontend
         if os.path.exists(results['output_path']):
-            outputs_root_abs = os.path.abspath(OUTPUT_FOLDER)
-            out_abs = os.path.abspath(results['output_path'])
-            sub_rel = os.path.relpath(out_abs, outputs_root_abs)  # e.g., "old_vs_new_20250101_120000"
-
-            # Map to paths relative to OUTPUT_FOLDER for /download/<path>
-            try:
-                diff_urls = []
-                for p in results.get('diff_images', []) or []:
-                    b = os.path.basename(p)
-                    diff_urls.append(f"{sub_rel}/{b}")
-                results['diff_images'] = diff_urls
-                if results.get('summary_pdf'):
-                    results['summary_pdf'] = f"{sub_rel}/{os.path.basename(results['summary_pdf'])}"
-            except Exception as e:
-                logging.warning(f"Failed to remap result paths: {e}")
-
+            sub_rel = remap_result_paths(results)
             return jsonify({
                 'success': True,
+                'job_id': job_id,
                 'output_path': sub_rel,
                 'results': results
             })
         else:
             return jsonify({'error': 'Failed to generate comparison'}), 500
     
+    except MemoryBudgetExceededError as e:
+        return jsonify({'error': f'Document too large to process: {e}'}), 422
+
+    except FileExistsError:
+        return jsonify({'error': 'Job id already in use'}), 409
+
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+
+    except JobCancelledError as e:
+        return cancelled_response(e)
+
     except Exception as e:
         logging.error(f"Upload processing error: {e}")
         return jsonify({'error': f'Processing failed: {str(e)}'}), 500
     
     finally:
-        # Cleanup temporary files
-        if os.path.exists(temp_dir):
+        # Cleanup temporary files (a queued job's worker removes them when it is done)
+        if temp_dir and os.path.exists(temp_dir) and not queued:
+            shutil.rmtree(temp_dir)
+
+def start_progressive_job(job_id, job_dir, old_pdf, new_pdf, settings):
+    """Run the preview pass in this request and the full-resolution pass in a background thread.
+
+    The thread takes over the request's job slot; the page polls GET /jobs/<job_id>, whose results
+    switch to full resolution page by page.
+    """
+    # Buffered so the inputs outlive the request (uploads) and the temp dir cleanup (stored files)
+    old_pdf, new_pdf = buffered_input(old_pdf, 'old.pdf'), buffered_input(new_pdf, 'new.pdf')
+    runner = ProgressiveDiff(job_dir, settings)
+    results = runner.preview(old_pdf, new_pdf, cancel_token=job_cancel_token(job_dir, settings))
+    slot = g.pop('job_slot', None)
+
+    def refine():
+        try:
+            # No disconnect probe: the client is expected to leave and poll
+            runner.refine(old_pdf, new_pdf, cancel_token=CancellationToken(
+                timeout=settings.get('deadline_sec'), cancel_file=os.path.join(job_dir, CANCEL_FILENAME)))
+        except JobCancelledError as e:
+            logging.info(f"Progressive job {job_id} stopped: {e}")
+        except Exception as e:
+            logging.error(f"Progressive job {job_id} failed: {e}")
+        finally:
+            if slot:
+                slot.release()
+
+    # Not a daemon thread: a gracefully stopping worker finishes the refinement before it exits
+    threading.Thread(target=refine, name=f'refine-{job_id}').start()
+    sub_rel = remap_result_paths(results)
+    return jsonify({
+        'success': True,
+        'progressive': True,
+        'job_id': job_id,
+        'status': 'running',
+        'phase': 'refining',
+        'status_url': url_for('job_status', job_id=job_id),
+        'output_path': sub_rel,
+        'results': results
+    }), 202
+
+@app.route('/upload/chain', methods=['POST'])
+@admit_job
+def upload_chain():
+    """Compare an ordered list of revisions (v1 -> v2 -> ...), rendering each revision once."""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    # Revisions in order, as uploaded files (pdfs) or as ids of files in the upload store (file_ids)
+    file_ids = request.form.getlist('file_ids')
+    files = request.files.getlist('pdfs')
+    if len(file_ids or files) < 2:
+        return jsonify({'error': 'At least two PDF files are required'}), 400
+    if not file_ids and not all(f.filename and allowed_file(f.filename) for f in files):
+        return jsonify({'error': 'Only PDF files are allowed'}), 400
+
+    temp_dir = tempfile.mkdtemp(dir=UPLOAD_FOLDER if job_queue else None) if job_queue or file_ids else None
+    queued = False
+    try:
+        paths = []
+        for index, file_id in enumerate(file_ids):
+            paths.append(stored_input(file_id, os.path.join(temp_dir, f"{index:02d}")))
+        if not file_ids and not job_queue:
+            # Compared inside this process: the detector reads the uploads from memory
+            if any(upload_size(f) > MAX_FILE_SIZE for f in files):
+                return jsonify({'error': f'File too large (max {MAX_FILE_SIZE // (1024 * 1024)}MB each)'}), 400
+            for f in files:
+                f.filename = secure_filename(f.filename)
+            paths = files
+        for index, f in enumerate([] if file_ids or not job_queue else files):
+            # One sub-directory per position so identical names keep their order and don't collide
+            revision_dir = os.path.join(temp_dir, f"{index:02d}")
+            os.makedirs(revision_dir)
+            path = os.path.join(revision_dir, secure_filename(f.filename))
+            f.save(path)
+            if os.path.getsize(path) > MAX_FILE_SIZE:
+                return jsonify({'error': f'File too large (max {MAX_FILE_SIZE // (1024 * 1024)}MB each)'}), 400
+            paths.append(path)
+
+        settings = settings_from_request()
+        settings['compare_to_first'] = is_truthy(request.form.get('compare_to_first', 'false'))
+
+        job_id, output_path = new_job_dir()
+        if job_queue:
+            response = enqueue_job(job_id, 'chain', {
+                'paths': paths, 'output_dir': output_path, 'input_dir': temp_dir, 'settings': settings
+            })
+            queued = True
+            return response
+
+        with inline_job(output_path):
+            results = PixelDiffDetector().create_revision_chain_output(paths, output_path, settings=settings,
+                                                                        cancel_token=job_cancel_token(output_path, settings))
+        sub_rel = remap_result_paths(results)
+        return jsonify({'success': True, 'job_id': job_id, 'output_path': sub_rel, 'results': results})
+
+    except FileExistsError:
+        return jsonify({'error': 'Job id already in use'}), 409
+
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+
+    except JobCancelledError as e:
+        return cancelled_response(e)
+
+    except Exception as e:
+        logging.error(f"Chain processing error: {e}")
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+    finally:
+        if temp_dir and os.path.exists(temp_dir) and not queued:
             shutil.rmtree(temp_dir)
 
+@app.route('/quick-check', methods=['POST'])
+def quick_check():
+    """Report which pages changed (no images): content-hash skip plus a low-DPI diff."""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    old_file = request.files.get('old_pdf')
+    new_file = request.files.get('new_pdf')
+    if not old_file or not new_file or old_file.filename == '' or new_file.filename == '':
+        return jsonify({'error': 'Both old and new PDF files are required'}), 400
+    if not (allowed_file(old_file.filename) and allowed_file(new_file.filename)):
+        return jsonify({'error': 'Only PDF files are allowed'}), 400
+
+    try:
+        if upload_size(old_file) > MAX_FILE_SIZE or upload_size(new_file) > MAX_FILE_SIZE:
+            return jsonify({'error': f'File too large (max {MAX_FILE_SIZE // (1024 * 1024)}MB each)'}), 400
+
+        settings = {
+            'sensitivity': int(request.form.get('sensitivity', 10)),
+            'page_matching': is_truthy(request.form.get('match_pages', 'false')),
+            # Stop at the first changed page when the caller only needs a yes/no answer
+            'first_change_only': is_truthy(request.form.get('first_change_only', 'false'))
+        }
+        results = PixelDiffDetector().quick_check(old_file, new_file, settings=settings)
+        return jsonify({'success': True, 'results': results})
+
+    except Exception as e:
+        logging.error(f"Quick check error: {e}")
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+def enqueue_job(job_id, kind, payload):
+    """Hand a job to the worker pool; the client polls GET /jobs/<job_id> for the result."""
+    job_queue.enqueue(kind, payload, owner=session.get('user_email'), job_id=job_id)
+    return jsonify({
+        'success': True,
+        'queued': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('job_status', job_id=job_id)
+    }), 202
+
+# Job status for each phase of a progressive job's progress.json
+PROGRESS_STATUS = {'preview': 'running', 'refining': 'running', 'done': 'done', 'failed': 'failed', 'cancelled': 'cancelled'}
+
+def progress_fields(progress):
+    """Status fields of a progressive job: phase, pages refined so far and the results so far."""
+    body = {key: progress.get(key) for key in ('phase', 'page_count', 'pages_refined', 'preview_dpi', 'dpi')}
+    if progress.get('results'):
+        results = progress['results']
+        body.update(output_path=remap_result_paths(results), results=results)
+    return body
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status of a queued or progressive job; includes the results (same shape as /upload) once it is done.
+
+    A progressive job also reports its phase and, while it runs, the results so far: each page has
+    resolution "preview" until the full-resolution pass replaces it ("full").
+    """
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    job = job_queue.get(job_id) if job_queue and JOB_ID_PATTERN.match(job_id) else None
+    if not job:
+        # Progressive jobs run inside the web container when there is no queue
+        job_dir = find_job_dir(job_id)
+        progress = read_progress(job_dir) if job_dir else None
+        if not progress:
+            return jsonify({'error': 'Job not found'}), 404
+        status = PROGRESS_STATUS.get(progress['phase'], 'running')
+        body = dict({'job_id': job_id, 'kind': 'diff', 'status': status}, **progress_fields(progress))
+        if status == 'done':
+            body.update(success=True)
+        elif status == 'failed':
+            body.update(success=False, error=f"Processing failed: {progress.get('error')}")
+        elif status == 'cancelled':
+            body.update(success=False, cancelled=True, error='Job was cancelled')
+        return jsonify(body)
+    if job.owner != session.get('user_email'):
+        return jsonify({'error': 'Job not found'}), 404
+
+    body = {'job_id': job.id, 'kind': job.kind, 'status': job.status, 'attempts': job.attempts}
+    if job.status == 'running' and job.kind == 'diff':
+        progress = read_progress(job.payload['output_dir'])
+        if progress:
+            body.update(progress_fields(progress))
+    if job.status == 'done':
+        results = job.result
+        body.update(success=True, output_path=remap_result_paths(results), results=results)
+    elif job.status == 'failed':
+        body.update(success=False, error=f'Processing failed: {job.error}')
+    elif job.status == 'cancelled':
+        body.update(success=False, cancelled=True, error='Job was cancelled')
+    return jsonify(body)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a running or queued job; its partial outputs are removed.
+
+    The POST form exists for navigator.sendBeacon, which the page uses when it is closed mid-job.
+    """
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    job_dir = find_job_dir(job_id)
+    if not job_dir:
+        return jsonify({'error': 'Job not found'}), 404
+
+    queue_status = job_queue.cancel(job_id) if job_queue else None
+    if queue_status is None:
+        # Run by a web process (inline or progressive): finished jobs have recorded how they ended
+        status = inline_job_status(job_dir)
+        if status in ('done', 'failed'):
+            return jsonify({'error': f'Job already {status}', 'status': status}), 409
+        if status == 'cancelled':
+            return jsonify({'success': True, 'job_id': job_id, 'status': status})
+    elif queue_status in ('done', 'failed'):
+        return jsonify({'error': f'Job already {queue_status}', 'status': queue_status}), 409
+    elif queue_status == 'cancelled':
+        # Never claimed by a worker: nothing is running, just drop the uploads
+        cleanup_inputs(job_queue.get(job_id))
+        return jsonify({'success': True, 'job_id': job_id, 'status': queue_status})
+    # The detector checks for the marker between pages, in whichever process runs the job
+    request_cancel(job_dir)
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'cancelling'}), 202
+
+@app.route('/jobs/<job_id>/rethreshold', methods=['POST'])
+@admit_job
+def rethreshold_job(job_id):
+    """Re-run thresholding/filtering of a finished job with new settings, without re-rendering."""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    job_output = find_job_output(job_id)
+    if not job_output:
+        return jsonify({'error': 'Job not found'}), 404
+
+    form_settings = settings_from_request()
+    settings = {key: form_settings[key] for key in ('sensitivity', 'display_filter', 'export_all_patterns')}
+    try:
+        results = PixelDiffDetector().rethreshold_output(job_output, settings=settings)
+    except FileNotFoundError:
+        return jsonify({'error': 'This job has no saved intermediates; run the comparison again'}), 409
+    except Exception as e:
+        logging.error(f"Rethreshold error: {e}")
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+    sub_rel = remap_result_paths(results)
+    return jsonify({'success': True, 'job_id': job_id, 'output_path': sub_rel, 'results': results})
+
 @app.route('/download/<path:filename>')
 def download_file(filename):
     """Download generated files."""
@@ -290,6 +951,22 @@ def status():
         'user': session.get('user_name', '')
     })
 
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process answers requests (no load checks, so a busy container is not restarted)."""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 while the container can take another comparison, otherwise 503."""
+    ready, report = capacity_report()
+    report['ready'] = ready
+    if ready:
+        return jsonify(report)
+    response = jsonify(report)
+    response.headers['Retry-After'] = str(RETRY_AFTER_SEC)
+    return response, 503
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -297,6 +974,19 @@ if __name__ == '__main__':
 # Apply rate limit to upload if limiter is available
 if limiter:
     try:
-        app.view_functions['upload_files'] = limiter.limit("2 per minute")(app.view_functions['upload_files'])
+        for endpoint in ('upload_files', 'upload_chain'):
+            app.view_functions[endpoint] = limiter.limit("2 per minute")(app.view_functions[endpoint])
+        app.view_functions['rethreshold_job'] = limiter.limit("20 per minute")(app.view_functions['rethreshold_job'])
+        app.view_functions['quick_check'] = limiter.limit("30 per minute")(app.view_functions['quick_check'])
+        # Clients poll job status while a worker runs the comparison
+        app.view_functions['job_status'] = limiter.limit("120 per minute")(app.view_functions['job_status'])
+        app.view_functions['cancel_job'] = limiter.limit("30 per minute")(app.view_functions['cancel_job'])
+        # A 50 MB file is about a dozen chunks; retries after a dropped connection resend only the missing ones
+        app.view_functions['begin_upload'] = limiter.limit("60 per minute")(app.view_functions['begin_upload'])
+        app.view_functions['put_upload_chunk'] = limiter.limit("600 per minute")(app.view_functions['put_upload_chunk'])
+        app.view_functions['complete_upload'] = limiter.limit("60 per minute")(app.view_functions['complete_upload'])
+        # Probed every few seconds by Docker, nginx and orchestrators
+        for endpoint in ('healthz', 'readyz'):
+            app.view_functions[endpoint] = limiter.exempt(app.view_functions[endpoint])
     except Exception:
         pass